@@ -1,5 +1,6 @@
 import os
 import traceback
+from datetime import timedelta
 
 from flask import Flask, request, got_request_exception
 from flask_jwt_extended import JWTManager
@@ -58,16 +59,50 @@ def create_app(env: str = "development"):
     CORS(app)
     stripe.api_key = app.config["STRIPE_KEY"]
     stripe.api_base = app.config["STRIPE_ENDPOINT"]
-    from app.jobs.nomad_cleanup import check_all_boxes
+
+    # Workers are not preloaded, so each one resolves its dependencies here,
+    # before it accepts traffic, rather than on its first request
+    if env == "production":
+        from app.utils.dns import warm_discovery_cache
+
+        unresolved = warm_discovery_cache(
+            app, app.config["DISCOVERY_WARMUP"], app.config["DISCOVERY_WARMUP_TIMEOUT"]
+        )
+        if unresolved:
+            app.logger.warning("Could not resolve %s at startup", unresolved)
+
+    from app.jobs.capacity import refresh_cluster_capacity
+    from app.jobs.nomad_cleanup import check_all_boxes, expire_boxes
+    from app.jobs.provisioning import dispatch_admissions
+    from app.jobs.warm_pool import refill_warm_pool
 
     # queue job hour
     check_all_boxes.cron("0 * * * *", "Check running boxes")
+    refill_warm_pool.cron("* * * * *", "Refill warm box pool")
+    expire_boxes.schedule(
+        timedelta(0),
+        interval=app.config["BOX_EXPIRY_INTERVAL"],
+        job_id="interval-expire-boxes",
+        description="Expire finished box sessions",
+    )
+    refresh_cluster_capacity.schedule(
+        timedelta(0),
+        interval=app.config["CAPACITY_REFRESH_INTERVAL"],
+        job_id="interval-refresh-cluster-capacity",
+        description="Snapshot free cluster capacity",
+    )
+    dispatch_admissions.schedule(
+        timedelta(0),
+        interval=app.config["RQ_SCHEDULER_INTERVAL"],
+        job_id="interval-dispatch-admissions",
+        description="Dispatch queued boxes",
+    )
     from app.routes.boxes import box_blueprint
     from app.routes.config import config_blueprint
     from app.routes.authentication import auth_blueprint
     from app.routes.account import account_blueprint
     from app.routes.root import root_blueprint
-    from app.commands import plan
+    from app.commands import plan, nomad_cli, image
 
     from querystring_parser.parser import parse as qs_parse
 
@@ -83,6 +118,8 @@ def create_app(env: str = "development"):
     app.register_blueprint(account_blueprint)
     app.register_blueprint(root_blueprint)
     app.cli.add_command(plan)
+    app.cli.add_command(nomad_cli)
+    app.cli.add_command(image)
 
     from app.serializers import ErrorSchema
     from app.utils.errors import (
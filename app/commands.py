@@ -1,8 +1,11 @@
 import stripe
 import click
 from flask.cli import with_appcontext
-from app.models import Plan
-from app import db
+from app.models import Image, Plan
+from app import db, Q
+from app.jobs.images import prepull_images
+from app.utils.node_index import NodeIndex
+from app.utils.nomad_pool import nomad_client
 
 LIMITS = {
     "free": {
@@ -47,6 +50,14 @@ LIMITS = {
     },
 }
 
+IMAGES = {
+    "ubuntu": {"tag": "cypherpunkarmory/ubuntu:0.0.1"},
+    "debian": {"tag": "cypherpunkarmory/debian:0.0.1"},
+    "kali": {"tag": "cypherpunkarmory/kali:0.0.1"},
+    "alpine": {"tag": "cypherpunkarmory/alpine:0.0.1"},
+    "arch": {"tag": "cypherpunkarmory/arch:0.0.1"},
+}
+
 
 @click.group()
 def plan():
@@ -95,3 +106,91 @@ def populate():
         db.session.add(p)
 
     db.session.commit()
+
+
+@click.group(name="nomad")
+def nomad_cli():
+    """ Manage Nomad Cluster State """
+    pass
+
+
+@nomad_cli.command("watch-nodes")
+@with_appcontext
+def watch_nodes_command():
+    """ Keep the node address index in sync with the cluster """
+    NodeIndex(Q.connection, nomad_client()).watch(reconnect=nomad_client)
+
+
+@nomad_cli.command("prepull")
+@with_appcontext
+def prepull_command():
+    """ Pull every enabled catalog image onto every client node """
+    prepull_images.queue()
+
+
+@click.group()
+def image():
+    """ Manage the Image Catalog """
+    pass
+
+
+@image.command("populate")
+@with_appcontext
+def populate_images_command():
+    """ Create DB Entries for the default images """
+    for name, attributes in IMAGES.items():
+        if Image.query.filter_by(name=name).first() is None:
+            db.session.add(Image(name=name, **attributes))
+
+    catalog_changed()
+
+
+@image.command("set")
+@click.argument("name")
+@click.argument("tag")
+@click.option("--memory", type=int, help="Default memory in MB")
+@click.option("--cpu", type=int, help="Default CPU in MHz")
+@with_appcontext
+def set_image_command(name, tag, memory, cpu):
+    """ Add an image or point it at a new tag """
+    entry = Image.query.filter_by(name=name).first() or Image(name=name)
+    entry.tag = tag
+    # Limits left out keep the image's current ones
+    if memory is not None:
+        entry.memory = memory
+    if cpu is not None:
+        entry.cpu = cpu
+    db.session.add(entry)
+
+    catalog_changed()
+
+
+@image.command("enable")
+@click.argument("name")
+@with_appcontext
+def enable_image_command(name):
+    set_enabled(name, True)
+
+
+@image.command("disable")
+@click.argument("name")
+@with_appcontext
+def disable_image_command(name):
+    set_enabled(name, False)
+
+
+def set_enabled(name, enabled):
+    entry = Image.query.filter_by(name=name).first()
+    if entry is None:
+        raise click.BadParameter(f"No image named {name}")
+
+    entry.enabled = enabled
+    db.session.add(entry)
+
+    catalog_changed()
+
+
+def catalog_changed():
+    """ Save catalog changes and bring the nodes in line with them """
+    db.session.commit()
+    prepull_images.queue()
@@ -0,0 +1,12 @@
+from flask import current_app
+
+from app import Q
+from app.utils.capacity import ClusterCapacity
+from app.utils.nomad_pool import nomad_client
+
+
+@Q.job(func_or_queue="nomad", timeout=60000)
+def refresh_cluster_capacity():
+    interval = current_app.config["CAPACITY_REFRESH_INTERVAL"]
+    # Outlive a couple of missed refreshes, but not a stopped refresher
+    ClusterCapacity(Q.connection, max_age=interval * 3).refresh(nomad_client())
@@ -0,0 +1,8 @@
+from app import Q
+
+
+@Q.job(func_or_queue="nomad", timeout=60000)
+def prepull_images():
+    from app.services.image import ImagePrePullService
+
+    ImagePrePullService().sync()
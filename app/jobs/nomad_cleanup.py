@@ -1,47 +1,273 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
 import nomad
+from consul import ConsulException
+from flask import current_app
+from requests.exceptions import RequestException
+
 from app import Q
 from app import db
-from app.utils.dns import discover_service
+from app.utils.nomad_pool import nomad_client
 from datetime import timedelta, datetime
 import os
 
-from app.models import Box
+from app.models import Box, WarmBox
+from app.utils.errors import NomadUnavailable
+from app.utils.metrics import box_drift
+
+# Jobs deregistered, or boxes torn down, per batch during reconciliation
+RECONCILE_BATCH = 100
 
 
 @Q.job(func_or_queue="nomad", timeout=60000)
-def cleanup_old_nomad_box(job_id):
-    nomad_client = nomad.Nomad(discover_service("nomad").ip)
+def cleanup_old_nomad_box(job_id, node_ids=()):
+    """Deregister a box job.  `node_ids` are nodes its home volume may be on
+    that Nomad might no longer list an allocation for, such as the node a
+    hibernated box was recorded on."""
+    from app.services.warm_pool import (
+        WARM_JOB_PREFIX,
+        release_session_end,
+        release_ssh_key,
+    )
 
     try:
-        del_box_nomad(nomad_client, job_id)
+        del_box_nomad(nomad_client(), job_id, node_ids)
+    except NomadUnavailable as e:
+        cleanup_old_nomad_box.schedule(
+            timedelta(seconds=e.retry_after), job_id, node_ids, timeout=60000
+        )
+        return
     except nomad.api.exceptions.BaseNomadException:
-        cleanup_old_nomad_box.schedule(timedelta(hours=2), job_id, timeout=60000)
+        cleanup_old_nomad_box.schedule(
+            timedelta(hours=2), job_id, node_ids, timeout=60000
+        )
         raise nomad.api.exceptions.BaseNomadException
 
+    release_session_end(job_id)
+    if job_id.startswith(WARM_JOB_PREFIX):
+        release_ssh_key(job_id)
+
 
 @Q.job(func_or_queue="nomad", timeout=60000)
-def expire_running_box(current_user, box):
-    from app.services.box import BoxDeletionService
+def expire_boxes():
+    """Tear down every box whose session has ended, BOX_EXPIRY_BATCH at a time.
 
-    BoxDeletionService(current_user=current_user, box=box).delete()
-    db.session.commit()
+    Runs every BOX_EXPIRY_INTERVAL seconds.  Due boxes are found through the
+    session_end_time index and claimed with SKIP LOCKED, so overlapping
+    sweeps split the work instead of tearing the same box down twice.
+    """
+    from app.services.box import BoxTeardownService
+
+    batch = current_app.config["BOX_EXPIRY_BATCH"]
+    while True:
+        due = (
+            Box.query.filter(Box.session_end_time <= datetime.utcnow())
+            .order_by(Box.session_end_time)
+            .limit(batch)
+            .with_for_update(skip_locked=True, of=Box)
+        )
+        expired = BoxTeardownService(due).delete(expiring=True)
+        db.session.commit()
+        if len(expired) < batch:
+            return
+
+
+@Q.job(func_or_queue="nomad", timeout=60000)
+def cleanup_old_nomad_boxes(job_ids, nodes=None):
+    """Deregister many box jobs at once, rescheduling the ones that fail.
+
+    `nodes` maps jobs to a node their home volume is on, as recorded for
+    hibernated boxes.  Returns the jobs that could not be deregistered, with
+    the reason, so the failures show up on the job result as well as being
+    retried.
+    """
+    from app.services.warm_pool import WARM_JOB_PREFIX, release_ssh_key
 
+    nodes = nodes or {}
+    failures = del_boxes_nomad(job_ids, nodes)
+
+    for job_id in job_ids:
+        if job_id not in failures and job_id.startswith(WARM_JOB_PREFIX):
+            release_ssh_key(job_id)
+
+    if failures:
+        unavailable = any(isinstance(e, NomadUnavailable) for e in failures.values())
+        retry_in = timedelta(seconds=30) if unavailable else timedelta(hours=2)
+        cleanup_old_nomad_boxes.schedule(
+            retry_in,
+            list(failures),
+            {job_id: nodes[job_id] for job_id in failures if job_id in nodes},
+            timeout=60000,
+        )
+
+    return {job_id: str(error) for job_id, error in failures.items()}
+
+
+def del_box_nomad(nomad_client, job_id, node_ids: Iterable[str] = ()):
+    """Purge a box job and queue removing its home volume from every node it
+    ran on, as well as from `node_ids`"""
+    nodes = set(node_ids)
+    nodes.update(a["NodeID"] for a in nomad_client.job.get_allocations(job_id))
+    try:
+        nomad_client.job.deregister_job(job_id, purge=True)
+    except nomad.api.exceptions.URLNotFoundNomadException:
+        # Nomad collects stopped jobs, so a hibernated box's can be gone
+        # while its volume is still on the node
+        if not nodes:
+            raise
+
+    if nodes:
+        remove_home_volume.queue(job_id, sorted(nodes), timeout=60000)
+
+
+@Q.job(func_or_queue="nomad", timeout=60000)
+def remove_home_volume(job_id: str, node_ids: List[str]):
+    """Remove a deregistered box job's home volume from each of its nodes,
+    rescheduling the nodes whose cleanup job could not be submitted"""
+    from app.services.box_job import home_volume_cleanup_job
 
-def del_box_nomad(nomad_client, job_id):
-    nomad_client.job.deregister_job(job_id, purge=True)
+    client = nomad_client()
+    failed = []
+    for node_id in node_ids:
+        try:
+            client.jobs.register_job(home_volume_cleanup_job(job_id, node_id))
+        except (nomad.api.exceptions.BaseNomadException, NomadUnavailable):
+            failed.append(node_id)
+
+    if failed:
+        remove_home_volume.schedule(timedelta(minutes=5), job_id, failed, timeout=60000)
+
+
+def del_boxes_nomad(
+    job_ids, nodes: Optional[Dict[str, str]] = None
+) -> Dict[str, Exception]:
+    """Deregister jobs, at most NOMAD_CLEANUP_CONCURRENCY at a time.
+
+    A job Nomad no longer knows about counts as deregistered.
+    """
+    if not job_ids:
+        return {}
+
+    app = current_app._get_current_object()
+    workers = min(len(job_ids), app.config["NOMAD_CLEANUP_CONCURRENCY"])
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            job_id: executor.submit(
+                del_box_in_context, app, job_id, (nodes or {}).get(job_id)
+            )
+            for job_id in job_ids
+        }
+
+    failures = {}
+    for job_id, future in futures.items():
+        try:
+            future.result()
+        except (
+            nomad.api.exceptions.BaseNomadException,
+            NomadUnavailable,
+            ConsulException,
+            RequestException,
+        ) as e:
+            failures[job_id] = e
+
+    return failures
+
+
+def del_box_in_context(app, job_id, node_id=None):
+    from app.services.warm_pool import release_session_end
+
+    with app.app_context():
+        try:
+            del_box_nomad(nomad_client(), job_id, [node_id] if node_id else [])
+        except nomad.api.exceptions.URLNotFoundNomadException:
+            pass
+        release_session_end(job_id)
 
 
 @Q.job(func_or_queue="nomad", timeout=100000)
 def check_all_boxes():
-    nomad_client = nomad.Nomad(discover_service("nomad").ip)
-    deployments = nomad_client.job.get_deployments("ssh-client")
+    """Bring Nomad and the database back in step.
+
+    Box jobs in Nomad and boxes in the database are compared as two sets,
+    built from one job listing and one query per table.  Jobs the database
+    does not know about are deregistered and boxes whose session ended
+    without the sweeper catching them are torn down, RECONCILE_BATCH at a
+    time.  Resumes that claimed a box more than two box start timeouts ago
+    and never finished put the box back to hibernated.  Jobs submitted
+    within the last two box start timeouts are left alone, their box may
+    not be committed yet.  The size of each kind of drift is kept in the
+    userland_box_drift gauge.
+    """
+    from app.services.box import BoxTeardownService
+    from app.services.box_job import BOX_JOB_PREFIX
+
+    now = datetime.utcnow()
+    settled = now - timedelta(seconds=current_app.config["BOX_START_TIMEOUT"] * 2)
+
+    jobs = nomad_client().jobs.get_jobs(prefix=BOX_JOB_PREFIX)
+    boxes = db.session.query(Box.id, Box.job_id, Box.state, Box.session_end_time).all()
+    warm_job_ids = {job_id for job_id, in db.session.query(WarmBox.job_id)}
+
+    known = {box.job_id for box in boxes} | warm_job_ids
+    orphaned = [
+        job["ID"]
+        for job in jobs
+        if job["ID"] not in known and submitted_at(job) < settled
+    ]
+    expired = [
+        box.id for box in boxes if box.session_end_time and box.session_end_time <= now
+    ]
+    nomad_job_ids = {job["ID"] for job in jobs}
+    missing = [
+        box.id
+        for box in boxes
+        if box.state == Box.RUNNING
+        and box.job_id not in nomad_job_ids
+        and box.id not in expired
+    ]
+
+    stalled = []
+    for box in Box.query.filter(
+        Box.state == Box.PENDING, Box.job_spec.isnot(None), Box.claimed_at < settled
+    ).with_for_update(skip_locked=True, of=Box):
+        stalled.append(box.id)
+        # Stop without purging, the job keeps the home volume around
+        try:
+            nomad_client().job.deregister_job(box.job_id, purge=False)
+        except nomad.api.exceptions.BaseNomadException:
+            pass
+        box.state = Box.HIBERNATED
+        box.claimed_at = None
+    db.session.commit()
+
+    for start in range(0, len(orphaned), RECONCILE_BATCH):
+        cleanup_old_nomad_boxes.queue(
+            orphaned[start : start + RECONCILE_BATCH], timeout=60000
+        )
+
+    for start in range(0, len(expired), RECONCILE_BATCH):
+        due = Box.query.filter(
+            Box.id.in_(expired[start : start + RECONCILE_BATCH])
+        ).with_for_update(skip_locked=True, of=Box)
+        BoxTeardownService(due).delete(expiring=True)
+        db.session.commit()
+
+    pipe = Q.connection.pipeline(transaction=False)
+    box_drift.set(pipe, len(orphaned), kind="orphaned")
+    box_drift.set(pipe, len(expired), kind="expired")
+    box_drift.set(pipe, len(missing), kind="missing")
+    box_drift.set(pipe, len(stalled), kind="stalled")
+    pipe.execute()
 
-    for deployment in deployments:
-        box_exist = Box.query.filter_by(job_id=deployment).first()
+    return {
+        "orphaned": orphaned,
+        "expired": expired,
+        "missing": missing,
+        "stalled": stalled,
+    }
 
-        if datetime.utcnow >= box_exist.session_end_time:
-            cleanup_old_nomad_box(deployment)
-            continue
 
-        if not box_exist:
-            cleanup_old_nomad_box(deployment)
+def submitted_at(job: Dict) -> datetime:
+    # Nomad reports submit times in nanoseconds since the epoch
+    return datetime.utcfromtimestamp(job.get("SubmitTime", 0) / 1e9)
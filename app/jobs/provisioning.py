@@ -0,0 +1,105 @@
+import time
+import uuid
+
+from flask import current_app
+
+from app import Q
+from app import db
+from app.models import Box
+from app.utils.errors import BoxError, ClusterFull
+from app.utils.locks import acquire_lock, release_lock
+
+DISPATCH_LOCK = "userland:admission:dispatching"
+
+
+@Q.job(func_or_queue="nomad", timeout=60000)
+def dispatch_admissions():
+    """Hand the next admitted boxes to the provisioning workers"""
+    from app.services.admission import AdmissionQueue
+
+    token = uuid.uuid4().hex
+    if not acquire_lock(Q.connection, DISPATCH_LOCK, token, expire=60, wait=0):
+        return
+
+    try:
+        for entry in AdmissionQueue.from_config(Q.connection).dispatch():
+            provision_box.queue(
+                entry["box_id"],
+                entry["ssh_key"],
+                entry["image"],
+                entry["deadline"],
+                timeout=60000,
+            )
+    finally:
+        release_lock(Q.connection, DISPATCH_LOCK, token)
+
+
+@Q.job(func_or_queue="nomad", timeout=60000)
+def provision_box(box_id, ssh_key, image, deadline=None):
+    from app.services.admission import AdmissionQueue
+
+    admission = AdmissionQueue.from_config(Q.connection)
+    started = time.monotonic()
+    seconds = None
+    try:
+        requeued = provision(admission, box_id, ssh_key, image, deadline)
+        if not requeued:
+            seconds = time.monotonic() - started
+    finally:
+        admission.finish(box_id, seconds)
+
+    # A box that went back for want of room leaves the next dispatch to the
+    # interval, or it would be retried straight away
+    if not requeued:
+        dispatch_admissions.queue()
+
+
+def provision(admission, box_id, ssh_key, image, deadline) -> bool:
+    """Start a pending box, returning whether it went back in the queue"""
+    from app.services.box import BoxCreationService
+
+    box = Box.query.get(box_id)
+
+    # The box may have been stopped while it was still waiting in the queue
+    if box is None or box.state != Box.PENDING:
+        return False
+
+    if deadline is None:
+        deadline = time.time() + current_app.config["BOX_START_TIMEOUT"]
+
+    service = BoxCreationService(box.user, box.config_id, ssh_key, image)
+    # A box opened without a config got an unnamed one of its own
+    service.created_config = not box.config.name
+    try:
+        service.provision(box)
+    except ClusterFull:
+        # Wait for room at the front of the queue rather than failing a box
+        # the user is already waiting on
+        if time.time() < deadline:
+            admission.push(
+                box_id,
+                str(box.user.uuid),
+                box.user.plan.name,
+                ssh_key,
+                image,
+                deadline,
+                front=True,
+            )
+            return True
+        fail(service, box)
+    except BoxError:
+        fail(service, box)
+
+    db.session.commit()
+    return False
+
+
+def fail(service, box: Box) -> None:
+    """Tell clients the box failed and drop it, as a synchronous open does.
+    A failed row left behind would share its config and job_id with the
+    next box opened on that config."""
+    from app.services.box_events import publish_box_event
+
+    box.state = Box.FAILED
+    publish_box_event(box)
+    service.release(box)
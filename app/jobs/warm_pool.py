@@ -0,0 +1,10 @@
+from flask import current_app
+from app import Q
+
+
+@Q.job(func_or_queue="nomad", timeout=600000)
+def refill_warm_pool():
+    from app.services.warm_pool import WarmPoolService
+
+    if current_app.config["WARM_POOL_SIZES"]:
+        WarmPoolService().refill()
@@ -4,6 +4,7 @@ from werkzeug import check_password_hash, generate_password_hash
 from app import db
 from sqlalchemy.dialects.postgresql import UUID
 from typing import NamedTuple
+from datetime import datetime
 
 
 class UserLimit(NamedTuple):
@@ -102,15 +103,66 @@ class User(db.Model):  # type: ignore
 
 
 class Box(db.Model):  # type: ignore
+    PENDING = "pending"
+    RUNNING = "running"
+    HIBERNATED = "hibernated"
+    FAILED = "failed"
+
     id = db.Column(db.Integer, primary_key=True)
     config_id = db.Column(db.Integer, db.ForeignKey("config.id"))
     ssh_port = db.Column(db.Integer)
     job_id = db.Column(db.String(64))
     ip_address = db.Column(db.String(32))
     config = db.relationship("Config", backref="box", lazy="joined")
-    session_end_time = db.Column(DateTime())
+    session_end_time = db.Column(DateTime(), index=True)
+    state = db.Column(db.String(16), nullable=False, default=RUNNING)
+    # The stopped job and the node it ran on while the box is hibernated
+    job_spec = db.Column(db.JSON)
+    node_id = db.Column(db.String(64))
+    # When a resume took the box, so one cut short can be put back to sleep
+    claimed_at = db.Column(DateTime())
 
     user = association_proxy("config", "user")
 
     def __repr__(self):
         return "<Box {} {}>".format(self.config, self.job_id)
+
+
+class Image(db.Model):  # type: ignore
+    """An image users can open boxes with"""
+
+    DEFAULT = "ubuntu"
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(32), index=True, unique=True, nullable=False)
+    tag = db.Column(db.String(128), nullable=False)
+    memory = db.Column(db.Integer)
+    cpu = db.Column(db.Integer)
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+
+    def __repr__(self):
+        return "<Image {} {}>".format(self.name, self.tag)
+
+    def limits(self, plan_limits: UserLimit) -> UserLimit:
+        """Resources for a box of this image, never more than the plan allows"""
+        return plan_limits._replace(
+            memory=min(self.memory or plan_limits.memory, plan_limits.memory),
+            cpu=min(self.cpu or plan_limits.cpu, plan_limits.cpu),
+        )
+
+
+class WarmBox(db.Model):  # type: ignore
+    """An idle box kept running so it can be handed straight to a user"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(64), unique=True, nullable=False)
+    image = db.Column(db.String(128), index=True, nullable=False)
+    plan_id = db.Column(db.Integer, db.ForeignKey("plan.id"), nullable=False)
+    plan = db.relationship("Plan", lazy="joined")
+    ssh_port = db.Column(db.Integer)
+    ip_address = db.Column(db.String(32))
+    ready = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(DateTime(), default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<WarmBox {} {}>".format(self.image, self.job_id)
@@ -2,27 +2,49 @@
 Provides CRUD operations for Box Resources
 """
 
-from flask import Blueprint, request, Response, make_response
+from datetime import timezone
+
+from dateutil.parser import isoparse
+from flask import Blueprint, current_app, request, Response, make_response
 from flask_jwt_extended import get_jwt_identity, jwt_required
 from jsonschema import ValidationError
 from sqlalchemy.orm.exc import NoResultFound
 
-from app import json_schema_manager
-from app.models import Box, User, Config
+from app import db, json_schema_manager, Q
+from app.models import Box, User, Config, Image
 from app.serializers import ErrorSchema, BoxSchema
-from app.services.box import BoxCreationService, BoxDeletionService
+from app.services.box import (
+    BoxBatchCreationService,
+    BoxCreationService,
+    BoxDeletionService,
+    BoxExtensionService,
+    BoxHibernationService,
+)
+from app.services.box_events import BoxEventLog, box_event, hub
+from app.services.image import catalog_tag
 from app.utils.errors import (
     BadRequest,
     NotFoundError,
     AccessDenied,
     ConfigInUse,
     ConfigLimitReached,
+    ConfigLocked,
     BoxError,
     BoxLimitReached,
+    BoxNotHibernated,
+    BoxNotRunning,
+    ImageNotAvailable,
+    ClusterFull,
+    NomadUnavailable,
+    SessionLimitReached,
+    UnprocessableEntity,
 )
-from app.utils.json import dig, json_api
-from typing import Tuple
+from app.utils.idempotency import config_locks, idempotent
+from app.utils.json import dig, document, json_api
+from typing import Dict, Optional, Tuple
 
+import json
+import queue
 import rollbar
 import sys
 
@@ -47,52 +69,186 @@ def box_index() -> Tuple[Response, int]:
 
 @box_blueprint.route("/boxes", methods=["POST"])
 @jwt_required
+@idempotent
 def start_box() -> Tuple[Response, int]:
+    if isinstance(dig(request.json, "data"), list):
+        return start_boxes()
+
     try:
         json_schema_manager.validate(request.json, "box_create.json")
 
         config_id = dig(request.json, "data/relationships/config/data/id")
         ssh_key = dig(request.json, "data/attributes/sshKey")
-        image = dig(request.json, "data/attributes/image", "ubuntu")
-
-        #right now there is only one valid choice
-        #in the future there will be multiple choices and customer snapshots
-        #we will want to throw an error in the future for an invalid choice
-        if image == "ubuntu":
-            image = "cypherpunkarmory/ubuntu:0.0.1"
-        elif image == "debian":
-            image = "cypherpunkarmory/debian:0.0.1"
-        elif image == "kali":
-            image = "cypherpunkarmory/kali:0.0.1"
-        elif image == "alpine":
-            image = "cypherpunkarmory/alpine:0.0.1"
-        elif image == "arch":
-            image = "cypherpunkarmory/arch:0.0.1"
-        else:
-            image = "cypherpunkarmory/ubuntu:0.0.1"
+        image = catalog_tag(dig(request.json, "data/attributes/image", Image.DEFAULT))
 
         current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
         try:
-            box_info = BoxCreationService(current_user, config_id, ssh_key, image).create()
+            with config_locks([config_id]):
+                service = BoxCreationService(current_user, config_id, ssh_key, image)
+                if provision_async():
+                    box_info, status = service.create_async(), 202
+                else:
+                    box_info, status = service.create(), 201
+                # Commit while the config is locked so the next request sees the box
+                db.session.commit()
         except ConfigLimitReached:
             return json_api(ConfigLimitReached, ErrorSchema), 403
         except BoxLimitReached:
             return json_api(BoxLimitReached, ErrorSchema), 403
-        except BoxError:
+        except (ClusterFull, NomadUnavailable) as e:
+            response = json_api(e, ErrorSchema)
+            response.headers["Retry-After"] = str(e.retry_after)
+            return response, 503
+        except BoxError as e:
             rollbar.report_exc_info(sys.exc_info())
-            return json_api(BoxError, ErrorSchema), 500
+            return json_api(e, ErrorSchema), int(e.status)
 
-        return json_api(box_info, BoxSchema), 201
+        return json_api(box_info, BoxSchema, meta=queue_meta(service.estimate)), status
 
     except ValidationError as e:
         return json_api(BadRequest(detail=e.message), ErrorSchema), 400
 
+    except ImageNotAvailable as e:
+        return json_api(e, ErrorSchema), 422
+
     except AccessDenied:
         return json_api(AccessDenied, ErrorSchema), 403
 
     except ConfigInUse:
         return json_api(ConfigInUse, ErrorSchema), 403
 
+    except ConfigLocked as e:
+        return config_locked(e)
+
+
+def start_boxes() -> Tuple[Response, int]:
+    """
+    Open every box in a JSON:API bulk payload.  Items succeed or fail on
+    their own; meta.results lists the outcome of each in request order.
+    """
+    try:
+        json_schema_manager.validate(request.json, "boxes_create.json")
+    except ValidationError as e:
+        return json_api(BadRequest(detail=e.message), ErrorSchema), 400
+
+    try:
+        items = [
+            (
+                dig(item, "relationships/config/data/id"),
+                dig(item, "attributes/sshKey"),
+                catalog_tag(dig(item, "attributes/image", Image.DEFAULT)),
+            )
+            for item in request.json["data"]
+        ]
+    except ImageNotAvailable as e:
+        return json_api(e, ErrorSchema), 422
+
+    current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
+    asynchronous = provision_async()
+    try:
+        with config_locks(config_id for config_id, _, _ in items):
+            service = BoxBatchCreationService(current_user, items)
+            results = service.create(asynchronous)
+            db.session.commit()
+    except BoxLimitReached:
+        return json_api(BoxLimitReached, ErrorSchema), 403
+    except ConfigInUse:
+        return json_api(ConfigInUse, ErrorSchema), 403
+    except ConfigLocked as e:
+        return config_locked(e)
+
+    box_status = "202" if asynchronous else "201"
+    outcomes = []
+    retry_after = None
+    for index, result in enumerate(results):
+        if isinstance(result, Box):
+            outcome = {"status": box_status, "id": str(result.id)}
+            outcome.update(queue_meta(service.estimates.get(index)) or {})
+        else:
+            if isinstance(result, (ClusterFull, NomadUnavailable)):
+                retry_after = result.retry_after
+            elif isinstance(result, BoxError):
+                rollbar.report_exc_info((type(result), result, result.__traceback__))
+            outcome = {
+                "status": result.status,
+                "error": document(result, ErrorSchema)["data"],
+            }
+        outcomes.append(outcome)
+
+    boxes = [result for result in results if isinstance(result, Box)]
+    response = json_api(boxes, BoxSchema, many=True, meta={"results": outcomes})
+    if retry_after:
+        response.headers["Retry-After"] = str(retry_after)
+    statuses = {outcome["status"] for outcome in outcomes}
+    return response, int(box_status) if statuses == {box_status} else 207
+
+
+def queue_meta(estimate: Optional[Tuple[int, int]]) -> Optional[Dict]:
+    """Where a queued box stands, so clients know how long to wait"""
+    if estimate is None:
+        return None
+    position, wait = estimate
+    return {"queuePosition": position, "estimatedWait": wait}
+
+
+def config_locked(error: ConfigLocked) -> Tuple[Response, int]:
+    """Tell the client to retry rather than wait for another request's lock"""
+    response = json_api(error, ErrorSchema)
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 409
+
+
+def provision_async() -> bool:
+    """
+    Boxes are provisioned in the background when the deployment asks for it,
+    or when the client sends `Prefer: respond-async`
+    """
+    if current_app.config["ASYNC_BOX_PROVISIONING"]:
+        return True
+    return "respond-async" in request.headers.get("Prefer", "")
+
+
+@box_blueprint.route("/boxes/events", methods=["GET"])
+@jwt_required
+def box_events() -> Tuple[Response, int]:
+    """
+    Long-poll for state changes of a users boxes.  Without a cursor, or with
+    one too old to catch up from, the answer is the current state of each
+    box.  With a cursor it is the changes made since, waiting up to
+    BOX_EVENTS_WAIT seconds for the first.  meta.cursor goes in the next poll.
+    """
+    current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
+    user = str(current_user.uuid)
+    log = BoxEventLog(Q.connection)
+    cursor = request.args.get("cursor", type=int)
+
+    # Subscribe before reading the log so no change falls between
+    listener = hub.subscribe(Q.connection, user)
+    try:
+        changes = log.since(user, cursor) if cursor is not None else None
+        if changes is not None and not changes[0]:
+            try:
+                listener.get(timeout=current_app.config["BOX_EVENTS_WAIT"])
+            except queue.Empty:
+                pass
+            changes = log.since(user, cursor)
+    finally:
+        hub.unsubscribe(user, listener)
+
+    if changes is None:
+        # Read the cursor first, a change made in between is then sent twice
+        # rather than missed
+        latest = log.latest(user)
+        changes = [box_event(box) for box in current_user.boxes], latest
+
+    events, latest = changes
+    response = make_response(
+        json.dumps({"data": events, "meta": {"cursor": str(latest)}})
+    )
+    response.headers["Content-Type"] = "application/vnd.api+json"
+    response.headers["Cache-Control"] = "no-cache"
+    return response, 200
+
 
 @box_blueprint.route("/boxes/<int:box_id>", methods=["DELETE"])
 @jwt_required
@@ -110,6 +266,94 @@ def stop_box(box_id) -> Tuple[Response, int]:
         return json_api(BoxError, ErrorSchema), 500
 
 
+@box_blueprint.route("/boxes/<int:box_id>", methods=["PATCH"])
+@jwt_required
+def extend_box(box_id) -> Tuple[Response, int]:
+    """
+    Move the end of a running box's session, up to the plan's duration from
+    now, without restarting it
+    """
+    current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
+    box = Box.query.filter_by(user=current_user, id=box_id).first_or_404()
+
+    try:
+        json_schema_manager.validate(request.json, "box_update.json")
+        session_end_time = isoparse(dig(request.json, "data/attributes/sessionEndTime"))
+    except (ValidationError, ValueError) as e:
+        return json_api(BadRequest(detail=str(e)), ErrorSchema), 400
+
+    # Boxes keep naive UTC times
+    if session_end_time.tzinfo is not None:
+        session_end_time = session_end_time.astimezone(timezone.utc).replace(
+            tzinfo=None
+        )
+
+    try:
+        box = BoxExtensionService(current_user, box).extend(session_end_time)
+        db.session.commit()
+    except SessionLimitReached:
+        return json_api(SessionLimitReached, ErrorSchema), 403
+    except BoxNotRunning as e:
+        return json_api(e, ErrorSchema), 409
+    except UnprocessableEntity as e:
+        return json_api(e, ErrorSchema), 422
+    except BoxError:
+        rollbar.report_exc_info(sys.exc_info())
+        return json_api(BoxError, ErrorSchema), 500
+
+    return json_api(box, BoxSchema), 200
+
+
+@box_blueprint.route("/boxes/<int:box_id>/hibernate", methods=["POST"])
+@jwt_required
+def hibernate_box(box_id) -> Tuple[Response, int]:
+    """
+    Stop a running box, keeping its job and files so it resumes quickly
+    """
+    current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
+    box = Box.query.filter_by(user=current_user, id=box_id).first_or_404()
+
+    try:
+        box = BoxHibernationService(current_user, box).hibernate()
+        db.session.commit()
+    except BoxNotRunning as e:
+        return json_api(e, ErrorSchema), 409
+    except NomadUnavailable as e:
+        response = json_api(e, ErrorSchema)
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response, 503
+    except BoxError:
+        rollbar.report_exc_info(sys.exc_info())
+        return json_api(BoxError, ErrorSchema), 500
+
+    return json_api(box, BoxSchema), 200
+
+
+@box_blueprint.route("/boxes/<int:box_id>/resume", methods=["POST"])
+@jwt_required
+def resume_box(box_id) -> Tuple[Response, int]:
+    """
+    Start a hibernated box again, with a fresh session
+    """
+    current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
+    box = Box.query.filter_by(user=current_user, id=box_id).first_or_404()
+
+    try:
+        box = BoxHibernationService(current_user, box).resume()
+        db.session.commit()
+    except BoxNotHibernated as e:
+        return json_api(e, ErrorSchema), 409
+    except (ClusterFull, NomadUnavailable) as e:
+        response = json_api(e, ErrorSchema)
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response, 503
+    except BoxError as e:
+        rollbar.report_exc_info(sys.exc_info())
+        return json_api(e, ErrorSchema), int(e.status)
+
+    return json_api(box, BoxSchema), 200
+
+
 @box_blueprint.route("/boxes/<int:box_id>", methods=["GET"])
 @jwt_required
 def get_box(box_id) -> Tuple[Response, int]:
@@ -1,6 +1,13 @@
-from flask import Blueprint, jsonify, current_app
+from flask import Blueprint, jsonify, current_app, make_response, request
+import hmac
 import os
 
+from app import Q
+from app.serializers import ErrorSchema
+from app.utils.errors import NotFoundError
+from app.utils.json import json_api
+from app.utils.metrics import render_metrics
+
 root_blueprint = Blueprint("root", __name__)
 
 
@@ -22,6 +29,18 @@ def health_check():
     return "OK"
 
 
+@root_blueprint.route("/metrics")
+def metrics():
+    token = current_app.config["METRICS_TOKEN"]
+    authorization = request.headers.get("Authorization", "")
+    if not token or not hmac.compare_digest(authorization, f"Bearer {token}"):
+        return json_api(NotFoundError, ErrorSchema), 404
+
+    response = make_response(render_metrics(Q.connection))
+    response.headers["Content-Type"] = "text/plain; version=0.0.4"
+    return response
+
+
 def source_commit():
     if current_app.env == "production":
         return open("./SOURCE_COMMIT").readline()
@@ -15,6 +15,8 @@ class BoxSchema(Schema):
     port = fields.List(fields.Str())
     ssh_port = fields.Str()
     ip_address = fields.Str()
+    state = fields.Str()
+    session_end_time = fields.DateTime()
 
     config = fields.Relationship(
         "/configs/{config_id}",
@@ -0,0 +1,222 @@
+import json
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+
+from flask import current_app
+
+# How far into each tier's queue the dispatcher looks for a user who is
+# not already at their in-flight cap
+SCAN_DEPTH = 50
+
+# Seconds a box is assumed to take to start until some have been timed
+DEFAULT_START_SECONDS = 30.0
+
+
+class AdmissionQueue:
+    """Orders pending boxes for the provisioning workers by plan tier.
+
+    Each plan has its own FIFO queue in Redis.  The dispatcher takes boxes
+    from the tiers by smooth weighted round robin, so under saturation a
+    tier with twice the weight gets twice the starts while every tier keeps
+    moving.  At most `concurrency` boxes are provisioning at once across the
+    cluster, and at most `user_cap` for any one user; a box over its user's
+    cap waits without holding up the users behind it.  In-flight entries
+    older than `stale_after` seconds are dropped, so a worker that dies
+    does not hold its slot forever.
+    """
+
+    PREFIX = "userland:admission"
+
+    def __init__(
+        self,
+        redis,
+        weights: Dict[str, int],
+        concurrency: int,
+        user_cap: int,
+        stale_after: int,
+    ):
+        self.redis = redis
+        self.weights = weights
+        self.concurrency = concurrency
+        self.user_cap = user_cap
+        self.stale_after = stale_after
+
+    @classmethod
+    def from_config(cls, redis) -> "AdmissionQueue":
+        config = current_app.config
+        return cls(
+            redis,
+            weights=config["ADMISSION_WEIGHTS"],
+            concurrency=config["PROVISIONING_CONCURRENCY"],
+            user_cap=config["PROVISIONING_USER_CAP"],
+            stale_after=config["BOX_START_TIMEOUT"] * 2,
+        )
+
+    def key(self, *parts: str) -> str:
+        return ":".join((self.PREFIX,) + parts)
+
+    def weight(self, tier: str) -> int:
+        return self.weights.get(tier, 1)
+
+    def push(
+        self,
+        box_id: int,
+        user: str,
+        tier: str,
+        ssh_key: str,
+        image: str,
+        deadline: Optional[float] = None,
+        front: bool = False,
+    ) -> None:
+        """Queue a box, at the back of its tier or, when retrying, the front"""
+        entry = {
+            "box_id": box_id,
+            "user": user,
+            "tier": tier,
+            "ssh_key": ssh_key,
+            "image": image,
+            "deadline": deadline,
+        }
+        order = 0 if front else self.redis.incr(self.key("sequence"))
+
+        pipe = self.redis.pipeline()
+        pipe.sadd(self.key("tiers"), tier)
+        pipe.hset(self.key("entries"), box_id, json.dumps(entry))
+        pipe.zadd(self.key("queue", tier), {box_id: order})
+        pipe.execute()
+
+    def cancel(self, box_id: int) -> None:
+        entry = self.redis.hget(self.key("entries"), box_id)
+        if entry is None:
+            return
+
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.key("queue", json.loads(entry)["tier"]), box_id)
+        pipe.hdel(self.key("entries"), box_id)
+        pipe.execute()
+
+    def estimate(self, tier: str) -> Tuple[int, int]:
+        """Queue position and seconds of wait for a box joining `tier` now"""
+        tiers = [t.decode() for t in self.redis.smembers(self.key("tiers"))]
+        pipe = self.redis.pipeline()
+        for t in tiers:
+            pipe.zcard(self.key("queue", t))
+        pipe.get(self.key("start-seconds"))
+        *lengths, start_seconds = pipe.execute()
+        queued = dict(zip(tiers, lengths))
+
+        # Other tiers get weight-proportional turns while ours drains
+        rounds = (queued.get(tier, 0) + 1) / self.weight(tier)
+        position = queued.get(tier, 0) + 1
+        for other, length in queued.items():
+            if other != tier:
+                position += min(length, math.ceil(rounds * self.weight(other)))
+
+        average = float(start_seconds or DEFAULT_START_SECONDS)
+        wait = math.ceil(position / self.concurrency) * average
+        return position, int(math.ceil(wait))
+
+    def dispatch(self) -> List[Dict]:
+        """Take the next boxes to provision and mark them in flight.
+
+        Only one dispatcher may run at a time, see dispatch_admissions.
+        """
+        now = time.time()
+        in_flight = self.in_flight(now)
+        free = self.concurrency - len(in_flight)
+        if free <= 0:
+            return []
+
+        per_user: Dict[str, int] = {}
+        for entry in in_flight.values():
+            per_user[entry["user"]] = per_user.get(entry["user"], 0) + 1
+
+        waiting = self.waiting()
+        credits = {
+            tier.decode(): float(credit)
+            for tier, credit in self.redis.hgetall(self.key("credits")).items()
+        }
+
+        started: List[Dict] = []
+        while len(started) < free:
+            candidates = {}
+            for tier, entries in waiting.items():
+                for entry in entries:
+                    if per_user.get(entry["user"], 0) < self.user_cap:
+                        candidates[tier] = entry
+                        break
+            if not candidates:
+                break
+
+            # Smooth weighted round robin, as nginx balances upstreams
+            total = sum(self.weight(tier) for tier in candidates)
+            for tier in candidates:
+                credits[tier] = credits.get(tier, 0.0) + self.weight(tier)
+            tier = max(candidates, key=lambda t: credits[t])
+            credits[tier] -= total
+
+            entry = candidates[tier]
+            waiting[tier].remove(entry)
+            per_user[entry["user"]] = per_user.get(entry["user"], 0) + 1
+            started.append(entry)
+
+        if not started:
+            return []
+
+        pipe = self.redis.pipeline()
+        for entry in started:
+            pipe.zrem(self.key("queue", entry["tier"]), entry["box_id"])
+            pipe.hdel(self.key("entries"), entry["box_id"])
+            in_flight_entry = {"user": entry["user"], "started": now}
+            pipe.hset(
+                self.key("in-flight"), entry["box_id"], json.dumps(in_flight_entry)
+            )
+        pipe.hmset(self.key("credits"), credits)
+        pipe.execute()
+
+        return started
+
+    def finish(self, box_id: int, seconds: Optional[float] = None) -> None:
+        """Free a box's slot, folding how long it took into the wait estimate"""
+        self.redis.hdel(self.key("in-flight"), box_id)
+        if seconds is None:
+            return
+
+        average = self.redis.get(self.key("start-seconds"))
+        average = float(average) * 0.8 + seconds * 0.2 if average else seconds
+        self.redis.set(self.key("start-seconds"), average)
+
+    def in_flight(self, now: float) -> Dict[str, Dict]:
+        in_flight = {
+            box_id.decode(): json.loads(entry)
+            for box_id, entry in self.redis.hgetall(self.key("in-flight")).items()
+        }
+
+        stale = [
+            box_id
+            for box_id, entry in in_flight.items()
+            if entry["started"] < now - self.stale_after
+        ]
+        if stale:
+            self.redis.hdel(self.key("in-flight"), *stale)
+
+        return {
+            box_id: entry for box_id, entry in in_flight.items() if box_id not in stale
+        }
+
+    def waiting(self) -> Dict[str, List[Dict]]:
+        """The first SCAN_DEPTH entries of each tier, oldest first"""
+        tiers = sorted(t.decode() for t in self.redis.smembers(self.key("tiers")))
+        pipe = self.redis.pipeline()
+        for tier in tiers:
+            pipe.zrange(self.key("queue", tier), 0, SCAN_DEPTH - 1)
+        heads = dict(zip(tiers, pipe.execute()))
+
+        waiting = {}
+        for tier, box_ids in heads.items():
+            if not box_ids:
+                continue
+            entries = self.redis.hmget(self.key("entries"), box_ids)
+            waiting[tier] = [json.loads(e) for e in entries if e is not None]
+        return waiting
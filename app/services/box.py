@@ -1,68 +1,124 @@
-from typing import Tuple, cast
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Union, cast
 
 import nomad
-from dpath.util import values
+from consul import ConsulException
+from requests.exceptions import RequestException
+from sqlalchemy.orm import Query
 from datetime import timedelta, datetime
 
-from app import db
-from app.jobs.nomad_cleanup import cleanup_old_nomad_box
-from app.models import Config, Box, User
+from app import db, Q
+from app.jobs.nomad_cleanup import cleanup_old_nomad_box, cleanup_old_nomad_boxes
+from app.models import Config, Box, User, WarmBox
 from app.services.config import ConfigCreationService
-from app.jobs.nomad_cleanup import expire_running_box
-from app.utils.errors import AccessDenied, BoxError, ConfigInUse, BoxLimitReached
-from app.utils.json import dig
+from app.services.image import box_limits
+from app.jobs.provisioning import dispatch_admissions
+from app.services.admission import AdmissionQueue
+from app.services.box_events import EXPIRING, GONE, publish_box_event
+from app.services.box_job import (
+    BoxJobBuilder,
+    render_box_job,
+    submit_box_job,
+    wait_for_box,
+)
+from app.services.warm_pool import (
+    claim_warm_box,
+    hand_over,
+    publish_session_end,
+    release_session_end,
+)
+from app.utils.errors import (
+    AccessDenied,
+    BoxError,
+    BoxPlacementFailed,
+    ClusterFull,
+    ConfigInUse,
+    ConfigLimitReached,
+    BoxLimitReached,
+    BoxNotHibernated,
+    BoxNotRunning,
+    JsonApiException,
+    NomadUnavailable,
+    SessionLimitReached,
+    UnprocessableEntity,
+)
 
-from app.utils.dns import discover_service
+from app.utils.capacity import ClusterCapacity
+from app.utils.metrics import (
+    PhaseTimer,
+    box_create_phase_seconds,
+    box_resume_phase_seconds,
+)
+from app.utils.nomad_pool import nomad_client
+from app.utils.session import after_commit
 
 from typing import Optional
 
-from flask import current_app, render_template
+from flask import current_app
 
 
 class BoxCreationService:
     def __init__(
-        self,
-        current_user: User,
-        config_id: Optional[int],
-        ssh_key: str,
-        image: str,
+        self, current_user: User, config_id: Optional[int], ssh_key: str, image: str
     ):
 
         self.ssh_key = ssh_key
-        self.image = image 
+        self.image = image
+        self.eval_id: Optional[str] = None
+        # Queue position and estimated wait, once queued for provisioning
+        self.estimate: Optional[Tuple[int, int]] = None
         self.current_user = current_user
-        self.session_end_time = datetime.utcnow() + timedelta(seconds=current_user.limits().duration)
+        self.limits = box_limits(image, current_user.limits())
+        self.timer = PhaseTimer(
+            box_create_phase_seconds, image=image, plan=current_user.plan.name
+        )
+        self.session_end_time = datetime.utcnow() + timedelta(
+            seconds=self.limits.duration
+        )
 
-        if config_id:
-            self.config = Config.query.get(config_id)
-        else:
-            self.config = ConfigCreationService(self.current_user).create()
+        self.created_config = not config_id
+        with self.timer.phase("config"):
+            if config_id:
+                self.config = Config.query.get(config_id)
+            else:
+                self.config = ConfigCreationService(self.current_user).create()
 
-        # We need to do this each time so each if a nomad service goes down
-        # it doesnt affect web api
-        self.nomad_client = nomad.Nomad(discover_service("nomad").ip)
+        self.nomad_client = nomad_client()
 
     def create(self) -> Box:
-        self.check_config_permissions()
-        job_id = None
-        if self.over_box_limit():
-            raise BoxLimitReached("Maximum number of opened boxes reached")
-        try:
-            job_id = self.create_box_nomad()
-            ssh_port, ip_address = self.get_box_details(job_id)
-        except BoxError:
-            # if nomad fails to even start the job then there will be no job_id
-            if job_id:
-                cleanup_old_nomad_box.queue(job_id, timeout=60000)
-            raise BoxError("Failed to create box")
-        except nomad.api.exceptions.BaseNomadException:
-            raise BoxError("Failed to create box")
+        return self.provision(self.reserve())
+
+    def create_async(self) -> Box:
+        """Reserve the box and leave the Nomad side to the provisioning worker"""
+        return self.queue_provisioning(self.reserve())
+
+    def queue_provisioning(self, box: Box) -> Box:
+        """Put the box in line for a provisioning worker once it is committed"""
+        box_id = box.id
+        user, tier = str(self.current_user.uuid), self.current_user.plan.name
+        admission = AdmissionQueue.from_config(Q.connection)
+        self.estimate = admission.estimate(tier)
+
+        def provision_after_commit():
+            admission.push(box_id, user, tier, self.ssh_key, self.image)
+            dispatch_admissions.queue()
+
+        after_commit(provision_after_commit)
+
+        return box
+
+    def reserve(self, check_limit: bool = True) -> Box:
+        """Check the user may open a box and record it as pending"""
+        with self.timer.phase("limits"):
+            self.check_config_permissions()
+            self.check_config_in_use()
+            if check_limit and self.over_box_limit():
+                raise BoxLimitReached("Maximum number of opened boxes reached")
 
         box = Box(
             config_id=self.config.id,
-            job_id=job_id,
-            ssh_port=ssh_port,
-            ip_address=ip_address,
+            job_id=self.job_name,
+            state=Box.PENDING,
             session_end_time=self.session_end_time,
         )
 
@@ -72,71 +128,462 @@ class BoxCreationService:
         db.session.add(self.config)
         db.session.flush()
 
-        expire_running_box.schedule(
-            timedelta(seconds=self.current_user.limits().duration), self.current_user, box, timeout=30
+        publish_box_event(box)
+        return box
+
+    def provision(self, box: Box) -> Box:
+        """Schedule a reserved box into Nomad and wait for it to come up"""
+        warm_box = claim_warm_box(self.image, self.current_user.plan)
+        try:
+            if warm_box:
+                with self.timer.phase("warm_claim"):
+                    job_id, ssh_port, ip_address = self.claim(warm_box)
+            else:
+                job_id, ssh_port, ip_address = self.start()
+        except BoxError as e:
+            self.timer.record(Q.connection, outcome=failure_outcome(e))
+            raise
+
+        return self.finish(box, job_id, ssh_port, ip_address)
+
+    def finish(self, box: Box, job_id: str, ssh_port: str, ip_address: str) -> Box:
+        """Record where a started box can be reached"""
+        box.job_id = job_id
+        box.ssh_port = ssh_port
+        box.ip_address = ip_address
+        box.state = Box.RUNNING
+        box.session_end_time = datetime.utcnow() + timedelta(
+            seconds=self.limits.duration
         )
 
+        with self.timer.phase("flush"):
+            db.session.add(box)
+            db.session.flush()
+
+        self.timer.record(Q.connection)
+        publish_box_event(box)
+
         return box
 
+    def release(self, box: Box) -> None:
+        """Drop a reserved box that could not be started"""
+        publish_box_event(box, GONE)
+        db.session.delete(box)
+        if self.created_config:
+            db.session.delete(self.config)
+        db.session.flush()
+
+    def start(self) -> Tuple[str, str, str]:
+        with self.timer.phase("admission"):
+            self.check_capacity()
+
+        job_id = None
+        try:
+            job_id = self.create_box_nomad()
+            ssh_port, ip_address = self.get_box_details(job_id)
+        except BoxError as e:
+            # if nomad fails to even start the job then there will be no job_id
+            if job_id:
+                cleanup_old_nomad_box.queue(job_id, timeout=60000)
+            if isinstance(e, (BoxPlacementFailed, NomadUnavailable)):
+                raise
+            raise BoxError("Failed to create box", code=e.code, meta=e.meta)
+        except nomad.api.exceptions.BaseNomadException:
+            raise BoxError("Failed to create box")
+
+        return job_id, ssh_port, ip_address
+
+    def claim(self, warm_box: WarmBox) -> Tuple[str, str, str]:
+        """Hand an already running box from the warm pool to the user"""
+        try:
+            hand_over(self.nomad_client, warm_box.job_id, self.ssh_key)
+        except BoxError as e:
+            cleanup_old_nomad_box.queue(warm_box.job_id, timeout=60000)
+            raise BoxError("Failed to create box", code=e.code, meta=e.meta)
+        except (ConsulException, nomad.api.exceptions.BaseNomadException):
+            cleanup_old_nomad_box.queue(warm_box.job_id, timeout=60000)
+            raise BoxError("Failed to create box")
+
+        return warm_box.job_id, warm_box.ssh_port, warm_box.ip_address
+
+    @property
+    def job_name(self) -> str:
+        return "box-client-box-" + str(self.config.id)
+
     def check_config_permissions(self) -> None:
         if self.config.user != self.current_user:
             raise AccessDenied("You do not own this config")
         elif self.config.user == self.current_user:
             pass
 
+    def check_config_in_use(self) -> None:
+        # Boxes are named after their config, a second one would replace the first
+        in_use = Box.query.filter(
+            Box.config_id == self.config.id, Box.state != Box.FAILED
+        ).count()
+        if in_use:
+            raise ConfigInUse("Config is associated with a running box")
+
+    def check_capacity(self) -> None:
+        # Nomad takes a job it has no room for and never places it, so a
+        # full cluster would otherwise cost a whole BOX_START_TIMEOUT
+        job = BoxJobBuilder.for_image(self.image, self.limits).base
+        if not ClusterCapacity(Q.connection).fits(self.limits, job):
+            raise ClusterFull(
+                retry_after=current_app.config["CAPACITY_REFRESH_INTERVAL"]
+            )
+
     def over_box_limit(self) -> bool:
-        num_boxes = self.current_user.boxes.count()
-        if num_boxes >= self.current_user.limits().box_count:
+        num_boxes = self.current_user.boxes.filter(Box.state != Box.FAILED).count()
+        if num_boxes >= self.limits.box_count:
             return True
         return False
 
     def create_box_nomad(self) -> str:
         """Create a box by scheduling an SSH container into the Nomad cluster"""
+        with self.timer.phase("render"):
+            job = render_box_job(
+                "box-" + str(self.config.id), self.ssh_key, self.image, self.limits
+            )
+        with self.timer.phase("submit"):
+            self.eval_id = submit_box_job(self.nomad_client, job)
+        return self.job_name
+
+    def get_box_details(self, job_id: str) -> Tuple[str, str]:
+        """Get details of ssh container"""
+        return wait_for_box(self.nomad_client, job_id, self.eval_id, self.timer)
+
+
+BoxResult = Union[Box, JsonApiException]
+
+
+class BoxBatchCreationService:
+    """Opens several boxes for one user in a single request.
+
+    Plan limits are checked once for the whole batch.  Cold boxes are
+    submitted to Nomad and waited on concurrently, at most
+    BOX_BATCH_CONCURRENCY at a time, and every item gets its own result so
+    one box failing to start does not take the rest of the batch with it.
+    """
+
+    def __init__(self, current_user: User, items: List[Tuple[Optional[int], str, str]]):
+        self.current_user = current_user
+        self.items = items
+        self.estimates: Dict[int, Tuple[int, int]] = {}
+
+    def create(self, provision_async: bool = False) -> List[BoxResult]:
+        results: List[BoxResult] = [None] * len(self.items)  # type: ignore
+        services = self.prepare(results)
+        fresh = [
+            index for index, (config_id, _, _) in enumerate(self.items) if not config_id
+        ]
+
+        if self.over_box_limit(len(services) + len(fresh)):
+            raise BoxLimitReached("Maximum number of opened boxes reached")
+
+        # Items without a config get one only once the batch is known to fit
+        for index in fresh:
+            _, ssh_key, image = self.items[index]
+            services[index] = BoxCreationService(
+                self.current_user, None, ssh_key, image
+            )
+
+        boxes = {
+            index: service.reserve(check_limit=False)
+            for index, service in services.items()
+        }
+
+        if provision_async:
+            for index, service in services.items():
+                results[index] = service.queue_provisioning(boxes[index])
+                self.estimates[index] = cast(Tuple[int, int], service.estimate)
+            return results
+
+        for index, details in self.launch(services).items():
+            service, box = services[index], boxes[index]
+            if isinstance(details, BoxError):
+                service.timer.record(Q.connection, outcome=failure_outcome(details))
+                service.release(box)
+                results[index] = details
+            else:
+                results[index] = service.finish(box, *details)
+
+        return results
+
+    def prepare(self, results: List[BoxResult]) -> Dict[int, BoxCreationService]:
+        """Build a creation service per item with a config, recording items
+        that are refused"""
+        services = {}
+        config_ids = set()
+        for index, (config_id, ssh_key, image) in enumerate(self.items):
+            if not config_id:
+                continue
+            try:
+                if config_id in config_ids:
+                    raise ConfigInUse("Config is used by another box in this batch")
+                config_ids.add(config_id)
+
+                service = BoxCreationService(
+                    self.current_user, config_id, ssh_key, image
+                )
+                service.check_config_permissions()
+                service.check_config_in_use()
+            except (AccessDenied, ConfigInUse, ConfigLimitReached) as e:
+                results[index] = e
+            else:
+                services[index] = service
 
-        stripped_ssh_key = "".join(i for i in self.ssh_key if 31 < ord(i) < 127)
-        new_job = render_template(
-            "box.j2.json",
-            ssh_key=stripped_ssh_key,
-            box_name="box-" + str(self.config.id),
-            bandwidth=str(self.current_user.limits().bandwidth),
-            duration=self.current_user.limits().duration,
-            image=self.image,
-            memory=self.current_user.limits().memory,
-            cpu=self.current_user.limits().cpu,
+        return services
+
+    def over_box_limit(self, requested: int) -> bool:
+        num_boxes = self.current_user.boxes.filter(Box.state != Box.FAILED).count()
+        return num_boxes + requested > self.current_user.limits().box_count
+
+    def launch(
+        self, services: Dict[int, BoxCreationService]
+    ) -> Dict[int, Union[Tuple[str, str, str], BoxError]]:
+        """Start every box in the batch and wait for them together"""
+        launched: Dict[int, Union[Tuple[str, str, str], BoxError]] = {}
+        cold = {}
+        for index, service in services.items():
+            warm_box = claim_warm_box(service.image, self.current_user.plan)
+            if not warm_box:
+                cold[index] = service
+                continue
+            try:
+                launched[index] = service.claim(warm_box)
+            except BoxError as e:
+                launched[index] = e
+
+        if not cold:
+            return launched
+
+        app = current_app._get_current_object()
+        workers = min(len(cold), current_app.config["BOX_BATCH_CONCURRENCY"])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                index: executor.submit(start_in_context, app, service)
+                for index, service in cold.items()
+            }
+
+        for index, future in futures.items():
+            try:
+                launched[index] = future.result()
+            except BoxError as e:
+                launched[index] = e
+
+        return launched
+
+
+def failure_outcome(error: BoxError) -> str:
+    """The outcome label phase timings of a failed start are recorded under"""
+    return error.code or "failed"
+
+
+def start_in_context(app, service: BoxCreationService) -> Tuple[str, str, str]:
+    # Only Nomad is touched off the request thread, the database session
+    # stays with the request
+    with app.app_context():
+        return service.start()
+
+
+class BoxExtensionService:
+    """Moves the end of a running box's session without restarting it.
+
+    Sessions may be moved to end at most the plan's duration from now.  The
+    expiry sweeper works from session_end_time, so moving it moves the
+    expiry; the box is told through the Consul key its job renders into the
+    task, see session_end_template.
+    """
+
+    def __init__(self, current_user: User, box: Box):
+        self.current_user = current_user
+        self.box = box
+
+    def extend(self, session_end_time: datetime) -> Box:
+        if self.box.state != Box.RUNNING:
+            raise BoxNotRunning("Only running boxes can be extended")
+
+        now = datetime.utcnow()
+        latest = now + timedelta(seconds=self.current_user.limits().duration)
+        if session_end_time > latest:
+            raise SessionLimitReached
+        if session_end_time <= now:
+            raise UnprocessableEntity("Sessions can only be moved to end later")
+
+        try:
+            publish_session_end(self.box.job_id, session_end_time)
+        except (ConsulException, RequestException):
+            raise BoxError("Failed to extend box")
+
+        self.box.session_end_time = session_end_time
+        db.session.add(self.box)
+        db.session.flush()
+        publish_box_event(self.box)
+
+        return self.box
+
+
+class BoxHibernationService:
+    """Stops a box and brings it back without opening it from scratch.
+
+    Hibernating keeps the job as Nomad ran it and the node it ran on, and
+    stops the job.  The box's home directory is a Docker volume that stays
+    on that node, see home_volume, and the node already has the image, so
+    resuming submits the saved job constrained to that node: nothing is
+    rendered, nothing is pulled and the user's files are still there.  A
+    box is never resumed anywhere else, where it would come back with an
+    empty home, so resuming fails with ClusterFull while its node is full
+    or away.  A hibernated box keeps its config and has no session until it
+    resumes.
+    """
+
+    def __init__(self, current_user: User, box: Box):
+        self.current_user = current_user
+        self.box = box
+        self.timer = PhaseTimer(box_resume_phase_seconds, plan=current_user.plan.name)
+        self.nomad_client = nomad_client()
+
+    def hibernate(self) -> Box:
+        if self.box.state != Box.RUNNING:
+            raise BoxNotRunning("Only running boxes can be hibernated")
+
+        job_id = self.box.job_id
+        try:
+            job = self.nomad_client.job.get_job(job_id)
+            allocations = self.nomad_client.job.get_allocations(job_id)
+            self.nomad_client.job.deregister_job(job_id, purge=False)
+            # A session extended before hibernating must not carry over
+            release_session_end(job_id)
+        except (
+            nomad.api.exceptions.BaseNomadException,
+            ConsulException,
+            RequestException,
+        ):
+            raise BoxError("Failed to hibernate box")
+
+        self.box.job_spec = job
+        self.box.node_id = next(
+            (a["NodeID"] for a in allocations if a["ClientStatus"] == "running"), None
         )
-        self.nomad_client.jobs.request(
-            data=new_job, method="post", headers={"Content-Type": "application/json"}
+        self.box.state = Box.HIBERNATED
+        self.box.ssh_port = None
+        self.box.ip_address = None
+        self.box.session_end_time = None
+
+        db.session.add(self.box)
+        db.session.flush()
+        publish_box_event(self.box)
+
+        return self.box
+
+    def resume(self) -> Box:
+        self.claim()
+        job = self.resume_job()
+
+        submitted = False
+        try:
+            with self.timer.phase("admission"):
+                self.check_capacity(job)
+            with self.timer.phase("submit"):
+                eval_id = submit_box_job(self.nomad_client, {"Job": job})
+                submitted = True
+            ssh_port, ip_address = wait_for_box(
+                self.nomad_client, self.box.job_id, eval_id, self.timer
+            )
+        except (BoxError, nomad.api.exceptions.BaseNomadException) as e:
+            error = e if isinstance(e, BoxError) else BoxError("Failed to resume box")
+            self.timer.record(Q.connection, outcome=failure_outcome(error))
+            # Leave the job stopped, as it was, so the box can be resumed again
+            if submitted:
+                self.stop()
+            self.unclaim()
+            if isinstance(error, (BoxPlacementFailed, NomadUnavailable)):
+                raise error
+            raise BoxError("Failed to resume box", code=error.code, meta=error.meta)
+
+        self.box.ssh_port = ssh_port
+        self.box.ip_address = ip_address
+        self.box.state = Box.RUNNING
+        self.box.job_spec = None
+        self.box.node_id = None
+        self.box.claimed_at = None
+        self.box.session_end_time = datetime.utcnow() + timedelta(
+            seconds=self.current_user.limits().duration
         )
-        return "box-client-box-" + str(self.config.id)
 
-    def get_box_details(self, job_id: str) -> Tuple[str, str]:
-        """Get details of ssh container"""
-        # FIXME: nasty blocking loops should be asynced or something
-        # Add error handling to this
-        status = None
-        trys = 0
-        while status != "running":
-            trys += 1
-            status = self.nomad_client.job[job_id]["Status"]
-            if trys > 1000:
-                raise BoxError(detail="The box failed to start.")
-
-        job_info = self.nomad_client.job.get_allocations(job_id)
-
-        allocation_info = self.nomad_client.allocation.get_allocation(
-            dig(job_info, "0/ID")
+        with self.timer.phase("flush"):
+            db.session.add(self.box)
+            db.session.flush()
+
+        self.timer.record(Q.connection)
+        publish_box_event(self.box)
+
+        return self.box
+
+    def claim(self) -> None:
+        """Move the box from hibernated to pending in one conditional UPDATE.
+
+        The claim is committed before Nomad is called, so a repeated or
+        concurrent resume finds the box pending and is turned away without
+        submitting the job a second time.  check_all_boxes puts back claims
+        left behind by a resume that never finished.
+        """
+        claimed = Box.query.filter_by(id=self.box.id, state=Box.HIBERNATED).update(
+            {Box.state: Box.PENDING, Box.claimed_at: datetime.utcnow()},
+            synchronize_session=False,
         )
+        if not claimed:
+            raise BoxNotHibernated("Only hibernated boxes can be resumed")
+
+        db.session.refresh(self.box)
+        publish_box_event(self.box)
+        db.session.commit()
 
-        allocation_node = values(allocation_info, "NodeID")
-        nodes = self.nomad_client.nodes.get_nodes()
+    def unclaim(self) -> None:
+        """Put a box that could not be resumed back to sleep"""
+        self.box.state = Box.HIBERNATED
+        self.box.claimed_at = None
+        db.session.add(self.box)
+        publish_box_event(self.box)
+        db.session.commit()
 
-        ip_address = next(x["Address"] for x in nodes if x["ID"] in allocation_node)
-        allocated_ports = values(allocation_info, "Resources/Networks/0/DynamicPorts/*")
-        ssh_port = next(x for x in allocated_ports if x["Label"] == "ssh")["Value"]
-        if current_app.config["ENV"] == "development":
-            ip_address = current_app.config["SEA_HOST"]
+    def resume_job(self) -> Dict:
+        """The saved job, unstopped and pinned to the node holding its home
+        volume"""
+        job = dict(self.box.job_spec, Stop=False)
+        if self.box.node_id:
+            # A job saved after an earlier resume is still pinned
+            constraints = [
+                constraint
+                for constraint in job.get("Constraints") or []
+                if constraint["LTarget"] != "${node.unique.id}"
+            ]
+            job["Constraints"] = constraints + [
+                {
+                    "LTarget": "${node.unique.id}",
+                    "RTarget": self.box.node_id,
+                    "Operand": "=",
+                }
+            ]
+        return job
 
-        return (ssh_port, ip_address)
+    def check_capacity(self, job: Dict) -> None:
+        resources = job["TaskGroups"][0]["Tasks"][0]["Resources"]
+        limits = self.current_user.limits()._replace(
+            cpu=resources["CPU"], memory=resources["MemoryMB"]
+        )
+        if not ClusterCapacity(Q.connection).fits(limits, job):
+            raise ClusterFull(
+                "The node holding this box's files has no room for it right now",
+                retry_after=current_app.config["CAPACITY_REFRESH_INTERVAL"],
+            )
+
+    def stop(self) -> None:
+        try:
+            self.nomad_client.job.deregister_job(self.box.job_id, purge=False)
+        except (nomad.api.exceptions.BaseNomadException, BoxError):
+            pass
 
 
 class BoxDeletionService:
@@ -149,10 +596,86 @@ class BoxDeletionService:
             self.config = box.config
             self.job_id = box.job_id
 
-        self.nomad_client = nomad.Nomad(discover_service("nomad").ip)
+        self.nomad_client = nomad_client()
 
     def delete(self):
+        if self.box.state == Box.PENDING:
+            self.leave_admission_queue()
+
+        publish_box_event(self.box, GONE)
         db.session.delete(self.box)
-        db.session.delete(self.config)
+        shared = Box.query.filter(
+            Box.config_id == self.config.id, Box.id != self.box.id
+        ).count()
+        if not shared:
+            db.session.delete(self.config)
         db.session.flush()
-        cleanup_old_nomad_box.queue(self.job_id, timeout=60000)
+        # A failed box's job was cleaned up when it failed, and its job_id may
+        # now belong to a newer box on the same config
+        if self.box.state != Box.FAILED:
+            node_ids = [self.box.node_id] if self.box.node_id else []
+            cleanup_old_nomad_box.queue(self.job_id, node_ids, timeout=60000)
+
+    def leave_admission_queue(self) -> None:
+        box_id = self.box.id
+        admission = AdmissionQueue.from_config(Q.connection)
+
+        after_commit(lambda: admission.cancel(box_id))
+
+
+class BoxTeardownService:
+    """Deletes many boxes, and their configs, in a handful of statements.
+
+    Used when a whole account goes or an admin sweeps boxes away.  The rows
+    are removed with one DELETE per table and the Nomad jobs are handed to a
+    single cleanup_old_nomad_boxes job that deregisters them concurrently.
+    """
+
+    def __init__(self, boxes: Query):
+        self.boxes = boxes
+
+    @classmethod
+    def for_user(cls, user: User) -> "BoxTeardownService":
+        return cls(Box.query.join(Box.config).filter(Config.user_id == user.id))
+
+    def delete(self, expiring: bool = False) -> List[int]:
+        """Delete the boxes, returning their ids.
+
+        Set `expiring` when the boxes are going because their session ended,
+        so clients polling for events are told before they disappear.
+        """
+        boxes = self.boxes.all()
+        if not boxes:
+            return []
+
+        for box in boxes:
+            if expiring:
+                publish_box_event(box, EXPIRING)
+            publish_box_event(box, GONE)
+
+        # A failed box's job was cleaned up when it failed, and its job_id may
+        # now belong to a newer box on the same config
+        job_ids = [
+            box.job_id for box in boxes if box.job_id and box.state != Box.FAILED
+        ]
+        # Where hibernated boxes left their home volumes
+        nodes = {box.job_id: box.node_id for box in boxes if box.node_id}
+        box_ids = [box.id for box in boxes]
+        config_ids = {box.config_id for box in boxes}
+        # Configs still carrying a box that is not going stay
+        shared = db.session.query(Box.config_id).filter(
+            Box.config_id.in_(config_ids), ~Box.id.in_(box_ids)
+        )
+        config_ids -= {config_id for config_id, in shared}
+
+        Box.query.filter(Box.id.in_(box_ids)).delete(synchronize_session="fetch")
+        if config_ids:
+            Config.query.filter(Config.id.in_(config_ids)).delete(
+                synchronize_session="fetch"
+            )
+        db.session.flush()
+
+        if job_ids:
+            cleanup_old_nomad_boxes.queue(job_ids, nodes, timeout=60000)
+
+        return box_ids
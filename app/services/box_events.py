@@ -0,0 +1,158 @@
+import json
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from redis.exceptions import ConnectionError as RedisConnectionError, WatchError
+
+from app import Q
+from app.models import Box
+from app.utils.session import after_commit
+
+CHANNEL = "userland:box-events"
+
+EXPIRING = "expiring"
+GONE = "gone"
+
+
+def box_event(box: Box, state: Optional[str] = None) -> Dict:
+    return {
+        "id": str(box.id),
+        "state": state or box.state,
+        "sshPort": box.ssh_port,
+        "ipAddress": box.ip_address,
+    }
+
+
+def publish_box_event(box: Box, state: Optional[str] = None) -> None:
+    """Announce a box state change once the current transaction commits.
+
+    A change that is rolled back is never announced.
+    """
+    user = str(box.config.user.uuid)
+    event = box_event(box, state)
+    after_commit(lambda: BoxEventLog(Q.connection).append(user, event))
+
+
+class BoxEventLog:
+    """The last `length` box events of each user, numbered in order.
+
+    A poll names the number of the last event it has seen and gets the ones
+    after it.  Each event is also published on CHANNEL, which only wakes
+    the polls waiting on that user; the log is what they read.
+    """
+
+    PREFIX = "userland:box-events"
+
+    def __init__(self, redis, length: int = 100, ttl: int = 86400):
+        self.redis = redis
+        self.length = length
+        self.ttl = ttl
+
+    def key(self, user: str, *parts: str) -> str:
+        return ":".join((self.PREFIX, user) + parts)
+
+    def append(self, user: str, event: Dict) -> int:
+        log, sequence = self.key(user), self.key(user, "sequence")
+        with self.redis.pipeline() as pipe:
+            # The number and the entry are written together, so a poll never
+            # sees a later event before an earlier one
+            while True:
+                try:
+                    pipe.watch(sequence)
+                    number = int(pipe.get(sequence) or 0) + 1
+                    pipe.multi()
+                    pipe.set(sequence, number, ex=self.ttl)
+                    pipe.zadd(log, {json.dumps([number, event]): number})
+                    pipe.zremrangebyrank(log, 0, -self.length - 1)
+                    pipe.expire(log, self.ttl)
+                    pipe.execute()
+                    break
+                except WatchError:
+                    continue
+
+        self.redis.publish(CHANNEL, json.dumps({"user": user, "box": event}))
+        return number
+
+    def latest(self, user: str) -> int:
+        return int(self.redis.get(self.key(user, "sequence")) or 0)
+
+    def since(self, user: str, number: int) -> Optional[Tuple[List[Dict], int]]:
+        """Events after `number` and the number of the last, or None when
+        some of them are no longer kept"""
+        pipe = self.redis.pipeline()
+        pipe.get(self.key(user, "sequence"))
+        pipe.zrange(self.key(user), 0, 0, withscores=True)
+        pipe.zrangebyscore(self.key(user), number + 1, "+inf")
+        latest, oldest, entries = pipe.execute()
+
+        latest = int(latest or 0)
+        first = int(oldest[0][1]) if oldest else latest + 1
+        if number > latest or number + 1 < first:
+            return None
+        return [json.loads(entry)[1] for entry in entries], latest
+
+
+class BoxEventHub:
+    """Wakes the polls waiting in this process when their user's boxes change.
+
+    Every process holds a single Redis subscription to CHANNEL, however many
+    clients are waiting, and hands each event to the queues of the polls
+    waiting on that box's owner.  A waiting poll costs a queue and nothing
+    else; there is no per-connection polling of Redis or the database.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners: Dict[str, Set[queue.Queue]] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def subscribe(self, redis, user: str) -> queue.Queue:
+        listener: queue.Queue = queue.Queue()
+        with self._lock:
+            self._ensure_listening(redis)
+            self._listeners.setdefault(user, set()).add(listener)
+        return listener
+
+    def unsubscribe(self, user: str, listener: queue.Queue) -> None:
+        with self._lock:
+            listeners = self._listeners.get(user, set())
+            listeners.discard(listener)
+            if not listeners:
+                self._listeners.pop(user, None)
+
+    def dispatch(self, message: bytes) -> None:
+        data = json.loads(message)
+        with self._lock:
+            listeners = list(self._listeners.get(data["user"], ()))
+        for listener in listeners:
+            listener.put(data["box"])
+
+    def _ensure_listening(self, redis) -> None:
+        # The subscriber thread does not survive a fork
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._listeners = {}
+            self._thread = None
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._listen, args=(redis,), daemon=True
+            )
+            self._thread.start()
+
+    def _listen(self, redis) -> None:
+        while True:
+            try:
+                pubsub = redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                for message in pubsub.listen():
+                    self.dispatch(message["data"])
+            except RedisConnectionError:
+                time.sleep(1)
+
+
+hub = BoxEventHub()
@@ -0,0 +1,207 @@
+import json
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from dpath.util import values
+from flask import current_app, render_template
+
+from app import Q
+from app.models import UserLimit
+from app.utils.allocation import AllocationWaiter
+from app.utils.metrics import PhaseTimer
+from app.utils.node_index import NodeIndex
+
+BOX_JOB_PREFIX = "box-client-"
+
+VOLUME_JOB_PREFIX = "userland-volume-rm-"
+
+# Runs `docker volume rm` against a node's Docker daemon
+DOCKER_CLI_IMAGE = "docker:19.03"
+
+
+def render_box_job(box_name: str, ssh_key: str, image: str, limits: UserLimit) -> Dict:
+    return BoxJobBuilder.for_image(image, limits).build(box_name, ssh_key)
+
+
+def render_box_template(
+    box_name: str, ssh_key: str, image: str, limits: UserLimit
+) -> Dict:
+    """Render box.j2.json with Jinja and parse it"""
+    return json.loads(
+        render_template(
+            "box.j2.json",
+            ssh_key=strip_ssh_key(ssh_key),
+            box_name=box_name,
+            bandwidth=str(limits.bandwidth),
+            duration=limits.duration,
+            image=image,
+            memory=limits.memory,
+            cpu=limits.cpu,
+        )
+    )
+
+
+def strip_ssh_key(ssh_key: str) -> str:
+    return "".join(i for i in ssh_key if 31 < ord(i) < 127)
+
+
+class BoxJobBuilder:
+    """Builds box jobs from a template rendered once per image and plan.
+
+    Only the fields that differ between boxes of the same image and plan are
+    filled in per box.  Everything off that path is shared with the cached
+    base job, so callers must not mutate anything deeper than the task.
+    """
+
+    def __init__(self, image: str, limits: UserLimit):
+        self.base = render_box_template("box-template", "", image, limits)["Job"]
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def for_image(image: str, limits: UserLimit) -> "BoxJobBuilder":
+        return BoxJobBuilder(image, limits)
+
+    def build(self, box_name: str, ssh_key: str) -> Dict:
+        job = dict(self.base)
+        job["ID"] = job["Name"] = BOX_JOB_PREFIX + box_name
+
+        group = dict(job["TaskGroups"][0])
+        job["TaskGroups"] = [group]
+
+        task = dict(group["Tasks"][0])
+        group["Tasks"] = [task]
+        task["Config"] = dict(
+            task["Config"],
+            labels=[{"io.userland.box": box_name}],
+            volumes=[home_volume(box_name)],
+        )
+        task["Env"] = dict(task["Env"], SSH_KEY=strip_ssh_key(ssh_key))
+        task["Templates"] = [session_end_template(job["ID"])]
+
+        service = dict(task["Services"][0], Name="ssh-" + box_name)
+        service["Checks"] = [
+            dict(service["Checks"][0], Label="ssh-" + box_name + "-up")
+        ]
+        task["Services"] = [service]
+
+        return {"Job": job}
+
+
+def home_volume(box_name: str) -> str:
+    """The Docker volume holding a box's home directory.  It outlives the
+    container, so a hibernated box resumed on the same node keeps its files.
+    It is removed once the box's job is deregistered, see
+    home_volume_cleanup_job."""
+    return f"{home_volume_name(box_name)}:/home/userland"
+
+
+def home_volume_name(box_name: str) -> str:
+    return f"userland-{box_name}"
+
+
+def home_volume_cleanup_job(job_id: str, node_id: str) -> Dict:
+    """A batch job that removes a box job's home volume from one node.
+
+    Docker volumes are local to their node and Nomad cannot remove them, so
+    the job is pinned to the node and runs the Docker CLI against its
+    socket.  The restarts cover Docker still removing the box's container.
+    """
+    box_name = job_id[len(BOX_JOB_PREFIX) :]
+    cleanup_id = f"{VOLUME_JOB_PREFIX}{box_name}-{node_id[:8]}"
+    return {
+        "Job": {
+            "ID": cleanup_id,
+            "Name": cleanup_id,
+            "Type": "batch",
+            # Same placement as box jobs in box.j2.json, on the box's node
+            "Datacenters": ["city"],
+            "Constraints": [
+                {"LTarget": "${meta.app}", "RTarget": "userland", "Operand": "="},
+                {"LTarget": "${node.unique.id}", "RTarget": node_id, "Operand": "="},
+            ],
+            "TaskGroups": [
+                {
+                    "Name": "volume",
+                    "Count": 1,
+                    "RestartPolicy": {
+                        "Attempts": 3,
+                        "Delay": 15000000000,
+                        "Interval": 1800000000000,
+                        "Mode": "fail",
+                    },
+                    "ReschedulePolicy": {"Attempts": 0, "Unlimited": False},
+                    "Tasks": [
+                        {
+                            "Name": "rm",
+                            "Driver": "docker",
+                            "Config": {
+                                "image": DOCKER_CLI_IMAGE,
+                                "command": "docker",
+                                "args": ["volume", "rm", home_volume_name(box_name)],
+                                "volumes": [
+                                    "/var/run/docker.sock:/var/run/docker.sock"
+                                ],
+                            },
+                            "Resources": {"CPU": 20, "MemoryMB": 16},
+                        }
+                    ],
+                }
+            ],
+        }
+    }
+
+
+def session_end_path(job_id: str) -> str:
+    return f"userland/boxes/{job_id}/session_end"
+
+
+def session_end_template(job_id: str) -> Dict:
+    """Renders the box's session end, once it has been extended, into the
+    task without restarting it.  The countdown in the box images prefers it
+    to the end worked out from TIME_LIMIT at start."""
+    return {
+        "DestPath": "local/session_end",
+        "EmbeddedTmpl": '{{ keyOrDefault "%s" "" }}' % session_end_path(job_id),
+        "ChangeMode": "noop",
+        "Splay": 0,
+        "Perms": "0644",
+    }
+
+
+def submit_box_job(nomad_client, job: Dict) -> Optional[str]:
+    """Register a box job and return the evaluation Nomad created for it"""
+    response = nomad_client.jobs.request(json=job, method="post")
+    return response.json().get("EvalID")
+
+
+def wait_for_box(
+    nomad_client,
+    job_id: str,
+    eval_id: Optional[str],
+    timer: Optional[PhaseTimer] = None,
+) -> Tuple[str, str]:
+    """Wait for a box job to run and return the address its ssh port is on"""
+    timer = timer or PhaseTimer()
+
+    with timer.phase("running"):
+        allocation = AllocationWaiter(
+            nomad_client,
+            job_id,
+            deadline=current_app.config["BOX_START_TIMEOUT"],
+            eval_id=eval_id,
+        ).wait()
+
+    with timer.phase("allocation"):
+        allocation_info = nomad_client.allocation.get_allocation(allocation["ID"])
+
+    with timer.phase("node"):
+        ip_address = NodeIndex(Q.connection, nomad_client).address(
+            allocation_info["NodeID"]
+        )
+
+    allocated_ports = values(allocation_info, "Resources/Networks/0/DynamicPorts/*")
+    ssh_port = next(x for x in allocated_ports if x["Label"] == "ssh")["Value"]
+    if current_app.config["ENV"] == "development":
+        ip_address = current_app.config["SEA_HOST"]
+
+    return (ssh_port, ip_address)
@@ -11,7 +11,8 @@ class ConfigCreationService:
         self.config_name = config_name
 
     def create(self):
-        config_exist = (
+        # Configs opened without a name all share the empty name
+        config_exist = self.config_name and (
             db.session.query(Config.name).filter_by(name=self.config_name).scalar()
         )
 
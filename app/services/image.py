@@ -0,0 +1,75 @@
+from typing import Dict, List
+
+from app.models import Image, UserLimit
+from app.utils.errors import ImageNotAvailable
+from app.utils.nomad_pool import nomad_client
+
+PREPULL_JOB_ID = "image-prepull"
+
+
+def catalog_tag(name: str) -> str:
+    """Docker tag of an enabled catalog image"""
+    image = Image.query.filter_by(name=name, enabled=True).first()
+    if image is None:
+        raise ImageNotAvailable(f"Image {name} is not available")
+    return image.tag
+
+
+def box_limits(tag: str, plan_limits: UserLimit) -> UserLimit:
+    """Resources for a box of `tag` on a plan with `plan_limits`"""
+    image = Image.query.filter_by(tag=tag).first()
+    if image is None:
+        return plan_limits
+    return image.limits(plan_limits)
+
+
+class ImagePrePullService:
+    """Keeps every enabled catalog image pulled on every client node.
+
+    Without this the first box on a node pays for a full image pull.  The
+    pre-pull job is a Nomad system job with one tiny task per image, so Nomad
+    places it on every node, including nodes that join later.  The tasks
+    sleep rather than exit: a system job would restart finished tasks, and a
+    running container also keeps Docker's image GC from removing the image.
+    """
+
+    def __init__(self):
+        self.nomad_client = nomad_client()
+
+    def sync(self) -> None:
+        images = Image.query.filter_by(enabled=True).order_by(Image.name).all()
+        if images:
+            self.nomad_client.jobs.register_job(prepull_job(images))
+        else:
+            self.nomad_client.job.deregister_job(PREPULL_JOB_ID)
+
+
+def prepull_job(images: List[Image]) -> Dict:
+    return {
+        "Job": {
+            "ID": PREPULL_JOB_ID,
+            "Name": PREPULL_JOB_ID,
+            "Type": "system",
+            # Same placement as box jobs in box.j2.json
+            "Datacenters": ["city"],
+            "Constraints": [
+                {"LTarget": "${meta.app}", "RTarget": "userland", "Operand": "="}
+            ],
+            "TaskGroups": [
+                {
+                    "Name": "images",
+                    "Count": 1,
+                    "Tasks": [prepull_task(image) for image in images],
+                }
+            ],
+        }
+    }
+
+
+def prepull_task(image: Image) -> Dict:
+    return {
+        "Name": image.name,
+        "Driver": "docker",
+        "Config": {"image": image.tag, "entrypoint": ["sleep"], "args": ["2147483647"]},
+        "Resources": {"CPU": 20, "MemoryMB": 16},
+    }
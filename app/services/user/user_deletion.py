@@ -1,8 +1,8 @@
 from app import db
 import app.services.authentication as authentication
 from app.utils.errors import AccessDenied
-from app.services.box import BoxDeletionService
-from app.models import Box
+from app.services.box import BoxTeardownService
+from app.models import Config
 
 
 class UserDeletion:
@@ -19,9 +19,8 @@ class UserDeletion:
         if not self.user.check_password(self.password):
             raise AccessDenied("Wrong password")
 
-        boxes = Box.query.filter_by(user=self.user)
-        for box in boxes:
-            BoxDeletionService(self.user, box).delete()
+        BoxTeardownService.for_user(self.user).delete()
+        Config.query.filter_by(user_id=self.user.id).delete(synchronize_session="fetch")
 
         entries_deleted = db.session.delete(self.user)
         db.session.flush()
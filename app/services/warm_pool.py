@@ -0,0 +1,186 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+import consul
+import nomad
+from flask import current_app
+
+from app import db
+from app.jobs.nomad_cleanup import cleanup_old_nomad_box
+from app.jobs.warm_pool import refill_warm_pool
+from app.models import Plan, WarmBox
+from app.services.box_job import (
+    render_box_job,
+    session_end_path,
+    strip_ssh_key,
+    submit_box_job,
+    wait_for_box,
+)
+from app.services.image import box_limits
+from app.utils.allocation import AllocationWaiter, task_restarts
+from app.utils.errors import BoxError
+from app.utils.nomad_pool import nomad_client
+from app.utils.session import after_commit
+
+WARM_JOB_PREFIX = "box-client-warm-"
+
+
+class WarmPoolService:
+    """Keeps WARM_POOL_SIZES idle boxes running for each image and plan"""
+
+    def __init__(self):
+        self.nomad_client = nomad_client()
+
+    def refill(self) -> None:
+        for image, plans in current_app.config["WARM_POOL_SIZES"].items():
+            for plan_name, size in plans.items():
+                plan = Plan.query.filter_by(name=plan_name).first()
+                if plan:
+                    self.fill(image, plan, size)
+
+    def fill(self, image: str, plan: Plan, size: int) -> None:
+        self.discard_stalled(image, plan)
+
+        pooled = WarmBox.query.filter_by(image=image, plan=plan).count()
+        warm_boxes = [self.reserve(image, plan) for _ in range(size - pooled)]
+
+        # Commit the placeholders before starting anything so an overlapping
+        # refill counts them and does not start the same boxes again
+        db.session.commit()
+
+        for warm_box in warm_boxes:
+            self.start(warm_box)
+
+    def reserve(self, image: str, plan: Plan) -> WarmBox:
+        warm_box = WarmBox(
+            job_id=WARM_JOB_PREFIX + uuid.uuid4().hex[:12], image=image, plan=plan
+        )
+        db.session.add(warm_box)
+        return warm_box
+
+    def start(self, warm_box: WarmBox) -> None:
+        try:
+            eval_id = submit_box_job(self.nomad_client, warm_box_job(warm_box))
+            warm_box.ssh_port, warm_box.ip_address = wait_for_box(
+                self.nomad_client, warm_box.job_id, eval_id
+            )
+            warm_box.ready = True
+        except (BoxError, nomad.api.exceptions.BaseNomadException):
+            cleanup_old_nomad_box.queue(warm_box.job_id, timeout=60000)
+            db.session.delete(warm_box)
+
+        db.session.commit()
+
+    def discard_stalled(self, image: str, plan: Plan) -> None:
+        """Drop placeholders left behind by a refill that never finished"""
+        cutoff = datetime.utcnow() - timedelta(
+            seconds=2 * current_app.config["BOX_START_TIMEOUT"]
+        )
+        stalled = WarmBox.query.filter(
+            WarmBox.image == image,
+            WarmBox.plan == plan,
+            WarmBox.ready.is_(False),
+            WarmBox.created_at < cutoff,
+        )
+        for warm_box in stalled:
+            cleanup_old_nomad_box.queue(warm_box.job_id, timeout=60000)
+            db.session.delete(warm_box)
+
+
+def warm_box_job(warm_box: WarmBox) -> Dict:
+    """Box job whose authorized key is read from Consul once it is claimed.
+
+    The task restarts when the key is written, which re-runs the image's
+    entrypoint with the key and a fresh session clock, without any
+    rescheduling or image pull.
+    """
+    job = render_box_job(
+        warm_box.job_id[len("box-client-") :],
+        "",
+        warm_box.image,
+        box_limits(warm_box.image, warm_box.plan.limits()),
+    )
+    task = job["Job"]["TaskGroups"][0]["Tasks"][0]
+    task["Templates"] = task["Templates"] + [
+        {
+            "DestPath": "secrets/authorized_keys",
+            "EmbeddedTmpl": '{{ keyOrDefault "%s" "" }}'
+            % ssh_key_path(warm_box.job_id),
+            "ChangeMode": "restart",
+            "Splay": 0,
+            "Perms": "0644",
+        }
+    ]
+    return job
+
+
+def claim_warm_box(image: str, plan: Plan) -> Optional[WarmBox]:
+    """Take a running box out of the pool, or None when the pool is empty"""
+    if image not in current_app.config["WARM_POOL_SIZES"]:
+        return None
+
+    warm_box = (
+        WarmBox.query.filter_by(image=image, plan=plan, ready=True)
+        .order_by(WarmBox.created_at)
+        .with_for_update(skip_locked=True, of=WarmBox)
+        .first()
+    )
+    if warm_box is None:
+        return None
+
+    db.session.delete(warm_box)
+    db.session.flush()
+
+    after_commit(lambda: refill_warm_pool.queue(timeout=60000))
+
+    return warm_box
+
+
+def hand_over(nomad_client, job_id: str, ssh_key: str) -> None:
+    """Give a claimed warm box the user's key and wait until it is in place.
+
+    The key reaches the box through a restart of its task, so the box is
+    only handed back once that restart has finished and sshd is running
+    with the key.
+    """
+    running = [
+        allocation
+        for allocation in nomad_client.job.get_allocations(job_id)
+        if allocation["ClientStatus"] == "running"
+    ]
+    restarts = max((task_restarts(a) for a in running), default=0)
+
+    inject_ssh_key(job_id, ssh_key)
+
+    AllocationWaiter(
+        nomad_client,
+        job_id,
+        deadline=current_app.config["BOX_START_TIMEOUT"],
+        restarts=restarts,
+    ).wait()
+
+
+def ssh_key_path(job_id: str) -> str:
+    return f"userland/warm/{job_id}/ssh_key"
+
+
+def consul_client() -> consul.Consul:
+    return consul.Consul(host=current_app.config["CONSUL_HOST"])
+
+
+def inject_ssh_key(job_id: str, ssh_key: str) -> None:
+    consul_client().kv.put(ssh_key_path(job_id), strip_ssh_key(ssh_key))
+
+
+def release_ssh_key(job_id: str) -> None:
+    consul_client().kv.delete(ssh_key_path(job_id))
+
+
+def publish_session_end(job_id: str, session_end_time: datetime) -> None:
+    timestamp = int(session_end_time.replace(tzinfo=timezone.utc).timestamp())
+    consul_client().kv.put(session_end_path(job_id), str(timestamp))
+
+
+def release_session_end(job_id: str) -> None:
+    consul_client().kv.delete(session_end_path(job_id))
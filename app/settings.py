@@ -1,3 +1,4 @@
+import json
 import os
 
 
@@ -8,6 +9,51 @@ class Config(object):
 
     JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY")
     CONSUL_HOST = os.environ.get("CONSUL_HOST")
+    BOX_START_TIMEOUT = int(os.environ.get("BOX_START_TIMEOUT", 120))
+    NOMAD_DISCOVERY_TTL = int(os.environ.get("NOMAD_DISCOVERY_TTL", 60))
+    # Service discovery answers are kept for at least DISCOVERY_MIN_TTL
+    # seconds, and served for up to DISCOVERY_MAX_STALE seconds past their
+    # TTL while they are refreshed in the background
+    DISCOVERY_MIN_TTL = int(os.environ.get("DISCOVERY_MIN_TTL", 5))
+    DISCOVERY_MAX_STALE = int(os.environ.get("DISCOVERY_MAX_STALE", 300))
+    # Services each worker looks up in parallel before taking requests, and
+    # how long it waits for them
+    DISCOVERY_WARMUP = json.loads(os.environ.get("DISCOVERY_WARMUP", '["nomad"]'))
+    DISCOVERY_WARMUP_TIMEOUT = float(os.environ.get("DISCOVERY_WARMUP_TIMEOUT", 2))
+    NOMAD_POOL_SIZE = int(os.environ.get("NOMAD_POOL_SIZE", 10))
+    BOX_BATCH_CONCURRENCY = int(os.environ.get("BOX_BATCH_CONCURRENCY", 8))
+    NOMAD_CLEANUP_CONCURRENCY = int(os.environ.get("NOMAD_CLEANUP_CONCURRENCY", 8))
+    # Consecutive Nomad failures before calls fail fast, and seconds to wait
+    # before letting a probe through
+    NOMAD_BREAKER_THRESHOLD = int(os.environ.get("NOMAD_BREAKER_THRESHOLD", 5))
+    NOMAD_BREAKER_RESET = int(os.environ.get("NOMAD_BREAKER_RESET", 30))
+    # Seconds a box event poll waits for a change before answering with none.
+    # Each waiting poll holds a web worker, so keep it short.
+    BOX_EVENTS_WAIT = int(os.environ.get("BOX_EVENTS_WAIT", 5))
+    IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 3600))
+    # Seconds between sweeps for boxes whose session has ended, and how many
+    # boxes a sweep tears down per transaction.  The scheduler only looks
+    # for due jobs every RQ_SCHEDULER_INTERVAL seconds, so keep them in step.
+    BOX_EXPIRY_INTERVAL = int(os.environ.get("BOX_EXPIRY_INTERVAL", 5))
+    BOX_EXPIRY_BATCH = int(os.environ.get("BOX_EXPIRY_BATCH", 100))
+    RQ_SCHEDULER_INTERVAL = BOX_EXPIRY_INTERVAL
+    # Seconds between capacity snapshots used to turn boxes away before they
+    # reach Nomad when the cluster is full
+    CAPACITY_REFRESH_INTERVAL = int(os.environ.get("CAPACITY_REFRESH_INTERVAL", 10))
+    # {"<image>": {"<plan name>": <idle boxes>}}
+    WARM_POOL_SIZES = json.loads(os.environ.get("WARM_POOL_SIZES", "{}"))
+    ASYNC_BOX_PROVISIONING = os.environ.get("ASYNC_BOX_PROVISIONING") == "true"
+    # Share of provisioning starts each plan gets while boxes are queued,
+    # {"<plan name>": <weight>}; plans not listed weigh 1
+    ADMISSION_WEIGHTS = json.loads(
+        os.environ.get("ADMISSION_WEIGHTS", '{"paid": 4, "beta": 2, "free": 1}')
+    )
+    # Boxes provisioning at once across the cluster, and for any one user
+    PROVISIONING_CONCURRENCY = int(os.environ.get("PROVISIONING_CONCURRENCY", 8))
+    PROVISIONING_USER_CAP = int(os.environ.get("PROVISIONING_USER_CAP", 1))
+    # Bearer token the Prometheus scraper sends for /metrics, which is not
+    # served at all without one
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
 
 
 class TestConfig(Config):
@@ -25,6 +71,7 @@ class TestConfig(Config):
     MAIL_DEFAULT_SENDER = "noreply@userland.io"
 
     TESTING = True
+    METRICS_TOKEN = "metrics-token"
 
     SQLALCHEMY_DATABASE_URI = (
         f'postgresql://{os.environ.get("DATABASE_URL")}/userland_test'
@@ -0,0 +1,142 @@
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+from app.utils.errors import BoxError, BoxPlacementFailed
+
+
+class AllocationWaiter:
+    """Wait for a job's allocation to reach the running state.
+
+    Rather than hammering the job status endpoint, this uses Nomad blocking
+    queries: each request carries the last ``X-Nomad-Index`` we saw and Nomad
+    holds it open until the allocations change or ``wait`` elapses.  When no
+    allocation has been placed the job's evaluations are checked so that a
+    placement failure is reported straight away instead of at the deadline.
+
+    With `restarts`, an allocation only counts once its tasks have been
+    restarted more often than that and are running again, which is how a
+    warm box is waited on after its key is written.
+    """
+
+    FAILED_STATUSES = ("failed", "lost")
+
+    def __init__(
+        self,
+        nomad_client,
+        job_id: str,
+        deadline: float,
+        eval_id: Optional[str] = None,
+        wait: float = 10,
+        restarts: Optional[int] = None,
+    ):
+        self.nomad_client = nomad_client
+        self.restarts = restarts
+        self.job_id = job_id
+        self.eval_id = eval_id
+        self.deadline = deadline
+        # The requester gives up after its own timeout, so never ask Nomad to
+        # hold a query open for longer than that.
+        self.wait_time = max(1, min(wait, nomad_client.timeout - 1))
+
+    def wait(self) -> Dict:
+        """Block until an allocation is running and return it"""
+        expires = time.monotonic() + self.deadline
+        index = 0
+
+        while True:
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                raise BoxError(
+                    detail="The box failed to start.", code="deadline_exceeded"
+                )
+
+            allocations, index = self._allocations(
+                index, min(remaining, self.wait_time)
+            )
+
+            for allocation in allocations:
+                if self._ready(allocation):
+                    return allocation
+
+            for allocation in allocations:
+                if allocation["ClientStatus"] in self.FAILED_STATUSES:
+                    raise BoxError(
+                        detail="The box failed to start.",
+                        code=f"allocation_{allocation['ClientStatus']}",
+                        meta={"allocation": allocation["ID"]},
+                    )
+
+            if not allocations:
+                self._check_evaluations()
+
+    def _ready(self, allocation: Dict) -> bool:
+        if allocation["ClientStatus"] != "running":
+            return False
+        return self.restarts is None or restarted(allocation, self.restarts)
+
+    def _allocations(self, index: int, wait: float) -> Tuple[List[Dict], int]:
+        response = self.nomad_client.job.request(
+            self.job_id,
+            "allocations",
+            method="get",
+            # Nomad reads a zero wait as its five minute default, so the last
+            # second before the deadline is asked for in milliseconds
+            params={"index": index, "wait": f"{max(1, int(wait * 1000))}ms"},
+        )
+        return response.json(), int(response.headers.get("X-Nomad-Index", index))
+
+    def _check_evaluations(self) -> None:
+        if self.eval_id:
+            evaluations = [self.nomad_client.evaluation.get_evaluation(self.eval_id)]
+        else:
+            evaluations = self.nomad_client.job.get_evaluations(self.job_id)
+
+        for evaluation in evaluations:
+            reason = placement_failure(evaluation)
+            if reason:
+                raise BoxPlacementFailed(
+                    detail=reason, meta={"evaluation": evaluation["ID"]}
+                )
+
+
+def task_restarts(allocation: Dict) -> int:
+    return sum(
+        state.get("Restarts", 0)
+        for state in (allocation.get("TaskStates") or {}).values()
+    )
+
+
+def restarted(allocation: Dict, restarts: int) -> bool:
+    """Whether an allocation's tasks have restarted past `restarts` times and
+    each has started again since its last restart"""
+    states = (allocation.get("TaskStates") or {}).values()
+    return task_restarts(allocation) > restarts and all(
+        state.get("State") == "running"
+        and (state.get("StartedAt") or "") >= (state.get("LastRestart") or "")
+        for state in states
+    )
+
+
+def placement_failure(evaluation: Dict) -> Optional[str]:
+    """Summarise why an evaluation could not place its allocations"""
+    if evaluation.get("Status") in ("failed", "canceled"):
+        return (
+            evaluation.get("StatusDescription") or "evaluation " + evaluation["Status"]
+        )
+
+    failed_groups = evaluation.get("FailedTGAllocs") or {}
+    reasons = []
+    for group, metric in failed_groups.items():
+        causes = list(metric.get("DimensionExhausted") or {}) + list(
+            metric.get("ConstraintFiltered") or {}
+        )
+        reasons.append(
+            "{}: {} nodes evaluated, blocked by {}".format(
+                group,
+                metric.get("NodesEvaluated", 0),
+                ", ".join(causes) or "no eligible nodes",
+            )
+        )
+
+    return "; ".join(reasons) or None
@@ -0,0 +1,109 @@
+import json
+from typing import Dict, List, Optional
+
+from app.models import UserLimit
+
+ACTIVE_ALLOCATIONS = ("pending", "running")
+
+
+class ClusterCapacity:
+    """Free CPU and memory on each client node, grouped by node class.
+
+    Each node keeps its datacenter and meta alongside, so a box is only
+    checked against the nodes its job's placement lets Nomad use.
+
+    The snapshot lives in a single Redis key so every web and job process
+    shares it, and checking a box against it is one GET.  It is rebuilt by
+    the refresh_cluster_capacity job and expires after `max_age` seconds, so
+    a refresher that stops running turns admission off instead of leaving
+    it working from old numbers.  Without a snapshot every box is admitted
+    and Nomad has the final say, as before.
+    """
+
+    KEY = "userland:nomad:capacity"
+
+    def __init__(self, redis, max_age: int = 60):
+        self.redis = redis
+        self.max_age = max_age
+
+    def fits(self, limits: UserLimit, job: Optional[Dict] = None) -> bool:
+        """Whether any one node `job` may be placed on has room for a box
+        with these limits"""
+        snapshot = self.redis.get(self.KEY)
+        if snapshot is None:
+            return True
+
+        job = job or {}
+        return any(
+            node["free"][0] >= limits.cpu and node["free"][1] >= limits.memory
+            for node_class, nodes in json.loads(snapshot).items()
+            for node in nodes
+            if placeable(job, node_class, node)
+        )
+
+    def refresh(self, nomad_client) -> Dict[str, List[Dict]]:
+        """Rebuild the snapshot from the nodes eligible for new boxes"""
+        snapshot: Dict[str, List[Dict]] = {}
+        for stub in nomad_client.nodes.get_nodes():
+            if stub["Status"] != "ready" or stub.get("Drain"):
+                continue
+            if stub.get("SchedulingEligibility", "eligible") != "eligible":
+                continue
+
+            node = nomad_client.node.get_node(stub["ID"])
+            allocations = nomad_client.node.get_allocations(stub["ID"])
+            snapshot.setdefault(node.get("NodeClass") or "", []).append(
+                {
+                    "id": node["ID"],
+                    "free": node_free(node, allocations),
+                    "datacenter": node.get("Datacenter"),
+                    "meta": node.get("Meta") or {},
+                }
+            )
+
+        self.redis.set(self.KEY, json.dumps(snapshot), ex=self.max_age)
+        return snapshot
+
+
+def placeable(job: Dict, node_class: str, node: Dict) -> bool:
+    """Whether a job's datacenters and equality constraints allow the node.
+    Other operands are left to Nomad, so they never rule a node out."""
+    if job.get("Datacenters") and node["datacenter"] not in job["Datacenters"]:
+        return False
+
+    for constraint in job.get("Constraints") or []:
+        if constraint.get("Operand") != "=":
+            continue
+        target = constraint["LTarget"]
+        if target == "${node.class}":
+            value = node_class
+        elif target == "${node.unique.id}":
+            value = node["id"]
+        elif target == "${node.datacenter}":
+            value = node["datacenter"]
+        elif target.startswith("${meta.") and target.endswith("}"):
+            value = node["meta"].get(target[len("${meta.") : -1])
+        else:
+            continue
+        if value != constraint["RTarget"]:
+            return False
+
+    return True
+
+
+def node_free(node: Dict, allocations: List[Dict]) -> List[int]:
+    """[cpu, memory] left on a node once its reservations and live
+    allocations are taken out"""
+    resources = node.get("Resources") or {}
+    reserved = node.get("Reserved") or {}
+    cpu = resources.get("CPU", 0) - reserved.get("CPU", 0)
+    memory = resources.get("MemoryMB", 0) - reserved.get("MemoryMB", 0)
+
+    for allocation in allocations:
+        if allocation["ClientStatus"] not in ACTIVE_ALLOCATIONS:
+            continue
+        used = allocation.get("Resources") or {}
+        cpu -= used.get("CPU", 0)
+        memory -= used.get("MemoryMB", 0)
+
+    return [cpu, memory]
@@ -0,0 +1,60 @@
+import math
+import threading
+import time
+
+
+class CircuitOpen(Exception):
+    """Raised instead of making a call while the breaker is open"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Circuit open, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calling a dependency that keeps failing.
+
+    After `failure_threshold` failures in a row the breaker opens and every
+    call fails straight away with CircuitOpen.  Once `reset_timeout` seconds
+    have passed a single probe call is let through: if it succeeds the
+    breaker closes, if it fails the breaker opens for another
+    `reset_timeout`.  Calls made while the probe is in flight fail fast.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, clock=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock or time.monotonic
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+
+            remaining = self.opened_at + self.reset_timeout - self.clock()
+            if self.state == self.OPEN and remaining <= 0:
+                # This caller is the probe, everyone else keeps failing fast
+                self.state = self.HALF_OPEN
+                return
+
+            raise CircuitOpen(max(1, math.ceil(remaining)))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
@@ -1,12 +1,20 @@
+import dns.exception
 import dns.resolver
 import dns.name
 import dns.rdatatype
 import random
 import os
+import threading
+import time
+from bisect import bisect
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import accumulate
 from flask import current_app
 from functools import lru_cache
+from redis.exceptions import RedisError
 
-from typing import Iterator, NamedTuple, List
+from typing import Dict, NamedTuple, List, Optional, Set, Tuple
 
 
 class Entry(NamedTuple):
@@ -14,6 +22,66 @@ class Entry(NamedTuple):
     port: str
 
 
+class EndpointHealth:
+    """Passive health of the endpoints discovered services point at.
+
+    Callers report how each request to an endpoint went.  An endpoint that
+    fails `failures` times in a row is ejected for `ejection` seconds,
+    doubling each time it is ejected again up to `max_ejection`, and comes
+    back on its first success.  Latency is a moving average of the reported
+    successes, for picking the quicker of two endpoints.
+    """
+
+    def __init__(
+        self, failures: int = 3, ejection: float = 10, max_ejection: float = 300
+    ):
+        self.failures = failures
+        self.ejection = ejection
+        self.max_ejection = max_ejection
+        self._lock = threading.Lock()
+        self._failures: Dict[Entry, int] = {}
+        self._ejections: Dict[Entry, int] = {}
+        self._ejected_until: Dict[Entry, float] = {}
+        self._latency: Dict[Entry, float] = {}
+
+    def report_success(self, entry: Entry, seconds: Optional[float] = None) -> None:
+        with self._lock:
+            self._failures.pop(entry, None)
+            self._ejections.pop(entry, None)
+            self._ejected_until.pop(entry, None)
+            if seconds is not None:
+                average = self._latency.get(entry)
+                self._latency[entry] = (
+                    seconds if average is None else average * 0.7 + seconds * 0.3
+                )
+
+    def report_failure(self, entry: Entry) -> None:
+        with self._lock:
+            failures = self._failures.get(entry, 0) + 1
+            self._failures[entry] = failures
+            if failures < self.failures:
+                return
+
+            ejections = self._ejections.get(entry, 0)
+            self._ejections[entry] = ejections + 1
+            self._failures[entry] = 0
+            backoff = min(self.ejection * 2 ** ejections, self.max_ejection)
+            self._ejected_until[entry] = time.monotonic() + backoff
+
+    def available(self, entry: Entry, now: float) -> bool:
+        return self._ejected_until.get(entry, 0.0) <= now
+
+    def latency(self, entry: Entry) -> float:
+        # Endpoints without a measurement yet count as quick so they get tried
+        return self._latency.get(entry, 0.0)
+
+    def measured(self) -> bool:
+        return bool(self._latency)
+
+
+endpoint_health = EndpointHealth()
+
+
 class BaseService:
     @staticmethod
     @lru_cache()
@@ -33,30 +101,61 @@ class BaseService:
         self.srv: List[Entry] = []
         self.weights: List[int] = []
         self._parse_response()
-        self.response_generator = self._response()
+        # SRV weights may all be 0, which means pick evenly
+        if not any(self.weights):
+            self.weights = [1] * len(self.weights)
+        self._cumulative = list(accumulate(self.weights))
 
     def _parse_response(self) -> None:
         raise NotImplementedError
 
     def _weighted_choice(self) -> Entry:
-        return random.choices(self.srv, self.weights, k=1)[0]
+        """Pick an endpoint by weight, leaving out ejected ones.
 
-    def _response(self) -> Iterator[Entry]:
-        while True:
-            yield self._weighted_choice()
+        Once latencies have been reported, two endpoints are drawn and the
+        quicker one is used, so slow endpoints get less traffic without
+        being starved of it.  If every endpoint is ejected they are all
+        used, as there is nothing better to try.  Cached services are
+        shared between threads, so picking keeps no state of its own.
+        """
+        now = time.monotonic()
+        available = [
+            i for i, e in enumerate(self.srv) if endpoint_health.available(e, now)
+        ]
+        if available and len(available) < len(self.srv):
+            cumulative = list(accumulate(self.weights[i] for i in available))
+            entries = [self.srv[i] for i in available]
+        else:
+            cumulative, entries = self._cumulative, self.srv
+
+        first = self._draw(entries, cumulative)
+        if not endpoint_health.measured():
+            return first
+        second = self._draw(entries, cumulative)
+        return min(first, second, key=endpoint_health.latency)
+
+    @staticmethod
+    def _draw(entries: List[Entry], cumulative: List[int]) -> Entry:
+        total = cumulative[-1]
+        if not total:
+            return random.choice(entries)
+        return entries[bisect(cumulative, random.random() * total, 0, len(entries) - 1)]
+
+    def choose(self) -> Entry:
+        return self._weighted_choice()
 
     @property
     def url(self) -> str:
-        entry = next(self.response_generator)
+        entry = self._weighted_choice()
         return f"{entry.ip}:{entry.port}"
 
     @property
     def ip(self) -> str:
-        return next(self.response_generator).ip
+        return self._weighted_choice().ip
 
     @property
     def port(self) -> str:
-        return next(self.response_generator).port
+        return self._weighted_choice().port
 
     def entries(self):
         return self.srv
@@ -106,13 +205,169 @@ class ServiceExplicit(BaseService):
         self.weights.append(100)
 
 
+HIT = "hit"
+MISS = "miss"
+STALE = "stale"
+ERROR = "error"
+
+
+class CachedService(NamedTuple):
+    service: BaseService
+    expires: float
+
+
+class DiscoveryCache:
+    """Discovered services, kept for as long as their records allow.
+
+    An answer is fresh until the smallest TTL among its records runs out.
+    Consul answers with a TTL of 0 unless it is told otherwise, so TTLs are
+    never taken as shorter than DISCOVERY_MIN_TTL.  Once an answer is stale
+    it is still handed out, for up to DISCOVERY_MAX_STALE seconds, while a
+    single background thread asks again, so callers never wait on a refresh
+    and a DNS hiccup leaves them on the last good answer.  Only a name that
+    has not resolved yet, or has been stale for too long, is looked up on
+    the caller's thread.
+
+    Lookups are counted by whether they were a hit, miss, stale hit or a
+    failed refresh.  The counts are kept in the process and added to the
+    userland_discovery_cache_lookups_total counter whenever Consul is
+    asked, so answering from the cache never touches Redis.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], CachedService] = {}
+        self._refreshing: Set[Tuple[str, str]] = set()
+        self._pid: Optional[int] = None
+        self.counts: Counter = Counter()
+        self._unflushed: Counter = Counter()
+
+    def get(self, service_name: str, query: str) -> BaseService:
+        key = (service_name, query)
+        now = time.monotonic()
+        max_stale = current_app.config["DISCOVERY_MAX_STALE"]
+
+        with self._lock:
+            # Refresh threads do not survive a fork
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._refreshing = set()
+
+            cached = self._entries.get(key)
+            if cached and now < cached.expires:
+                self._count(HIT)
+                return cached.service
+
+            if cached and now < cached.expires + max_stale:
+                self._count(STALE)
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    app = current_app._get_current_object()
+                    threading.Thread(
+                        target=self._refresh, args=(app, key), daemon=True
+                    ).start()
+                return cached.service
+
+            self._count(MISS)
+
+        try:
+            return self._resolve(key)
+        except dns.exception.DNSException:
+            with self._lock:
+                self._count(ERROR)
+            self._flush()
+            raise
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries = {}
+
+    def _resolve(self, key: Tuple[str, str]) -> BaseService:
+        service, ttl = resolve_service(*key)
+        ttl = max(ttl, current_app.config["DISCOVERY_MIN_TTL"])
+        with self._lock:
+            self._entries[key] = CachedService(service, time.monotonic() + ttl)
+        self._flush()
+        return service
+
+    def _refresh(self, app, key: Tuple[str, str]) -> None:
+        with app.app_context():
+            try:
+                self._resolve(key)
+            except dns.exception.DNSException:
+                # Keep serving the stale answer, the next lookup tries again
+                with self._lock:
+                    self._count(ERROR)
+                self._flush()
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+    def _count(self, result: str) -> None:
+        self.counts[result] += 1
+        self._unflushed[result] += 1
+
+    def _flush(self) -> None:
+        from app import Q
+        from app.utils.metrics import discovery_cache_lookups
+
+        with self._lock:
+            counts, self._unflushed = self._unflushed, Counter()
+
+        try:
+            pipe = Q.connection.pipeline(transaction=False)
+            for result, count in counts.items():
+                discovery_cache_lookups.inc(pipe, count, result=result)
+            pipe.execute()
+        except RedisError:
+            with self._lock:
+                self._unflushed.update(counts)
+
+
+discovery_cache = DiscoveryCache()
+
+
+def warm_discovery_cache(app, services: List[str], timeout: float) -> List[str]:
+    """Look every service up at once so the first requests find them cached.
+
+    Lookups run in parallel and are waited on for at most `timeout`
+    seconds, so a slow or failing DNS server cannot hold up a worker
+    starting.  Returns the services that did not resolve in time; their
+    first lookup on a request tries again.
+    """
+    if not services:
+        return []
+
+    def resolve(service_name: str) -> None:
+        with app.app_context():
+            discovery_cache.get(service_name, "SRV")
+
+    executor = ThreadPoolExecutor(max_workers=len(services))
+    futures = {executor.submit(resolve, name): name for name in services}
+    done, _ = wait(futures, timeout=timeout)
+    executor.shutdown(wait=False)
+
+    return [
+        name
+        for future, name in futures.items()
+        if future not in done or future.exception() is not None
+    ]
+
+
 def discover_service(service_name: str, query: str = "SRV") -> BaseService:
-    answer = None
-    if os.getenv("FLASK_ENV") == "production":
-        answer = BaseService.resolver().query(service_name, query)
-        return ServiceSRVRecord(answer.response)
-    elif query == "A":
-        answer = BaseService.resolver().query(service_name, query)
-        return ServiceARecord(answer.response)
+    if os.getenv("FLASK_ENV") == "production" or query == "A":
+        return discovery_cache.get(service_name, query)
     else:
         return ServiceExplicit(service_name)
+
+
+def resolve_service(service_name: str, query: str) -> Tuple[BaseService, int]:
+    """Ask Consul for a service, returning it with the TTL of its records"""
+    answer = BaseService.resolver().query(service_name, query)
+    ttl = min(
+        rrset.ttl for rrset in answer.response.answer + answer.response.additional
+    )
+    if os.getenv("FLASK_ENV") == "production":
+        return ServiceSRVRecord(answer.response), ttl
+    else:
+        return ServiceARecord(answer.response), ttl
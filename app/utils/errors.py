@@ -23,7 +23,7 @@ class JsonApiException(Exception):
         """
 
         self.detail = detail or self.__class__.detail
-        self.code = code
+        self.code = code or getattr(self.__class__, "code", None)
         self.source = source
         self.id = id_
         self.links = links or {}
@@ -67,6 +67,65 @@ class BoxError(JsonApiException):
     status = "500"
 
 
+class BoxPlacementFailed(BoxError):
+    """Raised when Nomad cannot find room in the cluster for a box"""
+
+    title = "Box Placement Failed"
+    status = "503"
+    code = "placement_failed"
+    detail = "No node in the cluster has capacity for this box"
+
+
+class ClusterFull(BoxPlacementFailed):
+    """Raised without calling Nomad when the last capacity snapshot shows no
+    node with room for a box"""
+
+    title = "Cluster Full"
+    code = "cluster_full"
+    detail = "The cluster is full right now, please try again shortly"
+
+    def __init__(self, *args, retry_after=30, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+class NomadUnavailable(BoxError):
+    """Raised without calling Nomad while its circuit breaker is open"""
+
+    title = "Nomad Unavailable"
+    status = "503"
+    code = "nomad_unavailable"
+    detail = "Boxes cannot be started right now, please try again shortly"
+
+    def __init__(self, *args, retry_after=30, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+class IdempotencyKeyReused(JsonApiException):
+    """Raised when an Idempotency-Key is sent again with a different request"""
+
+    title = "Idempotency Key Reused"
+    status = "422"
+    detail = "This Idempotency-Key was already used for a different request"
+
+
+class RequestInProgress(JsonApiException):
+    """Raised when a request with the same Idempotency-Key has not finished"""
+
+    title = "Request In Progress"
+    status = "409"
+    detail = "A request with this Idempotency-Key is still being processed"
+
+
+class ImageNotAvailable(JsonApiException):
+    """Raised when a box is asked for with an image that is not in the catalog"""
+
+    title = "Image Not Available"
+    status = "422"
+    detail = "The requested image is not available"
+
+
 class ConfigError(JsonApiException):
     """Raised when there is an error creating/deleting a config"""
 
@@ -91,6 +150,30 @@ class BoxLimitReached(JsonApiException):
     detail = "Number of boxes is greater than the tier will allow"
 
 
+class SessionLimitReached(JsonApiException):
+    """Raised when a session is extended past what the user's plan allows"""
+
+    title = "Session Limit Reached"
+    status = "403"
+    detail = "Sessions cannot end more than the plan's duration from now"
+
+
+class BoxNotRunning(JsonApiException):
+    """Raised when a box has to be running for a change but is not"""
+
+    title = "Box Not Running"
+    status = "409"
+    detail = "The box is not running"
+
+
+class BoxNotHibernated(JsonApiException):
+    """Raised when a box that is not hibernated is resumed"""
+
+    title = "Box Not Hibernated"
+    status = "409"
+    detail = "The box is not hibernated"
+
+
 class ConfigLimitReached(JsonApiException):
     """Raised when the number of configs reserved is greater than the limit for their tier"""
 
@@ -157,6 +240,18 @@ class ConfigInUse(JsonApiException):
     status = "403"
 
 
+class ConfigLocked(JsonApiException):
+    """Raised when another request is opening a box on the same config"""
+
+    title = "Config Locked"
+    status = "409"
+    detail = "Another request is opening a box on this config, please try again"
+
+    def __init__(self, *args, retry_after=5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
 class AccessDenied(JsonApiException):
     """Throw this error when user does not have access"""
 
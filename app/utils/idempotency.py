@@ -0,0 +1,128 @@
+import hashlib
+import json
+import uuid
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+from typing import Iterable, Iterator, Optional
+
+from flask import current_app, make_response, request
+from flask_jwt_extended import get_jwt_identity
+
+from app import Q
+from app.serializers import ErrorSchema
+from app.utils.errors import ConfigLocked, IdempotencyKeyReused, RequestInProgress
+from app.utils.json import json_api
+from app.utils.locks import acquire_lock, release_lock
+
+IN_FLIGHT = "in_flight"
+REPLAYED_HEADERS = ("Content-Type", "Retry-After")
+# Seconds a client is told to wait before repeating a request that is
+# still running or a config that is still locked
+RETRY_AFTER = 5
+
+
+def idempotent(view):
+    """Replay the first response to requests that repeat an Idempotency-Key.
+
+    The first request with a key claims it in Redis and stores its response
+    for IDEMPOTENCY_TTL seconds.  A repeat of a finished request gets that
+    response back without running the view again.  A repeat that arrives
+    while the first is still running gets a 409 with Retry-After straight
+    away, rather than holding a worker until it finishes.  The claim
+    expires after twice the time a box takes to start, so a worker killed
+    mid-request does not hold the key for the whole TTL.  Server errors are
+    not stored, and a repeat after one takes the key over and runs again.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return view(*args, **kwargs)
+
+        redis = Q.connection
+        store_key = f"userland:idempotency:{get_jwt_identity()}:{key}"
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        ttl = current_app.config["IDEMPOTENCY_TTL"]
+
+        claim = json.dumps({"state": IN_FLIGHT, "fingerprint": fingerprint})
+        in_flight_ttl = current_app.config["BOX_START_TIMEOUT"] * 2
+        if not redis.set(store_key, claim, nx=True, ex=in_flight_ttl):
+            replayed = replay(redis, store_key, fingerprint)
+            if replayed:
+                return replayed
+            # The first request failed and gave the key up, take it over
+            if not redis.set(store_key, claim, nx=True, ex=in_flight_ttl):
+                return in_progress()
+
+        try:
+            response, status = view(*args, **kwargs)
+        except Exception:
+            redis.delete(store_key)
+            raise
+
+        if status >= 500:
+            redis.delete(store_key)
+        else:
+            record = {
+                "state": "done",
+                "fingerprint": fingerprint,
+                "status": status,
+                "body": response.get_data(as_text=True),
+                "headers": {
+                    name: response.headers[name]
+                    for name in REPLAYED_HEADERS
+                    if name in response.headers
+                },
+            }
+            redis.set(store_key, json.dumps(record), ex=ttl)
+
+        return response, status
+
+    return wrapper
+
+
+def replay(redis, store_key: str, fingerprint: str):
+    """The response for a repeated key, or None once the key has been freed"""
+    stored = redis.get(store_key)
+    if stored is None:
+        return None
+
+    record = json.loads(stored)
+    if record["fingerprint"] != fingerprint:
+        return json_api(IdempotencyKeyReused, ErrorSchema), 422
+
+    if record["state"] == IN_FLIGHT:
+        return in_progress()
+
+    response = make_response(record["body"])
+    for name, value in record["headers"].items():
+        response.headers[name] = value
+    response.headers["Idempotent-Replayed"] = "true"
+    return response, record["status"]
+
+
+def in_progress():
+    response = json_api(RequestInProgress, ErrorSchema)
+    response.headers["Retry-After"] = str(RETRY_AFTER)
+    return response, 409
+
+
+@contextmanager
+def config_locks(config_ids: Iterable[Optional[int]]) -> Iterator[None]:
+    """Hold a Redis lock on each existing config while boxes are opened on it.
+
+    Locks are taken in id order so two batches sharing configs cannot
+    deadlock.  Raises ConfigLocked at once if another request holds any of
+    them; a lock left by a crashed worker expires after twice the time a box
+    takes to start.
+    """
+    expire = current_app.config["BOX_START_TIMEOUT"] * 2
+    with ExitStack() as stack:
+        for config_id in sorted({int(i) for i in config_ids if i}):
+            key = f"userland:config-lock:{config_id}"
+            token = uuid.uuid4().hex
+            if not acquire_lock(Q.connection, key, token, expire=expire, wait=0):
+                raise ConfigLocked(retry_after=RETRY_AFTER)
+            stack.callback(release_lock, Q.connection, key, token)
+        yield
@@ -1,19 +1,235 @@
 import json
 import os
+from datetime import timezone
+from functools import lru_cache
 from flask import make_response
 from jsonschema import RefResolver, validate, ValidationError
-from typing import Union, Dict
+from marshmallow import fields, missing
+from marshmallow.utils import is_collection
+from marshmallow_jsonapi import Schema
+from marshmallow_jsonapi.fields import Relationship
+from marshmallow_jsonapi.utils import tpl
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 from dpath.util import get
 from flask import Response
 
 
-def json_api(resource, resource_class, many=False) -> Response:
-    json_obj = resource_class().dump(resource, many=many).data
-    response = make_response(json.dumps(json_obj))
+def json_api(resource, resource_class, many=False, meta=None) -> Response:
+    if isinstance(resource, type) and not many and not meta:
+        # Errors passed as their class carry nothing from the request, so
+        # their document is the same every time
+        body = static_document(resource, resource_class)
+    else:
+        body = json.dumps(document(resource, resource_class, many, meta))
+    response = make_response(body)
     response.headers["Content-Type"] = "application/vnd.api+json"
     return response
 
 
+def document(resource, resource_class, many=False, meta=None) -> Dict:
+    compiled = compile_schema(resource_class)
+    if compiled is None:
+        json_obj = resource_class().dump(resource, many=many).data
+    else:
+        json_obj = compiled.dump(resource, many=many)
+    if meta:
+        json_obj["meta"] = meta
+    return json_obj
+
+
+@lru_cache(maxsize=None)
+def static_document(resource, resource_class) -> str:
+    return json.dumps(document(resource, resource_class))
+
+
+@lru_cache(maxsize=None)
+def compile_schema(resource_class) -> Optional["CompiledSchema"]:
+    """The compiled dumper for a schema, or None if it needs marshmallow"""
+    try:
+        return CompiledSchema(resource_class)
+    except ValueError:
+        return None
+
+
+def dump_processors(schema_class) -> Set[str]:
+    return {
+        name
+        for (tag, _), names in list(schema_class.__processors__.items())
+        if tag in ("pre_dump", "post_dump")
+        for name in names
+    }
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def _text_list(value):
+    if value is None:
+        return None
+    if is_collection(value):
+        return [_text(each) for each in value]
+    return [_text(value)]
+
+
+def _isoformat(value):
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc).isoformat()
+    return value.astimezone(timezone.utc).isoformat()
+
+
+def _boolean(field: fields.Boolean) -> Callable[[Any], Optional[bool]]:
+    def convert(value):
+        if value is None:
+            return None
+        elif value in field.truthy:
+            return True
+        elif value in field.falsy:
+            return False
+        return bool(value)
+
+    return convert
+
+
+class CompiledSchema:
+    """A marshmallow_jsonapi schema flattened into a plain dumper.
+
+    Most of the cost of a list response is marshmallow building a schema
+    and walking its fields for every item.  Here the inflected keys, the
+    resource type and the relationship link templates are worked out once
+    per schema class, and dumping an item is a getattr and a conversion per
+    field.  The document is the same one marshmallow builds, but values are
+    only read as attributes, and schemas using any option or field type not
+    handled here raise ValueError so json_api falls back to marshmallow.
+    """
+
+    def __init__(self, resource_class):
+        schema = resource_class()
+        opts = schema.opts
+        if opts.self_url or opts.self_url_many:
+            raise ValueError("resource links are not supported")
+        if dump_processors(resource_class) != dump_processors(Schema):
+            raise ValueError("dump processors are not supported")
+
+        self.type_ = opts.type_
+        self.id: Optional[Tuple[str, Callable]] = None
+        self.attributes: List[Tuple[str, str, Callable]] = []
+        self.relationships: List[Tuple[str, str, Relationship, List]] = []
+
+        for name, field in schema.fields.items():
+            if field.load_only:
+                continue
+            if field.dump_to or field.default is not missing:
+                raise ValueError(f"{name} needs marshmallow to dump")
+
+            attribute = field.attribute or name
+            if isinstance(field, Relationship):
+                self.relationships.append(
+                    (attribute, schema.inflect(name), field, self.link_params(field))
+                )
+            elif name == "id":
+                self.id = (attribute, self.converter(name, field))
+            else:
+                self.attributes.append(
+                    (attribute, schema.inflect(name), self.converter(name, field))
+                )
+
+    @staticmethod
+    def converter(name: str, field: fields.Field) -> Callable:
+        kind = type(field)
+        if kind is fields.String:
+            return _text
+        if kind is fields.List and type(field.container) is fields.String:
+            return _text_list
+        if kind is fields.Boolean:
+            return _boolean(field)
+        if (
+            kind is fields.DateTime
+            and field.dateformat in (None, "iso", "iso8601")
+            and not field.localtime
+        ):
+            return _isoformat
+        raise ValueError(f"{name} is a {kind.__name__}")
+
+    @staticmethod
+    def link_params(field: Relationship) -> List[Tuple[str, Optional[str], Any]]:
+        if (
+            field.self_url
+            or field.many
+            or field.include_data
+            or field.default is not missing
+        ):
+            raise ValueError(f"{field!r} needs marshmallow to dump")
+
+        params = []
+        if field.related_url:
+            for name, value in (field.related_url_kwargs or {}).items():
+                params.append((name, tpl(str(value)), value))
+        return params
+
+    def dump(self, resource, many=False) -> Dict:
+        if many:
+            items = resource if resource is not None else ()
+            return {"data": [self.dump_item(item) for item in items]}
+        return {"data": self.dump_item(resource)}
+
+    def dump_item(self, obj) -> Optional[Dict]:
+        found = False
+        item: Dict[str, Any] = {"type": self.type_}
+
+        if self.id is not None:
+            attribute, convert = self.id
+            value = getattr(obj, attribute, missing)
+            if value is not missing:
+                item["id"] = convert(value)
+                found = True
+
+        attributes = {}
+        for attribute, key, convert in self.attributes:
+            value = getattr(obj, attribute, missing)
+            if value is not missing:
+                attributes[key] = convert(value)
+        if attributes:
+            item["attributes"] = attributes
+            found = True
+
+        relationships = {}
+        for attribute, key, field, params in self.relationships:
+            value = getattr(obj, attribute, missing)
+            if value is missing:
+                continue
+            found = True
+            relationship = self.dump_relationship(obj, value, field, params)
+            if relationship:
+                relationships[key] = relationship
+        if relationships:
+            item["relationships"] = relationships
+
+        return item if found else None
+
+    @staticmethod
+    def dump_relationship(obj, value, field: Relationship, params: List) -> Dict:
+        relationship: Dict[str, Any] = {}
+
+        kwargs = {}
+        for name, attribute, literal in params:
+            param = getattr(obj, attribute) if attribute else literal
+            if param is not None:
+                kwargs[name] = param
+        if kwargs:
+            relationship["links"] = {"related": field.related_url.format(**kwargs)}
+
+        if field.include_resource_linkage:
+            if value is None:
+                relationship["data"] = None
+            else:
+                related_id = getattr(value, field.id_field, value)
+                relationship["data"] = {"type": field.type_, "id": _text(related_id)}
+        return relationship
+
+
 def dig(obj, keypath, default=None):
     try:
         return get(obj, keypath)
@@ -0,0 +1,16 @@
+import time
+
+
+def acquire_lock(redis, key: str, token: str, expire: int, wait: float) -> bool:
+    deadline = time.monotonic() + wait
+    while not redis.set(key, token, nx=True, ex=expire):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def release_lock(redis, key: str, token: str) -> None:
+    # Leave the lock alone if it expired and someone else has taken it
+    if redis.get(key) == token.encode():
+        redis.delete(key)
@@ -0,0 +1,198 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from flask import current_app
+
+# Seconds. Box starts run from tens of milliseconds for a warm claim up to
+# BOX_START_TIMEOUT for a cold start on a busy cluster.
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    """A Prometheus style histogram kept in Redis.
+
+    Web and job processes all observe into the same hash, so the numbers
+    survive worker restarts and cover boxes started by the provisioning
+    worker as well as by requests.  Fields are `<labels>|<le>` counts for
+    the smallest bucket each value fits in, plus `<labels>|sum`; buckets are
+    only made cumulative when rendered, so an observation costs two writes.
+    """
+
+    def __init__(
+        self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+
+    @property
+    def key(self) -> str:
+        return "userland:metrics:" + self.name
+
+    def observe(self, pipe, value: float, **labels: str) -> None:
+        prefix = label_string(labels)
+        bucket = next((str(b) for b in self.buckets if value <= b), "+Inf")
+        pipe.hincrby(self.key, f"{prefix}|{bucket}", 1)
+        pipe.hincrbyfloat(self.key, f"{prefix}|sum", value)
+
+    def render(self, redis) -> List[str]:
+        series: Dict[str, Dict[str, str]] = {}
+        for field, value in redis.hgetall(self.key).items():
+            prefix, _, suffix = field.decode().rpartition("|")
+            series.setdefault(prefix, {})[suffix] = value.decode()
+
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for prefix, fields in sorted(series.items()):
+            count = 0
+            for bucket in [str(b) for b in self.buckets] + ["+Inf"]:
+                count += int(fields.get(bucket, 0))
+                labels = f'{prefix},le="{bucket}"' if prefix else f'le="{bucket}"'
+                lines.append(f"{self.name}_bucket{{{labels}}} {count}")
+            lines.append(f"{self.name}_sum{{{prefix}}} {fields.get('sum', 0)}")
+            lines.append(f"{self.name}_count{{{prefix}}} {count}")
+        return lines
+
+
+class Gauge:
+    """A Prometheus style gauge kept in Redis, one hash field per label set"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+
+    @property
+    def key(self) -> str:
+        return "userland:metrics:" + self.name
+
+    def set(self, pipe, value: float, **labels: str) -> None:
+        pipe.hset(self.key, label_string(labels), value)
+
+    def render(self, redis) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(redis.hgetall(self.key).items()):
+            lines.append(f"{self.name}{{{labels.decode()}}} {value.decode()}")
+        return lines
+
+
+class Counter:
+    """A Prometheus style counter kept in Redis, one hash field per label set"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+
+    @property
+    def key(self) -> str:
+        return "userland:metrics:" + self.name
+
+    def inc(self, pipe, amount: int = 1, **labels: str) -> None:
+        pipe.hincrby(self.key, label_string(labels), amount)
+
+    def render(self, redis) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+        for labels, value in sorted(redis.hgetall(self.key).items()):
+            lines.append(f"{self.name}{{{labels.decode()}}} {value.decode()}")
+        return lines
+
+
+def label_string(labels: Dict[str, str]) -> str:
+    return ",".join(
+        '{}="{}"'.format(name, str(value).replace('"', "'"))
+        for name, value in sorted(labels.items())
+    )
+
+
+box_create_phase_seconds = Histogram(
+    "userland_box_create_phase_seconds", "Time spent in each phase of opening a box"
+)
+
+box_resume_phase_seconds = Histogram(
+    "userland_box_resume_phase_seconds",
+    "Time spent in each phase of resuming a hibernated box",
+)
+
+box_drift = Gauge(
+    "userland_box_drift",
+    "Boxes the last reconciliation found out of step between Nomad and the database",
+)
+
+discovery_cache_lookups = Counter(
+    "userland_discovery_cache_lookups_total",
+    "Service discovery lookups by whether the cache could answer them",
+)
+
+HISTOGRAMS = [box_create_phase_seconds, box_resume_phase_seconds]
+GAUGES = [box_drift]
+COUNTERS = [discovery_cache_lookups]
+
+
+def render_metrics(redis) -> str:
+    lines: List[str] = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render(redis))
+    for gauge in GAUGES:
+        lines.extend(gauge.render(redis))
+    for counter in COUNTERS:
+        lines.extend(counter.render(redis))
+    return "\n".join(lines) + "\n"
+
+
+class PhaseTimer:
+    """Times the phases of one operation and records them together.
+
+    Phases are timed with `with timer.phase("name"):` and kept in the order
+    they first ran.  `record` writes every phase into the histogram in a
+    single Redis round trip and, in production, onto the current ddtrace
+    root span.  Each is labelled with how the operation ended, so slow
+    failures show up next to the starts that worked.  A timer without a
+    histogram only keeps the timings.
+    """
+
+    def __init__(self, histogram: Optional[Histogram] = None, **labels: str):
+        self.histogram = histogram
+        self.labels = labels
+        self.timings: Dict[str, float] = OrderedDict()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def record(self, redis, outcome: str = "ok") -> None:
+        if self.histogram is None or not self.timings:
+            return
+
+        labels = dict(self.labels, outcome=outcome)
+        pipe = redis.pipeline(transaction=False)
+        for name, seconds in self.timings.items():
+            self.histogram.observe(pipe, seconds, phase=name, **labels)
+        pipe.execute()
+
+        if current_app.env == "production":
+            self.tag_span(labels)
+
+        self.timings.clear()
+
+    def tag_span(self, labels: Dict[str, str]) -> None:
+        from ddtrace import tracer
+
+        span = tracer.current_root_span()
+        if span is None:
+            return
+
+        for name, value in labels.items():
+            span.set_tag(f"{self.histogram.name}.{name}", value)
+        for name, seconds in self.timings.items():
+            span.set_metric(f"{self.histogram.name}.{name}", seconds)
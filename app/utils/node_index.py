@@ -0,0 +1,64 @@
+import time
+
+import nomad
+
+from app.utils.errors import NomadUnavailable
+
+
+class NodeIndex:
+    """Maps Nomad node IDs to their addresses.
+
+    The map lives in a Redis hash so every web and job process shares it.  It
+    is kept current by `flask nomad watch-nodes`, which follows the node list
+    with blocking queries.  A node that is not in the map yet costs one
+    lookup of that node alone, never the full node list.
+    """
+
+    KEY = "userland:nomad:nodes"
+
+    def __init__(self, redis, nomad_client):
+        self.redis = redis
+        self.nomad_client = nomad_client
+
+    def address(self, node_id: str) -> str:
+        address = self.redis.hget(self.KEY, node_id)
+        if address is not None:
+            return address.decode()
+
+        address = self.nomad_client.node.get_node(node_id)["Address"]
+        self.redis.hset(self.KEY, node_id, address)
+        return address
+
+    def sync(self, index: int = 0, wait: int = 0) -> int:
+        """Replace the map with the current node list.
+
+        With an index, Nomad holds the request until the node list changes
+        past it or `wait` seconds pass.  Returns the index to block on next.
+        """
+        params = {"index": index}
+        if wait:
+            params["wait"] = f"{wait}s"
+
+        response = self.nomad_client.nodes.request(method="get", params=params)
+        addresses = {node["ID"]: node["Address"] for node in response.json()}
+
+        pipe = self.redis.pipeline()
+        pipe.delete(self.KEY)
+        if addresses:
+            pipe.hmset(self.KEY, addresses)
+        pipe.execute()
+
+        return int(response.headers.get("X-Nomad-Index", 0))
+
+    def watch(self, reconnect=None, retry_delay: int = 5) -> None:
+        """Follow the node list forever, asking `reconnect` for a new client
+        whenever Nomad stops answering"""
+        index = 0
+        while True:
+            try:
+                index = self.sync(index, max(1, self.nomad_client.timeout - 1))
+            except (nomad.api.exceptions.BaseNomadException, NomadUnavailable) as e:
+                index = 0
+                time.sleep(getattr(e, "retry_after", retry_delay))
+                if reconnect:
+                    self.nomad_client = reconnect()
@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from typing import Optional
+
+import nomad
+import requests
+from dns.exception import DNSException
+from flask import current_app
+from nomad.api.base import Requester
+from requests.adapters import HTTPAdapter
+
+from app.utils.circuit_breaker import CircuitBreaker, CircuitOpen
+from app.utils.dns import discover_service, endpoint_health
+from app.utils.errors import NomadUnavailable
+
+
+class _TrackingAdapter(HTTPAdapter):
+    """HTTP adapter that tells the registry when Nomad stops answering.
+
+    Every call goes through the registry's circuit breaker, so while Nomad
+    is failing callers get NomadUnavailable straight away instead of each
+    waiting out its own timeout.
+    """
+
+    def __init__(self, registry, **kwargs):
+        self.registry = registry
+        super().__init__(**kwargs)
+
+    def send(self, *args, **kwargs):
+        breaker = self.registry.breaker
+        try:
+            breaker.before_call()
+        except CircuitOpen as e:
+            raise NomadUnavailable(retry_after=e.retry_after)
+
+        started = time.monotonic()
+        try:
+            response = super().send(*args, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            self.registry.mark_failed()
+            breaker.record_failure()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+
+        if response.status_code >= 500:
+            self.registry.report_failure()
+            breaker.record_failure()
+        else:
+            # Blocking queries are held open by Nomad, their time says
+            # nothing about how quick the server is
+            blocking = "index=" in (response.request.url or "")
+            self.registry.report_success(
+                None if blocking else time.monotonic() - started
+            )
+            breaker.record_success()
+        return response
+
+
+class NomadClientRegistry:
+    """Hands out one Nomad client per worker process.
+
+    python-nomad gives every endpoint (job, jobs, allocation, ...) its own
+    requests session, so a fresh client means a fresh TCP connection for
+    every call.  The registry builds a single client whose endpoints share a
+    pooled keep-alive session, and only goes back to service discovery when
+    the cached address is older than NOMAD_DISCOVERY_TTL, a connection to
+    it has failed or its server has been ejected for failing, see
+    EndpointHealth.  The registry also owns the process's circuit breaker
+    for Nomad.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._session = None
+        self._address = None
+        self._entry = None
+        self._resolved_at = 0.0
+        self._failed = False
+        self._pid = None
+        self.breaker = None
+
+    def client(self) -> nomad.Nomad:
+        with self._lock:
+            # Sockets must not be shared with a parent process after a fork
+            if self._pid != os.getpid():
+                self._reset()
+
+            if self._client is None or self._needs_resolve():
+                self._resolve()
+
+            return self._client
+
+    def mark_failed(self) -> None:
+        self._failed = True
+        self.report_failure()
+
+    def report_failure(self) -> None:
+        if self._entry is not None:
+            endpoint_health.report_failure(self._entry)
+
+    def report_success(self, seconds: Optional[float]) -> None:
+        if self._entry is not None:
+            endpoint_health.report_success(self._entry, seconds)
+
+    def _needs_resolve(self) -> bool:
+        ttl = current_app.config["NOMAD_DISCOVERY_TTL"]
+        now = time.monotonic()
+        return (
+            self._failed
+            or now - self._resolved_at > ttl
+            or not endpoint_health.available(self._entry, now)
+        )
+
+    def _resolve(self) -> None:
+        try:
+            self._entry = discover_service("nomad").choose()
+            address = self._entry.ip
+        except DNSException:
+            # Keep talking to the last known address rather than failing
+            if self._client is None:
+                raise
+            address = self._address
+
+        if self._client is None or address != self._address:
+            if self._session is not None:
+                self._session.close()
+            self._client = self._build(address)
+            self._address = address
+
+        self._resolved_at = time.monotonic()
+        self._failed = False
+
+    def _build(self, address: str) -> nomad.Nomad:
+        pool_size = current_app.config["NOMAD_POOL_SIZE"]
+        session = requests.Session()
+        adapter = _TrackingAdapter(
+            self, pool_connections=1, pool_maxsize=pool_size, pool_block=True
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self._session = session
+
+        client = nomad.Nomad(address)
+        for endpoint in vars(client).values():
+            if isinstance(endpoint, Requester):
+                endpoint.session = session
+
+        return client
+
+    def _reset(self) -> None:
+        self._client = None
+        self._session = None
+        self._address = None
+        self._entry = None
+        self._resolved_at = 0.0
+        self._failed = False
+        self._pid = os.getpid()
+        self.breaker = CircuitBreaker(
+            current_app.config["NOMAD_BREAKER_THRESHOLD"],
+            current_app.config["NOMAD_BREAKER_RESET"],
+        )
+
+
+registry = NomadClientRegistry()
+
+
+def nomad_client() -> nomad.Nomad:
+    return registry.client()
@@ -0,0 +1,27 @@
+from typing import Callable
+
+from sqlalchemy import event
+
+from app import db
+
+
+def after_commit(callback: Callable[[], None]) -> None:
+    """Run `callback` once the current transaction commits.
+
+    The hooks are set on this request's session, not on db.session, which
+    would set them for every session the factory makes.  A transaction that
+    rolls back drops the callback, rather than leaving it for whichever
+    commit comes next, in this request or a later one.
+    """
+    pending = [callback]
+
+    def on_commit(_):
+        if pending:
+            pending.pop()()
+
+    def on_rollback(_):
+        pending.clear()
+
+    session = db.session()
+    event.listen(session, "after_commit", on_commit, once=True)
+    event.listen(session, "after_rollback", on_rollback, once=True)
@@ -0,0 +1,26 @@
+"""box hibernation
+
+Revision ID: 2e6c8a4f0b17
+Revises: 7b3e9f1a2c58
+Create Date: 2026-10-18 17:02:31.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "2e6c8a4f0b17"
+down_revision = "7b3e9f1a2c58"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("box", sa.Column("job_spec", sa.JSON(), nullable=True))
+    op.add_column("box", sa.Column("node_id", sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    op.drop_column("box", "node_id")
+    op.drop_column("box", "job_spec")
@@ -0,0 +1,44 @@
+"""image catalog
+
+Revision ID: 4d7e2a9c1b63
+Revises: 9c31d6b2f8a7
+Create Date: 2026-10-18 14:05:37.120448
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "4d7e2a9c1b63"
+down_revision = "9c31d6b2f8a7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    image = op.create_table(
+        "image",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(length=32), nullable=False),
+        sa.Column("tag", sa.String(length=128), nullable=False),
+        sa.Column("memory", sa.Integer(), nullable=True),
+        sa.Column("cpu", sa.Integer(), nullable=True),
+        sa.Column("enabled", sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_image_name"), "image", ["name"], unique=True)
+
+    # The images start_box used to hard code
+    op.bulk_insert(
+        image,
+        [
+            {"name": name, "tag": f"cypherpunkarmory/{name}:0.0.1", "enabled": True}
+            for name in ["ubuntu", "debian", "kali", "alpine", "arch"]
+        ],
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_image_name"), table_name="image")
+    op.drop_table("image")
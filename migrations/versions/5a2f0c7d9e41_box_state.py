@@ -0,0 +1,31 @@
+"""box state
+
+Revision ID: 5a2f0c7d9e41
+Revises: c8493c83258e
+Create Date: 2026-10-18 09:12:44.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5a2f0c7d9e41"
+down_revision = "c8493c83258e"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "box",
+        sa.Column(
+            "state", sa.String(length=16), nullable=False, server_default="running"
+        ),
+    )
+    op.alter_column("box", "ssh_port", existing_type=sa.Integer(), nullable=True)
+
+
+def downgrade():
+    op.alter_column("box", "ssh_port", existing_type=sa.Integer(), nullable=False)
+    op.drop_column("box", "state")
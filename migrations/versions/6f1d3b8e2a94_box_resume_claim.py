@@ -0,0 +1,24 @@
+"""box resume claim
+
+Revision ID: 6f1d3b8e2a94
+Revises: 2e6c8a4f0b17
+Create Date: 2026-10-18 18:40:12.331052
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "6f1d3b8e2a94"
+down_revision = "2e6c8a4f0b17"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("box", sa.Column("claimed_at", sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("box", "claimed_at")
@@ -0,0 +1,25 @@
+"""box session end index
+
+Revision ID: 7b3e9f1a2c58
+Revises: 4d7e2a9c1b63
+Create Date: 2026-10-18 16:21:09.538112
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "7b3e9f1a2c58"
+down_revision = "4d7e2a9c1b63"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        op.f("ix_box_session_end_time"), "box", ["session_end_time"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_box_session_end_time"), table_name="box")
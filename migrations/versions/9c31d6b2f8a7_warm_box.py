@@ -0,0 +1,39 @@
+"""warm box pool
+
+Revision ID: 9c31d6b2f8a7
+Revises: 5a2f0c7d9e41
+Create Date: 2026-10-18 11:40:02.901773
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9c31d6b2f8a7"
+down_revision = "5a2f0c7d9e41"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "warm_box",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("job_id", sa.String(length=64), nullable=False),
+        sa.Column("image", sa.String(length=128), nullable=False),
+        sa.Column("plan_id", sa.Integer(), nullable=False),
+        sa.Column("ssh_port", sa.Integer(), nullable=True),
+        sa.Column("ip_address", sa.String(length=32), nullable=True),
+        sa.Column("ready", sa.Boolean(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["plan_id"], ["plan.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("job_id"),
+    )
+    op.create_index(op.f("ix_warm_box_image"), "warm_box", ["image"], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_warm_box_image"), table_name="warm_box")
+    op.drop_table("warm_box")
@@ -0,0 +1,44 @@
+import timeit
+
+import pytest
+
+from app.models import UserLimit
+from app.services.box_job import BoxJobBuilder, render_box_template
+
+IMAGE = "cypherpunkarmory/ubuntu:0.0.1"
+LIMITS = UserLimit(
+    box_count=2,
+    duration=28800,
+    memory=512,
+    cpu=1024,
+    bandwidth=10000,
+    forwards=10,
+    reserved_config=2,
+)
+ROUNDS = 500
+
+
+class TestBoxJobBenchmark(object):
+    """Job builder matches the Jinja render and is cheaper per box"""
+
+    def test_builder_matches_render(self, app):
+        with app.app_context():
+            built = BoxJobBuilder.for_image(IMAGE, LIMITS).build("box-7", "ssh-rsa AAA")
+            rendered = render_box_template("box-7", "ssh-rsa AAA", IMAGE, LIMITS)
+
+        assert built == rendered
+
+    @pytest.mark.benchmark
+    def test_builder_is_faster_than_render(self, app):
+        with app.app_context():
+            builder = BoxJobBuilder.for_image(IMAGE, LIMITS)
+
+            render = timeit.timeit(
+                lambda: render_box_template("box-7", "ssh-rsa AAA", IMAGE, LIMITS),
+                number=ROUNDS,
+            )
+            build = timeit.timeit(
+                lambda: builder.build("box-7", "ssh-rsa AAA"), number=ROUNDS
+            )
+
+        assert build < render
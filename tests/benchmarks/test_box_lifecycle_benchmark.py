@@ -0,0 +1,125 @@
+import time
+from unittest import mock
+
+import pytest
+
+from app.jobs.nomad_cleanup import cleanup_old_nomad_box
+from app.services.box import (
+    BoxBatchCreationService,
+    BoxCreationService,
+    BoxHibernationService,
+)
+from app.utils.errors import BoxError, BoxPlacementFailed
+from tests.factories.user import UserFactory
+from tests.support.fake_nomad import FakeNomad
+
+IMAGE = "cypherpunkarmory/ubuntu:0.0.1"
+BOXES = 20
+
+
+@pytest.fixture
+def fake_nomad(request):
+    options = getattr(request, "param", {})
+    with FakeNomad(**options) as fake:
+        client = fake.client()
+        with mock.patch("app.services.box.nomad_client", return_value=client):
+            with mock.patch("app.jobs.nomad_cleanup.nomad_client", return_value=client):
+                with mock.patch("app.services.warm_pool.release_session_end"):
+                    with mock.patch("app.services.box.release_session_end"):
+                        yield fake
+
+
+@pytest.fixture
+def user(session):
+    u = UserFactory()
+    session.add(u)
+    session.flush()
+    return u
+
+
+def open_box(user):
+    service = BoxCreationService(user, None, "ssh-rsa AAA", IMAGE)
+    return service.provision(service.reserve(check_limit=False))
+
+
+class TestBoxLifecycleBenchmark(object):
+    """Box path timed against a local stand-in for Nomad"""
+
+    @pytest.mark.parametrize(
+        "fake_nomad", [{"nodes": 5, "scheduling_delay": 0.02}], indirect=True
+    )
+    def test_open_and_close_throughput(self, fake_nomad, user):
+        boxes = [open_box(user) for _ in range(BOXES)]
+
+        assert len(fake_nomad.running()) == BOXES
+        assert len({(box.ip_address, box.ssh_port) for box in boxes}) == BOXES
+
+        for box in boxes:
+            cleanup_old_nomad_box(box.job_id)
+
+        assert fake_nomad.jobs == {}
+
+    @pytest.mark.parametrize(
+        "fake_nomad",
+        [{"nodes": 5, "scheduling_delay": 0.02, "pull_delay": 0.1}],
+        indirect=True,
+    )
+    @pytest.mark.benchmark
+    def test_resume_is_faster_than_open(self, fake_nomad, user, session):
+        # Each step commits, as its route does, so it pays for its own events
+        start = time.perf_counter()
+        boxes = []
+        for _ in range(BOXES):
+            boxes.append(open_box(user))
+            session.commit()
+        opened = time.perf_counter() - start
+
+        for box in boxes:
+            BoxHibernationService(user, box).hibernate()
+        session.commit()
+        assert fake_nomad.running() == []
+
+        start = time.perf_counter()
+        for box in boxes:
+            BoxHibernationService(user, box).resume()
+            session.commit()
+        resumed = time.perf_counter() - start
+
+        assert len(fake_nomad.running()) == BOXES
+        assert resumed < opened
+
+    @pytest.mark.parametrize(
+        "fake_nomad", [{"nodes": 3, "scheduling_delay": 0.2}], indirect=True
+    )
+    @pytest.mark.benchmark
+    def test_batch_waits_concurrently(self, app, fake_nomad, user):
+        items = [(None, "ssh-rsa AAA", IMAGE)] * 4
+
+        start = time.perf_counter()
+        with mock.patch.object(user.plan, "box_count", 10):
+            results = BoxBatchCreationService(user, items).create()
+        elapsed = time.perf_counter() - start
+
+        assert all(not isinstance(result, BoxError) for result in results)
+        assert elapsed < 0.2 * len(items)
+
+    @pytest.mark.parametrize(
+        "fake_nomad", [{"nodes": 1, "node_capacity": 1}], indirect=True
+    )
+    def test_full_cluster_fails_fast(self, fake_nomad, user):
+        open_box(user)
+
+        start = time.perf_counter()
+        with pytest.raises(BoxPlacementFailed):
+            open_box(user)
+
+        assert time.perf_counter() - start < 1
+
+    @pytest.mark.parametrize("fake_nomad", [{"failure_rate": 1.0}], indirect=True)
+    def test_failed_allocation_is_reported(self, fake_nomad, user):
+        with mock.patch("app.services.box.cleanup_old_nomad_box") as cleanup:
+            with pytest.raises(BoxError) as e:
+                open_box(user)
+
+        assert e.value.code == "allocation_failed"
+        assert cleanup.queue.called
@@ -0,0 +1,77 @@
+import json
+import timeit
+from datetime import datetime
+
+import pytest
+
+from app.models import Box, Config
+from app.serializers import BoxSchema, ConfigSchema, ErrorSchema
+from app.utils.errors import BoxError, BoxLimitReached
+from app.utils.json import compile_schema, json_api, static_document
+
+ITEMS = 1000
+ROUNDS = 5
+
+
+def configs():
+    return [Config(id=i, name=f"config-{i}") for i in range(ITEMS)]
+
+
+def boxes():
+    return [
+        Box(
+            id=i,
+            config_id=i,
+            config=config,
+            ssh_port=30000 + i,
+            ip_address="10.0.0.1",
+            state=Box.RUNNING,
+            session_end_time=datetime(2026, 1, 2, 3, 4, 5, i),
+        )
+        for i, config in enumerate(configs())
+    ] + [Box(id=ITEMS, state=Box.PENDING)]
+
+
+class TestSerializerBenchmark(object):
+    """Compiled serializers match marshmallow and are cheaper per item"""
+
+    @pytest.mark.parametrize(
+        "resource, schema, many",
+        [
+            (boxes(), BoxSchema, True),
+            (configs(), ConfigSchema, True),
+            ([], BoxSchema, True),
+            (None, BoxSchema, False),
+            (BoxLimitReached, ErrorSchema, False),
+            (BoxError("Nomad is down", code="nomad_down"), ErrorSchema, False),
+        ],
+    )
+    def test_compiled_matches_marshmallow(self, resource, schema, many):
+        expected = schema().dump(resource, many=many).data
+
+        assert compile_schema(schema).dump(resource, many=many) == expected
+
+    @pytest.mark.parametrize(
+        "resources, schema", [(boxes(), BoxSchema), (configs(), ConfigSchema)]
+    )
+    @pytest.mark.benchmark
+    def test_compiled_is_faster_than_marshmallow(self, resources, schema):
+        compiled = compile_schema(schema)
+
+        marshmallow = timeit.timeit(
+            lambda: schema().dump(resources, many=True), number=ROUNDS
+        )
+        fast = timeit.timeit(lambda: compiled.dump(resources, many=True), number=ROUNDS)
+
+        assert fast < marshmallow
+
+    def test_static_error_documents_are_cached(self, app):
+        static_document.cache_clear()
+        with app.test_request_context():
+            first = json_api(BoxLimitReached, ErrorSchema)
+            second = json_api(BoxLimitReached, ErrorSchema)
+
+        assert static_document.cache_info().hits == 1
+        assert first.get_data() == second.get_data()
+        assert json.loads(first.get_data()) == ErrorSchema().dump(BoxLimitReached).data
+        assert first.headers["Content-Type"] == "application/vnd.api+json"
@@ -4,7 +4,24 @@ from app import create_app
 from app import db as _db
 from sqlalchemy import event
 from tests.support.client import TestClient
-from tests.factories import user, plan as plan_factory
+from app.commands import IMAGES
+from tests.factories import user, plan as plan_factory, image as image_factory
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark", action="store_true", help="run the wall-clock benchmarks"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    # Timings depend on the machine, so they only run when asked for
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="needs --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
 
 
 @pytest.fixture(scope="session")
@@ -35,6 +52,17 @@ def populate_plans(app, db):
         sess.expire_all()
 
 
+@pytest.fixture(scope="session", autouse=True)
+def populate_images(app, db):
+    with app.app_context():
+        sess = _db.create_scoped_session()
+        for name, attributes in IMAGES.items():
+            sess.add(image_factory.ImageFactory(name=name, **attributes))
+
+        sess.commit()
+        sess.remove()
+
+
 @pytest.fixture(scope="function", autouse=True)
 def session(app, db, request):
     with app.app_context():
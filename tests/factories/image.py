@@ -0,0 +1,14 @@
+from factory import Factory
+from pytest_factoryboy import register
+
+from app.models import Image
+
+
+@register
+class ImageFactory(Factory):
+    class Meta:
+        model = Image
+
+    name = "ubuntu"
+    tag = "cypherpunkarmory/ubuntu:0.0.1"
+    enabled = True
@@ -10,6 +10,9 @@ class PlanFactory(Factory):
         model = Plan
 
     box_count = 5
+    duration = 28800
+    memory = 512
+    cpu = 1024
     bandwidth = 100000
     forwards = 9999
     reserved_config = 5
@@ -0,0 +1,261 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+from nomad.api.exceptions import BaseNomadException
+
+from app import Q
+from app.jobs.nomad_cleanup import (
+    check_all_boxes,
+    cleanup_old_nomad_box,
+    cleanup_old_nomad_boxes,
+    expire_boxes,
+    remove_home_volume,
+)
+from app.models import Box, Plan, WarmBox
+from app.utils.metrics import box_drift
+from tests.factories.box import BoxFactory
+from tests.support.fake_nomad import FakeNomad
+
+
+def nomad_job(job_id):
+    return {"ID": job_id, "Name": job_id, "TaskGroups": [{"Name": "ssh-client"}]}
+
+
+class TestCleanupOldNomadBoxes(object):
+    """Batch cleanup deregisters every job and reports the ones it could not"""
+
+    @mock.patch("app.services.warm_pool.release_session_end")
+    @mock.patch("app.jobs.nomad_cleanup.cleanup_old_nomad_boxes.schedule")
+    def test_deregisters_all_jobs(self, mock_schedule, mock_release):
+        """ Every job is purged and a job Nomad has already lost is not an error"""
+        with FakeNomad(scheduling_delay=0) as fake:
+            job_ids = [f"box-client-box-{i}" for i in range(5)]
+            for job_id in job_ids:
+                fake.register(nomad_job(job_id))
+
+            with mock.patch(
+                "app.jobs.nomad_cleanup.nomad_client", return_value=fake.client()
+            ):
+                failures = cleanup_old_nomad_boxes(job_ids + ["box-client-gone"])
+
+            assert failures == {}
+            assert fake.jobs == {}
+            assert not mock_schedule.called
+            assert mock_release.call_count == 6
+
+    @mock.patch("app.services.warm_pool.release_session_end")
+    @mock.patch("app.jobs.nomad_cleanup.cleanup_old_nomad_boxes.schedule")
+    @mock.patch("app.jobs.nomad_cleanup.nomad_client")
+    def test_reports_and_retries_failures(
+        self, mock_client, mock_schedule, mock_release
+    ):
+        """ Jobs that fail to deregister are returned and retried later"""
+
+        def deregister_job(job_id, purge):
+            if job_id == "box-client-box-2":
+                raise BaseNomadException("Nomad is having a bad day")
+
+        mock_client.return_value.job.deregister_job.side_effect = deregister_job
+
+        failures = cleanup_old_nomad_boxes(
+            ["box-client-box-1", "box-client-box-2", "box-client-box-3"]
+        )
+
+        assert list(failures) == ["box-client-box-2"]
+        mock_schedule.assert_called_once()
+        assert mock_schedule.call_args[0][1] == ["box-client-box-2"]
+
+
+class TestRemoveHomeVolume(object):
+    """A box's home volume is removed from every node it was left on"""
+
+    @mock.patch("app.services.warm_pool.release_session_end")
+    @mock.patch("app.jobs.nomad_cleanup.remove_home_volume.queue")
+    def test_cleanup_removes_volume(self, mock_remove, mock_release):
+        """ Deregistering a box queues removing its volume from its node"""
+        with FakeNomad(scheduling_delay=0) as fake:
+            fake.register(nomad_job("box-client-box-1"))
+            node_id = fake.running()[0]["NodeID"]
+
+            with mock.patch(
+                "app.jobs.nomad_cleanup.nomad_client", return_value=fake.client()
+            ):
+                cleanup_old_nomad_box("box-client-box-1")
+
+        mock_remove.assert_called_once_with(
+            "box-client-box-1", [node_id], timeout=60000
+        )
+
+    @mock.patch("app.services.warm_pool.release_session_end")
+    @mock.patch("app.jobs.nomad_cleanup.remove_home_volume.queue")
+    def test_collected_job_uses_recorded_node(self, mock_remove, mock_release):
+        """ A hibernated box's volume goes even once Nomad has collected its job"""
+        with FakeNomad(scheduling_delay=0) as fake:
+            with mock.patch(
+                "app.jobs.nomad_cleanup.nomad_client", return_value=fake.client()
+            ):
+                cleanup_old_nomad_box("box-client-box-1", ["node-1"])
+
+        mock_remove.assert_called_once_with(
+            "box-client-box-1", ["node-1"], timeout=60000
+        )
+
+    def test_submits_job_pinned_to_node(self):
+        """ The volume is removed by a batch job on the node that holds it"""
+        with FakeNomad(nodes=2, scheduling_delay=0) as fake:
+            node_id = next(iter(fake.nodes))
+
+            with mock.patch(
+                "app.jobs.nomad_cleanup.nomad_client", return_value=fake.client()
+            ):
+                remove_home_volume("box-client-box-1", [node_id])
+
+            (job,) = fake.jobs.values()
+            assert job["ID"] == f"userland-volume-rm-box-1-{node_id[:8]}"
+            task = job["TaskGroups"][0]["Tasks"][0]
+            assert task["Config"]["args"] == ["volume", "rm", "userland-box-1"]
+            assert [a["NodeID"] for a in fake.running()] == [node_id]
+
+
+class TestExpireBoxes(object):
+    """The sweeper tears down boxes whose session has ended"""
+
+    @mock.patch("app.services.box.cleanup_old_nomad_boxes.queue")
+    def test_expires_due_boxes(self, mock_cleanup, app, current_user, session):
+        """ Only boxes past their end time go, however many batches it takes"""
+        now = datetime.utcnow()
+        expired = [
+            BoxFactory(
+                config__id=1000 + i,
+                config__user=current_user,
+                session_end_time=now - timedelta(i),
+            )
+            for i in range(1, 4)
+        ]
+        running = BoxFactory(
+            config__id=1000,
+            config__user=current_user,
+            session_end_time=now + timedelta(hours=1),
+        )
+        session.add_all(expired + [running])
+        session.flush()
+        expired_ids = [b.id for b in expired]
+
+        with mock.patch.dict(app.config, {"BOX_EXPIRY_BATCH": 2}):
+            expire_boxes()
+
+        assert Box.query.filter(Box.id.in_(expired_ids)).count() == 0
+        assert Box.query.get(running.id) is not None
+        assert mock_cleanup.call_count == 2
+
+
+class TestCheckAllBoxes(object):
+    """Reconciliation finds every way Nomad and the database disagree"""
+
+    @mock.patch("app.jobs.nomad_cleanup.cleanup_old_nomad_boxes.queue")
+    def test_reconciles_drift(self, mock_cleanup, app, current_user, session):
+        """ Orphaned jobs and expired boxes are cleaned up and drift is reported"""
+        now = datetime.utcnow()
+        running = BoxFactory(
+            config__id=1000,
+            config__user=current_user,
+            job_id="box-client-box-1000",
+            session_end_time=now + timedelta(hours=1),
+        )
+        expired = BoxFactory(
+            config__id=1001,
+            config__user=current_user,
+            job_id="box-client-box-1001",
+            session_end_time=now - timedelta(hours=1),
+        )
+        missing = BoxFactory(
+            config__id=1002,
+            config__user=current_user,
+            job_id="box-client-box-1002",
+            session_end_time=now + timedelta(hours=1),
+        )
+        warm = WarmBox(job_id="box-client-warm-abc", image="ubuntu", plan=Plan.paid())
+        session.add_all([running, expired, missing, warm])
+        session.flush()
+
+        with FakeNomad(scheduling_delay=0) as fake:
+            for job_id in [
+                "box-client-box-1000",
+                "box-client-box-1001",
+                "box-client-warm-abc",
+                "box-client-box-orphan",
+            ]:
+                fake.register(nomad_job(job_id))
+
+            with mock.patch(
+                "app.jobs.nomad_cleanup.nomad_client", return_value=fake.client()
+            ), mock.patch.dict(app.config, {"BOX_START_TIMEOUT": 0}):
+                drift = check_all_boxes()
+
+        assert drift["orphaned"] == ["box-client-box-orphan"]
+        assert drift["expired"] == [expired.id]
+        assert drift["missing"] == [missing.id]
+        assert mock_cleanup.call_args_list == [
+            mock.call(["box-client-box-orphan"], timeout=60000),
+            mock.call(["box-client-box-1001"], {}, timeout=60000),
+        ]
+        assert Box.query.get(expired.id) is None
+        assert Box.query.get(running.id) is not None
+        assert 'userland_box_drift{kind="missing"} 1' in box_drift.render(Q.connection)
+
+    @mock.patch("app.jobs.nomad_cleanup.cleanup_old_nomad_boxes.queue")
+    def test_puts_stalled_resumes_back(self, mock_cleanup, app, current_user, session):
+        """ A resume claim nobody finished puts the box back to hibernated"""
+        now = datetime.utcnow()
+        stalled = BoxFactory(
+            config__id=1003,
+            config__user=current_user,
+            job_id="box-client-box-1003",
+            state=Box.PENDING,
+            job_spec=nomad_job("box-client-box-1003"),
+            claimed_at=now - timedelta(hours=1),
+            session_end_time=now + timedelta(hours=1),
+        )
+        resuming = BoxFactory(
+            config__id=1004,
+            config__user=current_user,
+            job_id="box-client-box-1004",
+            state=Box.PENDING,
+            job_spec=nomad_job("box-client-box-1004"),
+            claimed_at=now,
+            session_end_time=now + timedelta(hours=1),
+        )
+        session.add_all([stalled, resuming])
+        session.flush()
+
+        with FakeNomad(scheduling_delay=0) as fake:
+            fake.register(nomad_job("box-client-box-1003"))
+            fake.register(nomad_job("box-client-box-1004"))
+
+            with mock.patch(
+                "app.jobs.nomad_cleanup.nomad_client", return_value=fake.client()
+            ):
+                drift = check_all_boxes()
+
+            assert fake.jobs["box-client-box-1003"]["Status"] == "dead"
+            assert fake.jobs["box-client-box-1004"]["Status"] != "dead"
+
+        assert drift["stalled"] == [stalled.id]
+        assert stalled.state == Box.HIBERNATED
+        assert stalled.claimed_at is None
+        assert resuming.state == Box.PENDING
+        assert 'userland_box_drift{kind="stalled"} 1' in box_drift.render(Q.connection)
+
+    @mock.patch("app.jobs.nomad_cleanup.cleanup_old_nomad_boxes.queue")
+    def test_leaves_new_jobs_alone(self, mock_cleanup, app):
+        """ A job submitted moments ago may belong to a box not yet committed"""
+        with FakeNomad(scheduling_delay=0) as fake:
+            fake.register(nomad_job("box-client-box-starting"))
+
+            with mock.patch(
+                "app.jobs.nomad_cleanup.nomad_client", return_value=fake.client()
+            ):
+                drift = check_all_boxes()
+
+        assert drift["orphaned"] == []
+        assert not mock_cleanup.called
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+from app.jobs.nomad_cleanup import expire_boxes
+from app.jobs.provisioning import provision_box
+from app.models import Box, Config
+from app.services.box import BoxCreationService
+from app.utils.errors import BoxError, ClusterFull
+from tests.factories import box
+
+
+class TestProvisionBoxJob(object):
+    """Provisioning job finishes pending boxes"""
+
+    @mock.patch.object(
+        BoxCreationService, "create_box_nomad", return_value="box-client-box-1"
+    )
+    @mock.patch.object(
+        BoxCreationService, "get_box_details", return_value=(2222, "10.0.0.4")
+    )
+    def test_box_is_running(
+        self, mock_box_details, mock_create_box, current_user, session
+    ):
+        """ The pending box is filled in once Nomad runs it"""
+        pending = box.BoxFactory(
+            config__user=current_user, state=Box.PENDING, ssh_port=None
+        )
+        session.add(pending)
+        session.flush()
+
+        provision_box(pending.id, "i-am-a-lousy-key", "cypherpunkarmory/ubuntu:0.0.1")
+
+        assert pending.state == Box.RUNNING
+        assert pending.ssh_port == 2222
+        assert pending.ip_address == "10.0.0.4"
+
+    @mock.patch.object(
+        BoxCreationService, "create_box_nomad", side_effect=BoxError(detail="Error")
+    )
+    def test_box_failed(self, mock_create_box, current_user, session):
+        """ A box Nomad cannot start is dropped and its named config kept"""
+        pending = box.BoxFactory(
+            config__user=current_user, state=Box.PENDING, ssh_port=None
+        )
+        session.add(pending)
+        session.flush()
+        box_id, config_id = pending.id, pending.config_id
+
+        provision_box(box_id, "i-am-a-lousy-key", "cypherpunkarmory/ubuntu:0.0.1")
+
+        assert Box.query.get(box_id) is None
+        assert Config.query.get(config_id) is not None
+
+    @mock.patch("app.services.box.cleanup_old_nomad_boxes.queue")
+    @mock.patch.object(BoxCreationService, "start")
+    def test_failed_box_config_reopened(
+        self, mock_start, mock_cleanup, current_user, session
+    ):
+        """ A config whose box failed can be reopened and later expire"""
+        pending = box.BoxFactory(
+            config__user=current_user, state=Box.PENDING, ssh_port=None
+        )
+        session.add(pending)
+        session.flush()
+        config_id = pending.config_id
+
+        mock_start.side_effect = BoxError(detail="Error")
+        provision_box(pending.id, "i-am-a-lousy-key", "cypherpunkarmory/ubuntu:0.0.1")
+
+        mock_start.side_effect = None
+        mock_start.return_value = ("box-client-box-1", 2222, "10.0.0.4")
+        service = BoxCreationService(
+            current_user, config_id, "i-am-a-lousy-key", "cypherpunkarmory/ubuntu:0.0.1"
+        )
+        reopened = service.create()
+        reopened.session_end_time = datetime.utcnow() - timedelta(seconds=1)
+        session.commit()
+
+        expire_boxes()
+
+        assert Box.query.filter_by(config_id=config_id).count() == 0
+        assert Config.query.get(config_id) is None
+        assert mock_cleanup.call_args[0][0] == ["box-client-box-1"]
+
+    @mock.patch.object(BoxCreationService, "start", side_effect=ClusterFull)
+    @mock.patch("app.services.admission.AdmissionQueue.push")
+    def test_box_waits_for_capacity(self, mock_push, mock_start, current_user, session):
+        """ The box stays pending and goes back to the front of the queue"""
+        pending = box.BoxFactory(
+            config__user=current_user, state=Box.PENDING, ssh_port=None
+        )
+        session.add(pending)
+        session.flush()
+        box_id = pending.id
+
+        provision_box(box_id, "i-am-a-lousy-key", "cypherpunkarmory/ubuntu:0.0.1")
+
+        assert Box.query.get(box_id).state == Box.PENDING
+        assert mock_push.call_args[0][0] == box_id
+        assert mock_push.call_args[1] == {"front": True}
@@ -1,13 +1,21 @@
+from datetime import datetime, timedelta
+
+import hashlib
+import json
+
 import pytest
 from dpath.util import values
 from nomad.api.exceptions import BaseNomadException
+from app import Q
 from app.models import Box
 from app.services.box import BoxCreationService, BoxDeletionService
-from app.utils.errors import BoxError
+from app.services.box_events import publish_box_event
+from app.utils.errors import BoxError, NomadUnavailable
 from tests.factories.user import UserFactory
 from tests.factories import config, box
 from tests.support.assertions import assert_valid_schema
 from unittest import mock
+from werkzeug.datastructures import Headers
 
 
 class TestBoxes(object):
@@ -51,6 +59,105 @@ class TestBoxes(object):
         res = client.get(f"/boxes/{test_box.id}")
         assert res.status_code == 404
 
+    @mock.patch("app.services.box.publish_session_end")
+    def test_box_extend(self, mock_publish, client, current_user, session):
+        """User can move the end of a running box's session"""
+        test_box = box.BoxFactory(config__user=current_user, state=Box.RUNNING)
+        session.add(test_box)
+        session.flush()
+
+        session_end_time = datetime.utcnow().replace(microsecond=0) + timedelta(
+            seconds=60
+        )
+        res = client.patch(
+            f"/boxes/{test_box.id}",
+            json={
+                "data": {
+                    "type": "box",
+                    "attributes": {"sessionEndTime": session_end_time.isoformat()},
+                }
+            },
+        )
+
+        assert res.status_code == 200
+        assert_valid_schema(res.get_json(), "box.json")
+        assert Box.query.get(test_box.id).session_end_time == session_end_time
+        mock_publish.assert_called_once_with(test_box.job_id, session_end_time)
+
+    @mock.patch("app.services.box.publish_session_end")
+    def test_box_extend_past_limit(self, mock_publish, client, current_user, session):
+        """User cannot extend a session past their plan's duration"""
+        test_box = box.BoxFactory(config__user=current_user, state=Box.RUNNING)
+        session.add(test_box)
+        session.flush()
+
+        duration = current_user.limits().duration
+        session_end_time = datetime.utcnow() + timedelta(seconds=duration + 60)
+        res = client.patch(
+            f"/boxes/{test_box.id}",
+            json={
+                "data": {
+                    "type": "box",
+                    "attributes": {"sessionEndTime": session_end_time.isoformat()},
+                }
+            },
+        )
+
+        assert res.status_code == 403
+        assert not mock_publish.called
+
+    @mock.patch("app.services.box.publish_session_end")
+    def test_box_extend_pending(self, mock_publish, client, current_user, session):
+        """User cannot extend a box that has not started"""
+        test_box = box.BoxFactory(config__user=current_user, state=Box.PENDING)
+        session.add(test_box)
+        session.flush()
+
+        session_end_time = datetime.utcnow() + timedelta(seconds=60)
+        res = client.patch(
+            f"/boxes/{test_box.id}",
+            json={
+                "data": {
+                    "type": "box",
+                    "attributes": {"sessionEndTime": session_end_time.isoformat()},
+                }
+            },
+        )
+
+        assert res.status_code == 409
+        assert not mock_publish.called
+
+    def test_box_hibernate_pending(self, client, current_user, session):
+        """User cannot hibernate a box that has not started"""
+        test_box = box.BoxFactory(config__user=current_user, state=Box.PENDING)
+        session.add(test_box)
+        session.flush()
+
+        res = client.post(f"/boxes/{test_box.id}/hibernate")
+
+        assert res.status_code == 409
+
+    def test_box_resume_running(self, client, current_user, session):
+        """User cannot resume a box that is not hibernated"""
+        test_box = box.BoxFactory(config__user=current_user, state=Box.RUNNING)
+        session.add(test_box)
+        session.flush()
+
+        res = client.post(f"/boxes/{test_box.id}/resume")
+
+        assert res.status_code == 409
+
+    def test_box_resume_unowned(self, client, current_user, session):
+        """User cannot resume a box that does not belong to them"""
+        other_user = UserFactory(email="other_person@gmail.com")
+        test_box = box.BoxFactory(config__user=other_user, state=Box.HIBERNATED)
+        session.add_all([other_user, test_box])
+        session.flush()
+
+        res = client.post(f"/boxes/{test_box.id}/resume")
+
+        assert res.status_code == 404
+
     @pytest.mark.vcr()
     def test_box_open_without_config(self, client, current_user, session):
         """User can open a box without providing a config"""
@@ -134,6 +241,340 @@ class TestBoxes(object):
         res = client.delete("/boxes/" + str(test_box.id))
         assert res.status_code == 204
 
+    @mock.patch("app.services.box.BoxCreationService.create_box_nomad")
+    def test_box_open_async(self, mock_create_box, client, current_user, session):
+        """User gets a pending box straight away when asking for async"""
+
+        res = client.post(
+            "/boxes",
+            headers=Headers({"Prefer": "respond-async"}),
+            json={
+                "data": {
+                    "type": "box",
+                    "attributes": {"sshKey": "i-am-lousy-public-key"},
+                }
+            },
+        )
+
+        assert res.status_code == 202
+        assert_valid_schema(res.get_data(), "box.json")
+        assert values(res.get_json(), "data/attributes/state") == ["pending"]
+        assert res.get_json()["meta"]["queuePosition"] >= 1
+        assert not mock_create_box.called
+
+        box_id = values(res.get_json(), "data/id")[0]
+        res = client.get(f"/boxes/{box_id}")
+        assert values(res.get_json(), "data/attributes/state") == ["pending"]
+
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_batch(self, mock_start, client, current_user, session):
+        """User can open several boxes in one request"""
+        mock_start.return_value = ("box-client-box-1", 2222, "10.0.0.1")
+
+        res = client.post(
+            "/boxes",
+            json={
+                "data": [
+                    {"type": "box", "attributes": {"sshKey": "i-am-a-key"}},
+                    {
+                        "type": "box",
+                        "attributes": {"sshKey": "i-am-a-key", "image": "kali"},
+                    },
+                ]
+            },
+        )
+
+        assert res.status_code == 201
+        assert_valid_schema(res.get_data(), "boxes.json")
+        assert len(values(res.get_json(), "data/*/id")) == 2
+        assert values(res.get_json(), "meta/results/*/status") == ["201", "201"]
+        assert mock_start.call_count == 2
+        res = client.get("/boxes")
+        assert len(values(res.get_json(), "data/*/id")) == 2
+
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_batch_partial_failure(
+        self, mock_start, client, current_user, session
+    ):
+        """A box that fails to start does not fail the rest of the batch"""
+        mock_start.side_effect = [
+            ("box-client-box-1", 2222, "10.0.0.1"),
+            BoxError("Failed to create box"),
+        ]
+
+        res = client.post(
+            "/boxes",
+            json={
+                "data": [
+                    {"type": "box", "attributes": {"sshKey": "i-am-a-key"}},
+                    {"type": "box", "attributes": {"sshKey": "i-am-a-key"}},
+                ]
+            },
+        )
+
+        assert res.status_code == 207
+        assert sorted(values(res.get_json(), "meta/results/*/status")) == ["201", "500"]
+        assert len(values(res.get_json(), "data/*/id")) == 1
+        res = client.get("/boxes")
+        assert len(values(res.get_json(), "data/*/id")) == 1
+
+    @mock.patch("app.services.box.ConfigCreationService.create")
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_batch_over_limit(self, mock_start, mock_config, free_client):
+        """The whole batch is refused when it would go over the plan limit"""
+        res = free_client.post(
+            "/boxes",
+            json={
+                "data": [
+                    {"type": "box", "attributes": {"sshKey": "i-am-a-key"}},
+                    {"type": "box", "attributes": {"sshKey": "i-am-a-key"}},
+                ]
+            },
+        )
+
+        assert res.status_code == 403
+        assert not mock_start.called
+        assert not mock_config.called
+
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_unknown_image(self, mock_start, client):
+        """User cant open a box with an image that is not in the catalog"""
+        res = client.post(
+            "/boxes",
+            json={
+                "data": {
+                    "type": "box",
+                    "attributes": {"sshKey": "i-am-a-key", "image": "windows"},
+                }
+            },
+        )
+
+        assert res.status_code == 422
+        assert not mock_start.called
+
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_while_nomad_unavailable(self, mock_start, client):
+        """User is told when to retry while Nomad is failing"""
+        mock_start.side_effect = NomadUnavailable(retry_after=12)
+
+        res = client.post(
+            "/boxes",
+            json={"data": {"type": "box", "attributes": {"sshKey": "i-am-a-key"}}},
+        )
+
+        assert res.status_code == 503
+        assert res.headers["Retry-After"] == "12"
+        assert values(res.get_json(), "data/attributes/code") == ["nomad_unavailable"]
+
+    @mock.patch("app.services.box.BoxCreationService.create_box_nomad")
+    @mock.patch("app.utils.capacity.ClusterCapacity.fits", return_value=False)
+    def test_box_open_while_cluster_full(self, mock_fits, mock_create_box, client):
+        """User is turned away straight away when no node has room"""
+        res = client.post(
+            "/boxes",
+            json={"data": {"type": "box", "attributes": {"sshKey": "i-am-a-key"}}},
+        )
+
+        assert res.status_code == 503
+        assert res.headers["Retry-After"] == "10"
+        assert values(res.get_json(), "data/attributes/code") == ["cluster_full"]
+        assert not mock_create_box.called
+
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_idempotent_replay(self, mock_start, client):
+        """Repeating a request with the same Idempotency-Key opens one box"""
+        mock_start.return_value = ("box-client-box-1", 2222, "10.0.0.1")
+        body = {"data": {"type": "box", "attributes": {"sshKey": "i-am-a-key"}}}
+        headers = Headers({"Idempotency-Key": "open-one-box"})
+
+        first = client.post("/boxes", json=body, headers=headers)
+        second = client.post("/boxes", json=body, headers=headers)
+
+        assert first.status_code == 201
+        assert second.status_code == 201
+        assert second.headers["Idempotent-Replayed"] == "true"
+        assert second.get_json() == first.get_json()
+        assert mock_start.call_count == 1
+        res = client.get("/boxes")
+        assert len(values(res.get_json(), "data/*/id")) == 1
+
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_idempotency_key_reused(self, mock_start, client):
+        """An Idempotency-Key cant be reused for a different request"""
+        mock_start.return_value = ("box-client-box-1", 2222, "10.0.0.1")
+        headers = Headers({"Idempotency-Key": "open-one-box"})
+
+        client.post(
+            "/boxes",
+            json={"data": {"type": "box", "attributes": {"sshKey": "i-am-a-key"}}},
+            headers=headers,
+        )
+        res = client.post(
+            "/boxes",
+            json={"data": {"type": "box", "attributes": {"sshKey": "other-key"}}},
+            headers=headers,
+        )
+
+        assert res.status_code == 422
+        assert mock_start.call_count == 1
+
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_idempotent_in_flight(self, mock_start, client, current_user):
+        """A repeat of a request that is still running is told to retry"""
+        body = json.dumps(
+            {"data": {"type": "box", "attributes": {"sshKey": "i-am-a-key"}}}
+        )
+        claim = {
+            "state": "in_flight",
+            "fingerprint": hashlib.sha256(body.encode()).hexdigest(),
+        }
+        Q.connection.set(
+            f"userland:idempotency:{current_user.uuid}:in-flight", json.dumps(claim)
+        )
+
+        res = client.post(
+            "/boxes",
+            data=body,
+            content_type="application/json",
+            headers=Headers({"Idempotency-Key": "in-flight"}),
+        )
+
+        assert res.status_code == 409
+        assert res.headers["Retry-After"] == "5"
+        assert not mock_start.called
+
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_idempotency_claim_expires(
+        self, mock_start, app, client, current_user
+    ):
+        """A claim only outlives a killed request by two box start timeouts"""
+        store_key = f"userland:idempotency:{current_user.uuid}:claim-ttl"
+        ttls = []
+
+        def start():
+            ttls.append(Q.connection.ttl(store_key))
+            return ("box-client-box-1", 2222, "10.0.0.1")
+
+        mock_start.side_effect = start
+        client.post(
+            "/boxes",
+            json={"data": {"type": "box", "attributes": {"sshKey": "i-am-a-key"}}},
+            headers=Headers({"Idempotency-Key": "claim-ttl"}),
+        )
+
+        assert 0 < ttls[0] <= app.config["BOX_START_TIMEOUT"] * 2
+        assert Q.connection.ttl(store_key) > app.config["BOX_START_TIMEOUT"] * 2
+
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_idempotency_key_given_up(self, mock_start, client, current_user):
+        """A repeat takes over a key the first request gave up"""
+        mock_start.return_value = ("box-client-box-1", 2222, "10.0.0.1")
+        store_key = f"userland:idempotency:{current_user.uuid}:given-up"
+        Q.connection.set(store_key, "claimed")
+
+        def give_up(redis, *args):
+            # The first request fails between our claim and our read
+            redis.delete(store_key)
+
+        with mock.patch("app.utils.idempotency.replay", side_effect=give_up):
+            res = client.post(
+                "/boxes",
+                json={"data": {"type": "box", "attributes": {"sshKey": "i-am-a-key"}}},
+                headers=Headers({"Idempotency-Key": "given-up"}),
+            )
+
+        assert res.status_code == 201
+        assert mock_start.call_count == 1
+
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_config_locked(self, mock_start, client, current_user, session):
+        """User is told to retry while another request opens a box on the config"""
+        test_config = config.ConfigFactory(user=current_user)
+        session.add(test_config)
+        session.flush()
+        Q.connection.set(f"userland:config-lock:{test_config.id}", "other", ex=60)
+
+        res = client.post(
+            "/boxes",
+            json={
+                "data": {
+                    "type": "box",
+                    "attributes": {"sshKey": "i-am-a-key"},
+                    "relationships": {
+                        "config": {
+                            "data": {"type": "config", "id": str(test_config.id)}
+                        }
+                    },
+                }
+            },
+        )
+        Q.connection.delete(f"userland:config-lock:{test_config.id}")
+
+        assert res.status_code == 409
+        assert res.headers["Retry-After"] == "5"
+        assert not mock_start.called
+
+    @mock.patch("app.services.box.BoxCreationService.start")
+    def test_box_open_config_in_use(self, mock_start, client, current_user, session):
+        """User cant open a second box on a config that already has one"""
+        test_box = box.BoxFactory(config__user=current_user)
+        session.add(test_box)
+        session.flush()
+
+        res = client.post(
+            "/boxes",
+            json={
+                "data": {
+                    "type": "box",
+                    "attributes": {"sshKey": "i-am-a-key"},
+                    "relationships": {
+                        "config": {
+                            "data": {"type": "config", "id": str(test_box.config.id)}
+                        }
+                    },
+                }
+            },
+        )
+
+        assert res.status_code == 403
+        assert not mock_start.called
+
+    def test_box_events_without_cursor(self, client, current_user, session):
+        """User gets the state of their boxes and a cursor to poll from"""
+        test_box = box.BoxFactory(config__user=current_user)
+        session.add(test_box)
+        session.flush()
+
+        res = client.get("/boxes/events")
+
+        assert res.status_code == 200
+        assert values(res.get_json(), "data/*/state") == ["running"]
+        assert res.get_json()["meta"]["cursor"].isdigit()
+
+    def test_box_events_since_cursor(self, client, current_user, session):
+        """User gets the changes made since their last poll"""
+        test_box = box.BoxFactory(config__user=current_user)
+        session.add(test_box)
+        session.flush()
+        cursor = client.get("/boxes/events").get_json()["meta"]["cursor"]
+
+        publish_box_event(test_box, "gone")
+        session.commit()
+        res = client.get(f"/boxes/events?cursor={cursor}")
+
+        assert values(res.get_json(), "data/*/state") == ["gone"]
+        assert int(res.get_json()["meta"]["cursor"]) == int(cursor) + 1
+
+    def test_box_events_wait_is_bounded(self, app, client, current_user):
+        """A poll with nothing new answers empty once the wait is over"""
+        cursor = client.get("/boxes/events").get_json()["meta"]["cursor"]
+
+        with mock.patch.dict(app.config, {"BOX_EVENTS_WAIT": 0.1}):
+            res = client.get(f"/boxes/events?cursor={cursor}")
+
+        assert res.status_code == 200
+        assert res.get_json() == {"data": [], "meta": {"cursor": cursor}}
+
     def test_box_close_unowned(self, client):
         """User cant close a box they do not own"""
 
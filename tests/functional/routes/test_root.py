@@ -13,3 +13,21 @@ class TestRoot(object):
         """health_check is accessible with no login"""
         res = unauthenticated_client.get("/health_check")
         assert res.get_data() == b"OK"
+
+    def test_metrics_accessible(self, unauthenticated_client):
+        """metrics are exposed in the Prometheus text format"""
+        res = unauthenticated_client.get(
+            "/metrics", headers={"Authorization": "Bearer metrics-token"}
+        )
+        assert res.status_code == 200
+        assert b"# TYPE userland_box_create_phase_seconds histogram" in res.get_data()
+
+    def test_metrics_need_the_token(self, unauthenticated_client):
+        """metrics are hidden from anyone without the scrape token"""
+        res = unauthenticated_client.get("/metrics")
+        assert res.status_code == 404
+
+        res = unauthenticated_client.get(
+            "/metrics", headers={"Authorization": "Bearer guess"}
+        )
+        assert res.status_code == 404
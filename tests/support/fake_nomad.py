@@ -0,0 +1,426 @@
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import nomad
+
+# How long Nomad holds a blocking query that does not ask for a wait
+DEFAULT_WAIT = 300
+
+
+class FakeNomad:
+    """Stand-in for the parts of the Nomad HTTP API that boxes use.
+
+    Jobs are placed onto `nodes` nodes, each with room for `node_capacity`
+    allocations and reporting `node_resources` of CPU and memory.  A placed
+    allocation starts out pending and turns running, or failed for
+    `failure_rate` of them, after `scheduling_delay` seconds, plus
+    `pull_delay` the first time a node runs an image.  A job constrained
+    to a node's unique id is only placed there, and only while it has room.
+    Jobs that do not fit get an evaluation with FailedTGAllocs and no
+    allocation, the way Nomad reports a blocked placement.  Allocation and
+    node listings support blocking queries.
+
+        with FakeNomad(nodes=3, scheduling_delay=0.05) as fake:
+            client = fake.client()
+    """
+
+    def __init__(
+        self,
+        nodes=3,
+        node_capacity=10,
+        scheduling_delay=0.05,
+        failure_rate=0.0,
+        seed=0,
+        node_resources=None,
+        pull_delay=0.0,
+    ):
+        self.node_capacity = node_capacity
+        self.scheduling_delay = scheduling_delay
+        self.pull_delay = pull_delay
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+
+        self.nodes = {
+            str(uuid.uuid4()): {
+                "ID": None,
+                "Name": f"node-{i}",
+                "Address": f"10.0.0.{i + 1}",
+                "Status": "ready",
+                "Datacenter": "city",
+                "NodeClass": "",
+                "Meta": {"app": "userland"},
+                "Drain": False,
+                "SchedulingEligibility": "eligible",
+                "Resources": node_resources or {"CPU": 4000, "MemoryMB": 8192},
+                "Reserved": {"CPU": 0, "MemoryMB": 0},
+            }
+            for i in range(nodes)
+        }
+        for node_id, node in self.nodes.items():
+            node["ID"] = node_id
+        self.images = {node_id: set() for node_id in self.nodes}
+
+        self.jobs = {}
+        self.allocations = {}
+        self.evaluations = {}
+        self.requests = []
+        self.index = 1
+        self.ports = itertools.count(20000)
+        self.changed = threading.Condition()
+        self.timers = []
+        self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def client(self, timeout=5):
+        return nomad.Nomad(host="127.0.0.1", port=self.port, timeout=timeout)
+
+    def register(self, job):
+        with self.changed:
+            job = dict(job, Status="pending", SubmitTime=time.time_ns())
+            self.jobs[job["ID"]] = job
+            for allocation_id in self._job_allocations(job["ID"]):
+                del self.allocations[allocation_id]
+
+            if job.get("Type") == "system":
+                evaluation = self._evaluation(job, failed={})
+                for node_id in self.nodes:
+                    self._place(job, evaluation, node_id, delay=0)
+            else:
+                node_id = self._free_node(self._pinned_node(job))
+                evaluation = self._evaluation(
+                    job, failed=None if node_id else self._exhausted(job)
+                )
+                if node_id:
+                    self._place(job, evaluation, node_id, self.scheduling_delay)
+
+            self._bump()
+            return evaluation
+
+    def deregister(self, job_id, purge=False):
+        with self.changed:
+            job = self.jobs[job_id]
+            for allocation_id in self._job_allocations(job_id):
+                if purge:
+                    del self.allocations[allocation_id]
+                else:
+                    self.allocations[allocation_id]["ClientStatus"] = "complete"
+            if purge:
+                del self.jobs[job_id]
+            else:
+                job["Status"] = "dead"
+                job["Stop"] = True
+            evaluation = self._evaluation(job, failed=None)
+            self._bump()
+            return evaluation
+
+    def restart(self, job_id, delay=None):
+        """Restart the tasks of a job's running allocations, as a template
+        with ChangeMode restart does once its key changes"""
+        delay = self.scheduling_delay if delay is None else delay
+        with self.changed:
+            for allocation_id in self._job_allocations(job_id):
+                allocation = self.allocations[allocation_id]
+                if allocation["ClientStatus"] != "running":
+                    continue
+                for state in allocation["TaskStates"].values():
+                    state.update(State="pending", LastRestart=_timestamp())
+                    state["Restarts"] += 1
+                timer = threading.Timer(delay, self._rerun, (allocation_id,))
+                timer.daemon = True
+                self.timers.append(timer)
+                timer.start()
+            self._bump()
+
+    def running(self):
+        with self.changed:
+            return [
+                a for a in self.allocations.values() if a["ClientStatus"] == "running"
+            ]
+
+    def wait_for_change(self, index, wait):
+        with self.changed:
+            self.changed.wait_for(lambda: self.index > index, timeout=wait)
+            return self.index
+
+    def _bump(self):
+        self.index += 1
+        self.changed.notify_all()
+
+    def _job_allocations(self, job_id):
+        return [a["ID"] for a in self.allocations.values() if a["JobID"] == job_id]
+
+    def _free_node(self, pinned=None):
+        load = {node_id: 0 for node_id in self.nodes}
+        for allocation in self.allocations.values():
+            if allocation["ClientStatus"] in ("pending", "running"):
+                load[allocation["NodeID"]] += 1
+        if pinned:
+            load = {pinned: load[pinned]} if pinned in load else {}
+        if not load:
+            return None
+
+        node_id, used = min(load.items(), key=lambda item: item[1])
+        return node_id if used < self.node_capacity else None
+
+    def _pinned_node(self, job):
+        for constraint in job.get("Constraints") or []:
+            if constraint["LTarget"] == "${node.unique.id}":
+                return constraint["RTarget"]
+        return None
+
+    def _exhausted(self, job):
+        return {
+            group["Name"]: {
+                "NodesEvaluated": len(self.nodes),
+                "DimensionExhausted": {"memory": len(self.nodes)},
+                "ConstraintFiltered": None,
+            }
+            for group in job.get("TaskGroups", [])
+        }
+
+    def _evaluation(self, job, failed):
+        evaluation = {
+            "ID": str(uuid.uuid4()),
+            "JobID": job["ID"],
+            "Status": "complete",
+            "FailedTGAllocs": failed,
+            "CreateIndex": self.index,
+        }
+        self.evaluations[evaluation["ID"]] = evaluation
+        return evaluation
+
+    def _place(self, job, evaluation, node_id, delay):
+        task = job["TaskGroups"][0].get("Tasks", [{}])[0]
+        resources = task.get("Resources", {})
+        image = task.get("Config", {}).get("image")
+        if image not in self.images[node_id]:
+            self.images[node_id].add(image)
+            delay += self.pull_delay
+        allocation = {
+            "ID": str(uuid.uuid4()),
+            "EvalID": evaluation["ID"],
+            "JobID": job["ID"],
+            "NodeID": node_id,
+            "TaskGroup": job["TaskGroups"][0]["Name"],
+            "ClientStatus": "pending",
+            "TaskStates": {
+                task.get("Name", "box"): {"State": "pending", "Restarts": 0}
+            },
+            "Resources": {
+                "CPU": resources.get("CPU", 0),
+                "MemoryMB": resources.get("MemoryMB", 0),
+                "Networks": [
+                    {
+                        "IP": self.nodes[node_id]["Address"],
+                        "DynamicPorts": [{"Label": "ssh", "Value": next(self.ports)}],
+                    }
+                ],
+            },
+        }
+        self.allocations[allocation["ID"]] = allocation
+
+        status = "failed" if self.random.random() < self.failure_rate else "running"
+        if delay:
+            timer = threading.Timer(delay, self._settle, (allocation["ID"], status))
+            timer.daemon = True
+            self.timers.append(timer)
+            timer.start()
+        else:
+            self._start_tasks(allocation, status)
+
+    def _settle(self, allocation_id, status):
+        with self.changed:
+            allocation = self.allocations.get(allocation_id)
+            if allocation and allocation["ClientStatus"] == "pending":
+                self._start_tasks(allocation, status)
+                job = self.jobs.get(allocation["JobID"])
+                if job:
+                    job["Status"] = "running" if status == "running" else "dead"
+                self._bump()
+
+    def _rerun(self, allocation_id):
+        with self.changed:
+            allocation = self.allocations.get(allocation_id)
+            if allocation and allocation["ClientStatus"] == "running":
+                for state in allocation["TaskStates"].values():
+                    state.update(State="running", StartedAt=_timestamp())
+                self._bump()
+
+    def _start_tasks(self, allocation, status):
+        allocation["ClientStatus"] = status
+        for state in allocation["TaskStates"].values():
+            state["State"] = "running" if status == "running" else "dead"
+            state["StartedAt"] = _timestamp()
+
+
+def _timestamp():
+    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _handler(fake):
+    routes = []
+
+    def route(method, pattern):
+        def register(func):
+            routes.append((method, re.compile(f"^/v1{pattern}$"), func))
+            return func
+
+        return register
+
+    def blocking(query):
+        index = int(query.get("index", ["0"])[0])
+        wait = query.get("wait", ["0s"])[0]
+        seconds = float(wait[:-2]) / 1000 if wait.endswith("ms") else float(wait[:-1])
+        if index:
+            # Like Nomad, a missing or zero wait holds the query for the default
+            fake.wait_for_change(index, seconds or DEFAULT_WAIT)
+
+    @route("POST", "/jobs")
+    def register_job(body, query):
+        evaluation = fake.register(body["Job"])
+        return (
+            200,
+            {
+                "EvalID": evaluation["ID"],
+                "EvalCreateIndex": evaluation["CreateIndex"],
+                "JobModifyIndex": fake.index,
+            },
+        )
+
+    @route("GET", "/jobs")
+    def list_jobs(body, query):
+        prefix = query.get("prefix", [""])[0]
+        return (
+            200,
+            [
+                {
+                    "ID": job["ID"],
+                    "Name": job["Name"],
+                    "Type": job.get("Type"),
+                    "Status": job["Status"],
+                    "SubmitTime": job["SubmitTime"],
+                }
+                for job in list(fake.jobs.values())
+                if job["ID"].startswith(prefix)
+            ],
+        )
+
+    @route("GET", "/job/(?P<job_id>[^/]+)")
+    def get_job(body, query, job_id):
+        return (200, fake.jobs[job_id]) if job_id in fake.jobs else (404, None)
+
+    @route("DELETE", "/job/(?P<job_id>[^/]+)")
+    def deregister_job(body, query, job_id):
+        if job_id not in fake.jobs:
+            return 404, None
+        purge = query.get("purge", ["false"])[0].lower() == "true"
+        return 200, {"EvalID": fake.deregister(job_id, purge)["ID"]}
+
+    @route("GET", "/job/(?P<job_id>[^/]+)/allocations")
+    def job_allocations(body, query, job_id):
+        blocking(query)
+        return 200, [a for a in list(fake.allocations.values()) if a["JobID"] == job_id]
+
+    @route("GET", "/job/(?P<job_id>[^/]+)/evaluations")
+    def job_evaluations(body, query, job_id):
+        return 200, [e for e in list(fake.evaluations.values()) if e["JobID"] == job_id]
+
+    @route("GET", "/evaluation/(?P<eval_id>[^/]+)")
+    def get_evaluation(body, query, eval_id):
+        evaluation = fake.evaluations.get(eval_id)
+        return (200, evaluation) if evaluation else (404, None)
+
+    @route("GET", "/allocation/(?P<allocation_id>[^/]+)")
+    def get_allocation(body, query, allocation_id):
+        allocation = fake.allocations.get(allocation_id)
+        return (200, allocation) if allocation else (404, None)
+
+    @route("GET", "/nodes")
+    def list_nodes(body, query):
+        blocking(query)
+        return 200, list(fake.nodes.values())
+
+    @route("GET", "/node/(?P<node_id>[^/]+)/allocations")
+    def node_allocations(body, query, node_id):
+        return (
+            200,
+            [a for a in list(fake.allocations.values()) if a["NodeID"] == node_id],
+        )
+
+    @route("GET", "/node/(?P<node_id>[^/]+)")
+    def get_node(body, query, node_id):
+        node = fake.nodes.get(node_id)
+        return (200, node) if node else (404, None)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.dispatch("GET")
+
+        def do_POST(self):
+            self.dispatch("POST")
+
+        def do_PUT(self):
+            self.dispatch("POST")
+
+        def do_DELETE(self):
+            self.dispatch("DELETE")
+
+        def dispatch(self, method):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            fake.requests.append((method, url.path))
+
+            for route_method, pattern, func in routes:
+                match = pattern.match(url.path)
+                if route_method == method and match:
+                    status, payload = func(body, query, **match.groupdict())
+                    break
+            else:
+                status, payload = 404, None
+
+            data = b"not found" if status == 404 else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("X-Nomad-Index", str(fake.index))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
@@ -0,0 +1,93 @@
+import fakeredis
+import pytest
+
+from app.services.admission import AdmissionQueue
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeStrictRedis()
+
+
+def admission_queue(redis, concurrency=10, user_cap=1):
+    return AdmissionQueue(
+        redis,
+        weights={"paid": 2, "free": 1},
+        concurrency=concurrency,
+        user_cap=user_cap,
+        stale_after=240,
+    )
+
+
+def push(queue, box_id, user, tier):
+    queue.push(box_id, user, tier, "i-am-a-key", "ubuntu")
+
+
+class TestAdmissionQueue(object):
+    """Queued boxes are started fairly across plans and users"""
+
+    def test_dispatch_follows_weights(self, redis):
+        """ Heavier plans get proportionally more starts, lighter ones still move"""
+        queue = admission_queue(redis, concurrency=6)
+        for i in range(4):
+            push(queue, i, f"free-{i}", "free")
+            push(queue, 10 + i, f"paid-{i}", "paid")
+
+        tiers = [entry["tier"] for entry in queue.dispatch()]
+
+        assert tiers.count("paid") == 4
+        assert tiers.count("free") == 2
+
+    def test_dispatch_respects_user_cap(self, redis):
+        """ A user at their cap waits without holding up the users behind them"""
+        queue = admission_queue(redis)
+        push(queue, 1, "alice", "free")
+        push(queue, 2, "alice", "free")
+        push(queue, 3, "bob", "free")
+
+        assert [entry["box_id"] for entry in queue.dispatch()] == [1, 3]
+
+        queue.finish(1, seconds=12)
+        assert [entry["box_id"] for entry in queue.dispatch()] == [2]
+
+    def test_dispatch_respects_concurrency(self, redis):
+        """ No more than the concurrency limit provision at once"""
+        queue = admission_queue(redis, concurrency=2)
+        for i in range(3):
+            push(queue, i, f"user-{i}", "paid")
+
+        assert len(queue.dispatch()) == 2
+        assert queue.dispatch() == []
+
+        queue.finish(0)
+        assert [entry["box_id"] for entry in queue.dispatch()] == [2]
+
+    def test_retry_goes_to_the_front(self, redis):
+        """ A box that could not be placed keeps its turn"""
+        queue = admission_queue(redis, concurrency=1)
+        push(queue, 1, "alice", "free")
+        queue.push(2, "bob", "free", "i-am-a-key", "ubuntu", front=True)
+
+        assert [entry["box_id"] for entry in queue.dispatch()] == [2]
+
+    def test_cancel_removes_box(self, redis):
+        """ A box stopped while queued is never started"""
+        queue = admission_queue(redis)
+        push(queue, 1, "alice", "free")
+
+        queue.cancel(1)
+
+        assert queue.dispatch() == []
+
+    def test_estimate(self, redis):
+        """ Position counts the turns other plans get and wait uses start times"""
+        queue = admission_queue(redis, concurrency=2)
+        for i in range(4):
+            push(queue, i, f"free-{i}", "free")
+        push(queue, 10, "paid-0", "paid")
+        queue.finish(99, seconds=10)
+
+        position, wait = queue.estimate("paid")
+
+        assert position == 3
+        assert wait == 20
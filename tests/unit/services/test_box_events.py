@@ -0,0 +1,87 @@
+import json
+import queue
+
+import fakeredis
+import pytest
+
+from app.services.box_events import CHANNEL, BoxEventHub, BoxEventLog
+
+
+@pytest.fixture
+def hub():
+    return BoxEventHub()
+
+
+def message(user, box_id, state):
+    return json.dumps({"user": user, "box": {"id": box_id, "state": state}})
+
+
+class TestBoxEventHub(object):
+    """Box events reach the streams open for the box owner"""
+
+    def test_dispatches_to_owner_only(self, hub):
+        """ Events go to every stream of the owner and no one else"""
+        redis = fakeredis.FakeStrictRedis()
+        first = hub.subscribe(redis, "user-1")
+        second = hub.subscribe(redis, "user-1")
+        other = hub.subscribe(redis, "user-2")
+
+        hub.dispatch(message("user-1", "7", "running"))
+
+        assert first.get_nowait() == {"id": "7", "state": "running"}
+        assert second.get_nowait() == {"id": "7", "state": "running"}
+        assert other.empty()
+
+    def test_unsubscribed_streams_get_nothing(self, hub):
+        """ Closed streams are dropped"""
+        redis = fakeredis.FakeStrictRedis()
+        listener = hub.subscribe(redis, "user-1")
+        hub.unsubscribe("user-1", listener)
+
+        hub.dispatch(message("user-1", "7", "gone"))
+
+        assert listener.empty()
+
+    def test_events_arrive_through_redis(self, hub):
+        """ One shared subscription feeds the process"""
+        redis = fakeredis.FakeStrictRedis()
+        listener = hub.subscribe(redis, "user-1")
+
+        event = None
+        for _ in range(20):
+            redis.publish(CHANNEL, message("user-1", "7", "pending"))
+            try:
+                event = listener.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+
+        assert event == {"id": "7", "state": "pending"}
+
+
+class TestBoxEventLog(object):
+    """Polls catch up on box events from the log"""
+
+    def test_events_since_a_number(self):
+        """ A poll gets the events after the last one it saw"""
+        log = BoxEventLog(fakeredis.FakeStrictRedis())
+        first = log.append("user-1", {"id": "7", "state": "pending"})
+        log.append("user-1", {"id": "7", "state": "running"})
+        log.append("user-2", {"id": "8", "state": "running"})
+
+        assert log.since("user-1", first) == ([{"id": "7", "state": "running"}], 2)
+        assert log.since("user-1", 2) == ([], 2)
+        assert log.latest("user-1") == 2
+
+    def test_trimmed_events_need_a_fresh_start(self):
+        """ A poll too far behind is told to start again from the box states"""
+        log = BoxEventLog(fakeredis.FakeStrictRedis(), length=2)
+        for state in ("pending", "running", "expiring"):
+            log.append("user-1", {"id": "7", "state": state})
+
+        assert log.since("user-1", 0) is None
+        assert log.since("user-1", 1) == (
+            [{"id": "7", "state": "running"}, {"id": "7", "state": "expiring"}],
+            3,
+        )
+        assert log.since("user-1", 4) is None
@@ -1,9 +1,22 @@
 import pytest
 
-from app.services.box import BoxCreationService
-from app.models import UserLimit
-from app.utils.errors import BoxLimitReached
+from app.services.box import (
+    BoxCreationService,
+    BoxHibernationService,
+    BoxTeardownService,
+)
+from app.models import Box, Config, UserLimit
+from app import Q
+from app.utils.errors import (
+    BoxError,
+    BoxLimitReached,
+    BoxNotHibernated,
+    BoxNotRunning,
+    BoxPlacementFailed,
+)
+from tests.factories.box import BoxFactory
 from tests.factories.config import ConfigFactory
+from tests.support.fake_nomad import FakeNomad
 from unittest.mock import patch
 
 
@@ -22,3 +35,168 @@ class TestBoxCreationService(object):
                 BoxCreationService(
                     current_user=current_free_user, config_id=conf.id, ssh_key=""
                 ).create()
+
+    @patch("app.services.box.BoxCreationService.start")
+    def test_failed_start_is_timed(self, mock_start, current_user, session):
+        """ A start that fails still records its phases, under its outcome"""
+        mock_start.side_effect = BoxError("Failed", code="deadline_exceeded")
+        service = BoxCreationService(
+            current_user, None, "ssh-rsa AAA", "cypherpunkarmory/ubuntu:0.0.1"
+        )
+        box = service.reserve()
+
+        with patch.object(service.timer, "record") as mock_record:
+            with pytest.raises(BoxError):
+                service.provision(box)
+
+        mock_record.assert_called_once_with(Q.connection, outcome="deadline_exceeded")
+
+
+class TestBoxTeardownService(object):
+    """Box teardown service removes many boxes at once"""
+
+    @patch("app.services.box.cleanup_old_nomad_boxes.queue")
+    def test_teardown_user_boxes(self, mock_cleanup, current_user, session):
+        """ Removes the user's boxes and configs and queues one cleanup job"""
+        boxes = [
+            BoxFactory(config__id=1000 + i, config__user=current_user) for i in range(3)
+        ]
+        other = BoxFactory(config__id=1003)
+        session.add_all(boxes + [other])
+        session.flush()
+        config_ids = [b.config_id for b in boxes]
+
+        box_ids = BoxTeardownService.for_user(current_user).delete()
+
+        assert sorted(box_ids) == sorted(b.id for b in boxes)
+        mock_cleanup.assert_called_once()
+        assert sorted(mock_cleanup.call_args[0][0]) == sorted(b.job_id for b in boxes)
+        assert Box.query.filter(Box.config_id.in_(config_ids)).count() == 0
+        assert Config.query.filter(Config.id.in_(config_ids)).count() == 0
+        assert Box.query.get(other.id) is not None
+
+    @patch("app.services.box.cleanup_old_nomad_boxes.queue")
+    def test_teardown_keeps_shared_config(self, mock_cleanup, current_user, session):
+        """ A failed box goes without its config or the job of the box reusing it"""
+        live = BoxFactory(config__user=current_user, job_id="box-client-box-1")
+        failed = BoxFactory(
+            config=live.config, state=Box.FAILED, job_id="box-client-box-1"
+        )
+        session.add_all([live, failed])
+        session.flush()
+
+        BoxTeardownService(Box.query.filter_by(id=failed.id)).delete()
+
+        assert Box.query.get(failed.id) is None
+        assert Box.query.get(live.id) is not None
+        assert Config.query.get(live.config_id) is not None
+        assert not mock_cleanup.called
+
+    @patch("app.services.box.cleanup_old_nomad_boxes.queue")
+    def test_teardown_passes_hibernated_nodes(
+        self, mock_cleanup, current_user, session
+    ):
+        """ The node a hibernated box's home volume is on goes to the cleanup"""
+        hibernated = BoxFactory(
+            config__user=current_user, state=Box.HIBERNATED, node_id="node-1"
+        )
+        running = BoxFactory(config__user=current_user)
+        session.add_all([hibernated, running])
+        session.flush()
+
+        BoxTeardownService.for_user(current_user).delete()
+
+        assert mock_cleanup.call_args[0][1] == {hibernated.job_id: "node-1"}
+
+
+@pytest.fixture
+def fake_nomad():
+    with FakeNomad(scheduling_delay=0) as fake:
+        with patch("app.services.box.nomad_client", return_value=fake.client()):
+            with patch("app.services.box.release_session_end"):
+                yield fake
+
+
+class TestBoxHibernationService(object):
+    """Box hibernation service stops boxes and brings them back"""
+
+    def open_box(self, user):
+        service = BoxCreationService(user, None, "ssh-rsa AAA", "ubuntu:0.0.1")
+        return service.provision(service.reserve(check_limit=False))
+
+    def test_hibernate_and_resume(self, fake_nomad, current_user, session):
+        """ Resuming submits the saved job back onto the node it ran on"""
+        box = self.open_box(current_user)
+        node_id = fake_nomad.running()[0]["NodeID"]
+
+        BoxHibernationService(current_user, box).hibernate()
+
+        assert box.state == Box.HIBERNATED
+        assert box.node_id == node_id
+        assert box.session_end_time is None
+        assert fake_nomad.jobs[box.job_id]["Status"] == "dead"
+        assert fake_nomad.running() == []
+
+        BoxHibernationService(current_user, box).resume()
+
+        assert box.state == Box.RUNNING
+        assert box.ssh_port and box.session_end_time
+        assert box.job_spec is None
+        assert [a["NodeID"] for a in fake_nomad.running()] == [node_id]
+
+    def test_resume_claims_the_box(self, fake_nomad, current_user, session):
+        """ A second resume of a box being resumed never reaches Nomad"""
+        box = self.open_box(current_user)
+        BoxHibernationService(current_user, box).hibernate()
+        BoxHibernationService(current_user, box).claim()
+
+        submitted = fake_nomad.requests.count(("POST", "/v1/jobs"))
+        with pytest.raises(BoxNotHibernated):
+            BoxHibernationService(current_user, box).resume()
+
+        assert box.state == Box.PENDING
+        assert fake_nomad.requests.count(("POST", "/v1/jobs")) == submitted
+
+    def test_resume_only_on_its_node(self, fake_nomad, current_user, session):
+        """ A box whose node is full stays hibernated rather than moving"""
+        box = self.open_box(current_user)
+        BoxHibernationService(current_user, box).hibernate()
+        fake_nomad.node_capacity = 1
+        fake_nomad.register(
+            {
+                "ID": "box-client-neighbour",
+                "Name": "box-client-neighbour",
+                "Constraints": [
+                    {
+                        "LTarget": "${node.unique.id}",
+                        "RTarget": box.node_id,
+                        "Operand": "=",
+                    }
+                ],
+                "TaskGroups": [{"Name": "holepunch"}],
+            }
+        )
+
+        with pytest.raises(BoxPlacementFailed):
+            BoxHibernationService(current_user, box).resume()
+
+        assert box.state == Box.HIBERNATED
+        assert [a["NodeID"] for a in fake_nomad.running()] == [box.node_id]
+
+    def test_hibernate_pending_box(self, fake_nomad, current_user, session):
+        """ Only running boxes can be hibernated"""
+        box = BoxFactory(config__user=current_user, state=Box.PENDING)
+        session.add(box)
+        session.flush()
+
+        with pytest.raises(BoxNotRunning):
+            BoxHibernationService(current_user, box).hibernate()
+
+    def test_resume_running_box(self, fake_nomad, current_user, session):
+        """ Only hibernated boxes can be resumed"""
+        box = BoxFactory(config__user=current_user, state=Box.RUNNING)
+        session.add(box)
+        session.flush()
+
+        with pytest.raises(BoxNotHibernated):
+            BoxHibernationService(current_user, box).resume()
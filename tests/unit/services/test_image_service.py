@@ -0,0 +1,102 @@
+import pytest
+from unittest import mock
+
+from app.commands import set_image_command
+from app.models import Image, Plan
+from app.services.image import (
+    PREPULL_JOB_ID,
+    ImagePrePullService,
+    box_limits,
+    catalog_tag,
+)
+from app.utils.errors import ImageNotAvailable
+
+
+@pytest.fixture
+def nomad_client():
+    with mock.patch("app.services.image.nomad_client") as client:
+        yield client.return_value
+
+
+class TestImageCatalog(object):
+    """Boxes are opened with images from the catalog"""
+
+    def test_catalog_tag(self):
+        """ Image names resolve to their docker tag"""
+        assert catalog_tag("kali") == "cypherpunkarmory/kali:0.0.1"
+
+    @mock.patch("app.commands.prepull_images.queue")
+    def test_set_keeps_limits_left_out(self, mock_prepull, app, session):
+        """ Pointing an image at a new tag keeps the limits it already has"""
+        runner = app.test_cli_runner()
+        runner.invoke(
+            set_image_command,
+            ["kali", "cypherpunkarmory/kali:0.0.2", "--memory", "1024"],
+            catch_exceptions=False,
+        )
+        runner.invoke(
+            set_image_command,
+            ["kali", "cypherpunkarmory/kali:0.0.3"],
+            catch_exceptions=False,
+        )
+
+        kali = Image.query.filter_by(name="kali").first()
+        assert kali.tag == "cypherpunkarmory/kali:0.0.3"
+        assert kali.memory == 1024
+
+    def test_disabled_image_is_not_available(self, session):
+        """ Raises for images that are disabled or unknown"""
+        Image.query.filter_by(name="kali").first().enabled = False
+        session.flush()
+
+        with pytest.raises(ImageNotAvailable):
+            catalog_tag("kali")
+        with pytest.raises(ImageNotAvailable):
+            catalog_tag("windows")
+
+    def test_image_resources_capped_by_plan(self, session):
+        """ Image defaults apply up to what the plan allows"""
+        alpine = Image.query.filter_by(name="alpine").first()
+        alpine.memory = 128
+        alpine.cpu = 4096
+        session.flush()
+
+        limits = box_limits(alpine.tag, Plan.paid().limits())
+
+        assert limits.memory == 128
+        assert limits.cpu == Plan.paid().cpu
+        assert box_limits("unknown:latest", Plan.paid().limits()) == (
+            Plan.paid().limits()
+        )
+
+
+class TestImagePrePullService(object):
+    """Pre-pull keeps catalog images on every node"""
+
+    def test_registers_system_job_for_enabled_images(self, session, nomad_client):
+        """ Registers one task per enabled image"""
+        Image.query.filter_by(name="arch").first().enabled = False
+        session.flush()
+
+        ImagePrePullService().sync()
+
+        job = nomad_client.jobs.register_job.call_args[0][0]["Job"]
+        assert job["ID"] == PREPULL_JOB_ID
+        assert job["Type"] == "system"
+        tasks = job["TaskGroups"][0]["Tasks"]
+        assert [task["Name"] for task in tasks] == [
+            "alpine",
+            "debian",
+            "kali",
+            "ubuntu",
+        ]
+        assert tasks[0]["Config"]["image"] == "cypherpunkarmory/alpine:0.0.1"
+
+    def test_deregisters_when_catalog_is_empty(self, session, nomad_client):
+        """ Stops the pre-pull job when no image is enabled"""
+        Image.query.update({"enabled": False})
+
+        ImagePrePullService().sync()
+
+        nomad_client.job.deregister_job.assert_called_once_with(PREPULL_JOB_ID)
+        assert not nomad_client.jobs.register_job.called
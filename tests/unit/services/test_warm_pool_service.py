@@ -0,0 +1,98 @@
+import pytest
+from unittest import mock
+
+from app.models import Plan, WarmBox
+from app.services.warm_pool import (
+    WarmPoolService,
+    claim_warm_box,
+    hand_over,
+    warm_box_job,
+)
+from tests.support.fake_nomad import FakeNomad
+
+IMAGE = "cypherpunkarmory/ubuntu:0.0.1"
+
+
+@pytest.fixture
+def warm_pool(app):
+    with mock.patch.dict(app.config, {"WARM_POOL_SIZES": {IMAGE: {"paid": 2}}}):
+        yield
+
+
+@pytest.fixture
+def warm_box(session):
+    box = WarmBox(
+        job_id="box-client-warm-abc",
+        image=IMAGE,
+        plan=Plan.paid(),
+        ssh_port=2200,
+        ip_address="10.0.0.5",
+        ready=True,
+    )
+    session.add(box)
+    session.flush()
+    return box
+
+
+class TestWarmPoolService(object):
+    """Warm pool keeps idle boxes ready to be claimed"""
+
+    @mock.patch("app.services.warm_pool.refill_warm_pool.queue")
+    def test_claim_ready_box(self, mock_refill, warm_pool, warm_box):
+        """ A ready box for the image and plan is taken from the pool"""
+        claimed = claim_warm_box(IMAGE, Plan.paid())
+
+        assert claimed.job_id == "box-client-warm-abc"
+        assert WarmBox.query.count() == 0
+
+    def test_claim_skips_unpooled_images(self, warm_pool, warm_box):
+        """ Images without a pool go straight to Nomad"""
+        assert claim_warm_box("cypherpunkarmory/kali:0.0.1", Plan.paid()) is None
+        assert claim_warm_box(IMAGE, Plan.free()) is None
+
+    @mock.patch("app.services.warm_pool.submit_box_job", return_value="eval-1")
+    @mock.patch("app.services.warm_pool.wait_for_box", return_value=(2201, "10.0.0.6"))
+    def test_refill_starts_missing_boxes(
+        self, mock_wait, mock_submit, warm_pool, warm_box
+    ):
+        """ Refill only starts enough boxes to reach the pool size"""
+        WarmPoolService().refill()
+
+        assert mock_submit.call_count == 1
+        assert WarmBox.query.filter_by(ready=True).count() == 2
+
+    def test_warm_job_reads_key_from_consul(self, warm_box):
+        """ Warm boxes pick up their key from Consul when claimed"""
+        job = warm_box_job(warm_box)
+        task = job["Job"]["TaskGroups"][0]["Tasks"][0]
+
+        assert job["Job"]["ID"] == "box-client-warm-abc"
+        assert task["Env"]["SSH_KEY"] == ""
+        assert "userland/warm/box-client-warm-abc/ssh_key" in (
+            task["Templates"][-1]["EmbeddedTmpl"]
+        )
+
+    def test_warm_job_reads_session_end_from_consul(self, warm_box):
+        """ Warm boxes keep the session end template of every box job"""
+        job = warm_box_job(warm_box)
+        task = job["Job"]["TaskGroups"][0]["Tasks"][0]
+
+        assert task["Templates"][0]["DestPath"] == "local/session_end"
+        assert task["Templates"][0]["ChangeMode"] == "noop"
+
+    def test_hand_over_waits_for_the_key(self, app, warm_box):
+        """ A claimed box is only handed back once its task has restarted"""
+        with FakeNomad(nodes=1, scheduling_delay=0) as fake:
+            fake.register(warm_box_job(warm_box)["Job"])
+            with mock.patch(
+                "app.services.warm_pool.inject_ssh_key",
+                side_effect=lambda job_id, key: fake.restart(job_id, delay=0.1),
+            ) as mock_inject:
+                hand_over(fake.client(), warm_box.job_id, "ssh-rsa AAA")
+
+            [allocation] = fake.running()
+
+        mock_inject.assert_called_once_with(warm_box.job_id, "ssh-rsa AAA")
+        [state] = allocation["TaskStates"].values()
+        assert state["Restarts"] == 1
+        assert state["State"] == "running"
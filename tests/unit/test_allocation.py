@@ -0,0 +1,110 @@
+import pytest
+from unittest import mock
+
+from app.utils.allocation import AllocationWaiter, placement_failure
+from app.utils.errors import BoxError, BoxPlacementFailed
+
+FAILED_EVALUATION = {
+    "ID": "eval-1",
+    "Status": "complete",
+    "FailedTGAllocs": {
+        "holepunch": {
+            "NodesEvaluated": 3,
+            "DimensionExhausted": {"memory": 3},
+            "ConstraintFiltered": None,
+        }
+    },
+}
+
+
+def nomad_response(allocations, index):
+    response = mock.Mock()
+    response.json.return_value = allocations
+    response.headers = {"X-Nomad-Index": str(index)}
+    return response
+
+
+@pytest.fixture
+def nomad_client():
+    client = mock.Mock()
+    client.timeout = 5
+    client.job.get_evaluations.return_value = []
+    return client
+
+
+class TestAllocationWaiter(object):
+    """Allocation waiter uses blocking queries to wait for a box"""
+
+    def test_returns_running_allocation(self, nomad_client):
+        """ Returns once the allocation reports running"""
+        nomad_client.job.request.side_effect = [
+            nomad_response([{"ID": "a1", "ClientStatus": "pending"}], 10),
+            nomad_response([{"ID": "a1", "ClientStatus": "running"}], 11),
+        ]
+
+        allocation = AllocationWaiter(nomad_client, "box-client-box-1", 30).wait()
+
+        assert allocation["ID"] == "a1"
+        assert nomad_client.job.request.call_count == 2
+        params = nomad_client.job.request.call_args[1]["params"]
+        assert params["index"] == 10
+        assert params["wait"] == "4000ms"
+
+    def test_fails_fast_on_placement_failure(self, nomad_client):
+        """ Raises a structured error when the evaluation cannot place the box"""
+        nomad_client.job.request.return_value = nomad_response([], 5)
+        nomad_client.evaluation.get_evaluation.return_value = FAILED_EVALUATION
+
+        with pytest.raises(BoxPlacementFailed) as e:
+            AllocationWaiter(
+                nomad_client, "box-client-box-1", 30, eval_id="eval-1"
+            ).wait()
+
+        assert "memory" in e.value.detail
+        assert e.value.code == "placement_failed"
+        assert nomad_client.job.request.call_count == 1
+
+    def test_raises_on_failed_allocation(self, nomad_client):
+        """ Raises when the allocation dies before it runs"""
+        nomad_client.job.request.return_value = nomad_response(
+            [{"ID": "a1", "ClientStatus": "failed"}], 5
+        )
+
+        with pytest.raises(BoxError) as e:
+            AllocationWaiter(nomad_client, "box-client-box-1", 30).wait()
+
+        assert e.value.code == "allocation_failed"
+
+    def test_raises_at_deadline(self, nomad_client):
+        """ Gives up once the deadline has passed"""
+        nomad_client.job.request.return_value = nomad_response([], 5)
+
+        with pytest.raises(BoxError) as e:
+            AllocationWaiter(nomad_client, "box-client-box-1", 0).wait()
+
+        assert e.value.code == "deadline_exceeded"
+        assert not nomad_client.job.request.called
+
+    def test_never_sends_a_zero_wait(self, nomad_client):
+        """ Asks for the last fraction of a second rather than Nomad's default"""
+        nomad_client.job.request.return_value = nomad_response(
+            [{"ID": "a1", "ClientStatus": "pending"}], 5
+        )
+
+        with pytest.raises(BoxError) as e:
+            AllocationWaiter(nomad_client, "box-client-box-1", 0.3).wait()
+
+        assert e.value.code == "deadline_exceeded"
+        for call in nomad_client.job.request.call_args_list:
+            wait = call[1]["params"]["wait"]
+            assert wait.endswith("ms") and 0 < int(wait[:-2]) <= 300
+
+
+class TestPlacementFailure(object):
+    def test_summarises_exhausted_dimensions(self):
+        assert placement_failure(FAILED_EVALUATION) == (
+            "holepunch: 3 nodes evaluated, blocked by memory"
+        )
+
+    def test_successful_evaluation(self):
+        assert placement_failure({"ID": "eval-2", "Status": "complete"}) is None
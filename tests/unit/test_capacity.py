@@ -0,0 +1,96 @@
+import fakeredis
+import pytest
+
+from app.models import UserLimit
+from app.utils.capacity import ClusterCapacity
+from tests.support.fake_nomad import FakeNomad
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeStrictRedis()
+
+
+def limits(cpu, memory):
+    return UserLimit(
+        box_count=1,
+        duration=3600,
+        memory=memory,
+        cpu=cpu,
+        bandwidth=1000,
+        forwards=1,
+        reserved_config=1,
+    )
+
+
+def nomad_job(job_id, cpu, memory):
+    return {
+        "ID": job_id,
+        "Name": job_id,
+        "TaskGroups": [
+            {
+                "Name": "holepunch",
+                "Tasks": [{"Resources": {"CPU": cpu, "MemoryMB": memory}}],
+            }
+        ],
+    }
+
+
+class TestClusterCapacity(object):
+    """Boxes are checked against a shared snapshot of free capacity"""
+
+    def test_admits_without_snapshot(self, redis):
+        """ Nomad decides when there is no snapshot to go on"""
+        assert ClusterCapacity(redis).fits(limits(cpu=100000, memory=100000))
+
+    def test_refresh_subtracts_allocations(self, redis):
+        """ Live allocations use up their node's capacity"""
+        resources = {"CPU": 1000, "MemoryMB": 1024}
+        with FakeNomad(nodes=1, scheduling_delay=0, node_resources=resources) as fake:
+            fake.register(nomad_job("box-client-box-1", cpu=600, memory=512))
+            capacity = ClusterCapacity(redis)
+            snapshot = capacity.refresh(fake.client())
+
+        assert [node["free"] for node in snapshot[""]] == [[400, 512]]
+        assert capacity.fits(limits(cpu=400, memory=512))
+        assert not capacity.fits(limits(cpu=500, memory=512))
+
+    def test_only_nodes_the_job_can_use(self, redis):
+        """ Room on nodes outside the job's placement does not count"""
+        with FakeNomad(nodes=2) as fake:
+            small, large = fake.nodes.values()
+            small["Resources"] = {"CPU": 500, "MemoryMB": 512}
+            large["NodeClass"] = "gpu"
+            capacity = ClusterCapacity(redis)
+            capacity.refresh(fake.client())
+
+        box_job = {
+            "Datacenters": ["city"],
+            "Constraints": [
+                {"LTarget": "${meta.app}", "RTarget": "userland", "Operand": "="}
+            ],
+        }
+        assert capacity.fits(limits(cpu=1000, memory=1024), box_job)
+        box_job["Constraints"].append(
+            {"LTarget": "${node.class}", "RTarget": "", "Operand": "="}
+        )
+        assert not capacity.fits(limits(cpu=1000, memory=1024), box_job)
+        assert not capacity.fits(
+            limits(cpu=1000, memory=1024), dict(box_job, Datacenters=["other"])
+        )
+
+    def test_refresh_skips_draining_nodes(self, redis):
+        """ A draining node has no room for new boxes"""
+        with FakeNomad(nodes=2) as fake:
+            node = next(iter(fake.nodes.values()))
+            node["Drain"] = True
+            snapshot = ClusterCapacity(redis).refresh(fake.client())
+
+        assert len(snapshot[""]) == 1
+
+    def test_snapshot_expires(self, redis):
+        """ A snapshot nobody refreshes stops turning boxes away"""
+        with FakeNomad(nodes=1, node_resources={"CPU": 0, "MemoryMB": 0}) as fake:
+            ClusterCapacity(redis, max_age=1).refresh(fake.client())
+
+        assert 0 < redis.ttl(ClusterCapacity.KEY) <= 1
@@ -0,0 +1,75 @@
+import pytest
+
+from app.utils.circuit_breaker import CircuitBreaker, CircuitOpen
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=clock)
+
+
+class TestCircuitBreaker(object):
+    """Circuit breaker stops calls to a failing dependency"""
+
+    def test_opens_after_threshold(self, breaker):
+        """ Fails fast once the failure threshold is reached"""
+        for _ in range(3):
+            breaker.before_call()
+            breaker.record_failure()
+
+        with pytest.raises(CircuitOpen) as e:
+            breaker.before_call()
+
+        assert e.value.retry_after == 30
+
+    def test_success_resets_failures(self, breaker):
+        """ Only consecutive failures count toward the threshold"""
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+
+        breaker.before_call()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_probe_closes(self, breaker, clock):
+        """ A single probe is let through after the reset timeout"""
+        for _ in range(3):
+            breaker.record_failure()
+        clock.now += 30
+
+        breaker.before_call()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(CircuitOpen):
+            breaker.before_call()
+
+        breaker.record_success()
+        breaker.before_call()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_failed_probe_reopens(self, breaker, clock):
+        """ A failed probe opens the breaker for another reset timeout"""
+        for _ in range(3):
+            breaker.record_failure()
+        clock.now += 31
+
+        breaker.before_call()
+        breaker.record_failure()
+
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpen) as e:
+            breaker.before_call()
+        assert e.value.retry_after == 30
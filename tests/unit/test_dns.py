@@ -1,15 +1,23 @@
 import pytest
 from app.utils.dns import (
+    DiscoveryCache,
+    EndpointHealth,
     ServiceSRVRecord,
     ServiceARecord,
     ServiceExplicit,
     discover_service,
+    discovery_cache,
+    resolve_service,
+    warm_discovery_cache,
 )
 
 from collections import Counter
+from unittest import mock
+import dns.exception
 import dns.message
 import random
 import re
+import time
 
 # DO NOT ADJUST THE FORMATTING ON THIS STRING
 # IT WILL NOT PARSE
@@ -100,3 +108,228 @@ class TestServiceDiscovery(object):
     def test_service_discovery_with_a_record(self):
         ip = discover_service("nomad", "A").ip
         assert re.match(r"172\.1[78]\.\d{1,3}\.\d{1,3}", ip)
+
+
+@pytest.fixture
+def cache():
+    cache = DiscoveryCache()
+    with mock.patch.object(DiscoveryCache, "_flush"):
+        yield cache
+
+
+def wait_for_refresh(cache):
+    deadline = time.monotonic() + 5
+    while cache._refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class TestDiscoveryCache(object):
+    """Discovered services are cached for their TTL and refreshed in the
+    background once stale"""
+
+    @mock.patch("app.utils.dns.resolve_service")
+    def test_fresh_answer_is_cached(self, mock_resolve, cache, a_response):
+        """ Lookups within the TTL do not go to Consul"""
+        mock_resolve.return_value = (ServiceARecord(a_response), 600)
+
+        first = cache.get("nomad", "A")
+        second = cache.get("nomad", "A")
+
+        assert first is second
+        assert mock_resolve.call_count == 1
+        assert cache.counts == {"miss": 1, "hit": 1}
+
+    @mock.patch("app.utils.dns.time.monotonic")
+    @mock.patch("app.utils.dns.resolve_service")
+    def test_stale_answer_served_while_refreshing(
+        self, mock_resolve, mock_now, cache, a_response, response
+    ):
+        """ A stale answer is returned straight away and replaced in the
+        background"""
+        stale, fresh = ServiceARecord(a_response), ServiceSRVRecord(response)
+        mock_resolve.side_effect = [(stale, 10), (fresh, 10)]
+        mock_now.return_value = 100.0
+        cache.get("nomad", "A")
+
+        mock_now.return_value = 115.0
+        assert cache.get("nomad", "A") is stale
+        wait_for_refresh(cache)
+
+        assert cache.get("nomad", "A") is fresh
+        assert cache.counts == {"miss": 1, "stale": 1, "hit": 1}
+
+    @mock.patch("app.utils.dns.time.monotonic")
+    @mock.patch("app.utils.dns.resolve_service")
+    def test_failed_refresh_keeps_stale_answer(
+        self, mock_resolve, mock_now, cache, a_response
+    ):
+        """ A DNS failure while refreshing leaves the last good answer in use"""
+        stale = ServiceARecord(a_response)
+        mock_resolve.side_effect = [(stale, 10), dns.exception.Timeout()]
+        mock_now.return_value = 100.0
+        cache.get("nomad", "A")
+
+        mock_now.return_value = 115.0
+        cache.get("nomad", "A")
+        wait_for_refresh(cache)
+
+        assert cache.get("nomad", "A") is stale
+        assert cache.counts["error"] == 1
+
+    @mock.patch("app.utils.dns.time.monotonic")
+    @mock.patch("app.utils.dns.resolve_service")
+    def test_short_ttl_is_floored(self, mock_resolve, mock_now, app, cache, response):
+        """ Records with a TTL of 0 are still kept for DISCOVERY_MIN_TTL"""
+        mock_resolve.return_value = (ServiceSRVRecord(response), 0)
+        mock_now.return_value = 100.0
+        cache.get("nomad", "SRV")
+
+        mock_now.return_value = 100.0 + app.config["DISCOVERY_MIN_TTL"] - 1
+        cache.get("nomad", "SRV")
+
+        assert mock_resolve.call_count == 1
+
+    @mock.patch("app.utils.dns.resolve_service")
+    def test_failed_lookup_without_answer_raises(self, mock_resolve, cache):
+        """ A name that has never resolved fails like an uncached lookup"""
+        mock_resolve.side_effect = dns.exception.Timeout()
+
+        with pytest.raises(dns.exception.Timeout):
+            cache.get("nomad", "A")
+
+        assert cache.counts == {"miss": 1, "error": 1}
+
+    @mock.patch("app.utils.dns.BaseService.resolver")
+    def test_resolve_uses_smallest_ttl(self, mock_resolver, response):
+        """ The TTL of an answer is the smallest among its records"""
+        for rrset in response.answer + response.additional:
+            rrset.ttl = 30
+        response.additional[1].ttl = 10
+        mock_resolver.return_value.query.return_value.response = response
+
+        with mock.patch.dict("os.environ", {"FLASK_ENV": "production"}):
+            service, ttl = resolve_service("nomad", "SRV")
+
+        assert isinstance(service, ServiceSRVRecord)
+        assert ttl == 10
+
+
+@pytest.fixture
+def health():
+    health = EndpointHealth(failures=2, ejection=10, max_ejection=15)
+    with mock.patch("app.utils.dns.endpoint_health", health):
+        yield health
+
+
+class TestEndpointHealth(object):
+    """Endpoints that keep failing are ejected and the quicker ones are
+    preferred"""
+
+    @mock.patch("app.utils.dns.time.monotonic", return_value=100.0)
+    def test_ejects_after_repeated_failures(self, mock_now, health, response):
+        """ Ejection backs off with each ejection and ends on success"""
+        entry = ServiceSRVRecord(response).entries()[0]
+
+        health.report_failure(entry)
+        assert health.available(entry, 100.0)
+        health.report_failure(entry)
+        assert not health.available(entry, 109.0)
+        assert health.available(entry, 110.0)
+
+        health.report_failure(entry)
+        health.report_failure(entry)
+        assert not health.available(entry, 114.0)
+        assert health.available(entry, 115.0)
+
+        health.report_failure(entry)
+        health.report_failure(entry)
+        health.report_success(entry, 0.01)
+        assert health.available(entry, 100.0)
+
+    def test_ejected_endpoints_are_skipped(self, health, response):
+        """ Ejected endpoints get no traffic while others are available"""
+        srv = ServiceSRVRecord(response)
+        ejected = srv.entries()[0]
+        health.report_failure(ejected)
+        health.report_failure(ejected)
+
+        assert ejected not in {srv.choose() for _ in range(50)}
+
+    def test_all_ejected_still_answers(self, health, response):
+        """ With every endpoint ejected they are all used again"""
+        srv = ServiceSRVRecord(response)
+        for entry in srv.entries():
+            health.report_failure(entry)
+            health.report_failure(entry)
+
+        assert srv.choose() in srv.entries()
+
+    def test_quicker_endpoint_preferred(self, health, response):
+        """ The quicker of two drawn endpoints is used"""
+        rstate = random.getstate()
+        random.seed(5)
+
+        srv = ServiceSRVRecord(response)
+        slow, quick, other = srv.entries()
+        health.report_success(slow, 2.0)
+        health.report_success(quick, 0.01)
+        health.report_success(other, 0.5)
+        counted = Counter([srv.choose() for _ in range(200)])
+
+        random.setstate(rstate)
+        assert counted[quick] > 200 * 0.15
+        assert counted[slow] < 200 * 0.7
+
+    def test_zero_weights_pick_evenly(self, health, response):
+        """ SRV records that all weigh 0 are picked evenly"""
+        for record in response.answer[0]:
+            record.weight = 0
+
+        srv = ServiceSRVRecord(response)
+
+        assert srv.weights == [1, 1, 1]
+        assert srv.choose() in srv.entries()
+
+
+class TestWarmDiscoveryCache(object):
+    """Workers look their services up in parallel before taking requests"""
+
+    @mock.patch("app.utils.dns.resolve_service")
+    def test_services_resolved_in_parallel(self, mock_resolve, app, a_response):
+        """ Every service is cached, in about the time of the slowest lookup"""
+
+        def resolve(service_name, query):
+            time.sleep(0.2)
+            if service_name == "mail":
+                raise dns.exception.Timeout()
+            return ServiceARecord(a_response), 600
+
+        mock_resolve.side_effect = resolve
+        discovery_cache.clear()
+        start = time.monotonic()
+        with mock.patch.object(discovery_cache, "_flush"):
+            unresolved = warm_discovery_cache(app, ["nomad", "consul", "mail"], 5)
+            elapsed = time.monotonic() - start
+
+            assert unresolved == ["mail"]
+            assert elapsed < 0.5
+            assert discovery_cache.get("consul", "SRV").ip == "172.18.0.7"
+            assert mock_resolve.call_count == 3
+        discovery_cache.clear()
+
+    @mock.patch("app.utils.dns.resolve_service")
+    def test_slow_lookups_do_not_hold_up_startup(self, mock_resolve, app, a_response):
+        """ Lookups still running at the timeout are given up on"""
+
+        def resolve(service_name, query):
+            time.sleep(1)
+            raise dns.exception.Timeout()
+
+        mock_resolve.side_effect = resolve
+
+        with mock.patch.object(discovery_cache, "_flush"):
+            start = time.monotonic()
+            unresolved = warm_discovery_cache(app, ["nomad"], 0.1)
+
+        assert unresolved == ["nomad"]
+        assert time.monotonic() - start < 0.5
@@ -0,0 +1,108 @@
+import fakeredis
+import pytest
+
+from app.utils.metrics import Counter, Gauge, Histogram, PhaseTimer
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def histogram():
+    return Histogram("box_phase_seconds", "Box phases", buckets=(0.5, 1, 5))
+
+
+class TestHistogram(object):
+    """Histograms are kept in Redis so every process shares them"""
+
+    def test_observe_counts_cumulative_buckets(self, redis, histogram):
+        """ Observations land in every bucket at or above their value"""
+        pipe = redis.pipeline()
+        histogram.observe(pipe, 0.75, phase="submit", image="ubuntu")
+        histogram.observe(pipe, 3, phase="submit", image="ubuntu")
+        pipe.execute()
+
+        lines = histogram.render(redis)
+
+        prefix = 'image="ubuntu",phase="submit"'
+        assert f'box_phase_seconds_bucket{{{prefix},le="0.5"}} 0' in lines
+        assert f'box_phase_seconds_bucket{{{prefix},le="1"}} 1' in lines
+        assert f'box_phase_seconds_bucket{{{prefix},le="5"}} 2' in lines
+        assert f'box_phase_seconds_bucket{{{prefix},le="+Inf"}} 2' in lines
+        assert f"box_phase_seconds_count{{{prefix}}} 2" in lines
+        assert f"box_phase_seconds_sum{{{prefix}}} 3.75" in lines
+
+
+class TestGauge(object):
+    """Gauges keep the last value set for each label set"""
+
+    def test_set_replaces_value(self, redis):
+        """ Only the latest value is rendered"""
+        gauge = Gauge("box_drift", "Box drift")
+        gauge.set(redis, 3, kind="orphaned")
+        gauge.set(redis, 1, kind="orphaned")
+
+        lines = gauge.render(redis)
+
+        assert lines[1] == "# TYPE box_drift gauge"
+        assert 'box_drift{kind="orphaned"} 1' in lines
+
+
+class TestCounter(object):
+    """Counters add up every increment for each label set"""
+
+    def test_inc_adds_up(self, redis):
+        """ Increments are summed per label set"""
+        counter = Counter("lookups_total", "Lookups")
+        counter.inc(redis, 3, result="hit")
+        counter.inc(redis, result="hit")
+        counter.inc(redis, result="miss")
+
+        lines = counter.render(redis)
+
+        assert lines[1] == "# TYPE lookups_total counter"
+        assert 'lookups_total{result="hit"} 4' in lines
+        assert 'lookups_total{result="miss"} 1' in lines
+
+
+class TestPhaseTimer(object):
+    """Phase timer records each phase of an operation"""
+
+    def test_records_phases_with_labels(self, app, redis, histogram):
+        """ Every timed phase is observed with the timer labels"""
+        timer = PhaseTimer(histogram, image="ubuntu", plan="paid")
+        with timer.phase("render"):
+            pass
+        with timer.phase("submit"):
+            pass
+
+        timer.record(redis)
+
+        fields = [field.decode() for field in redis.hkeys(histogram.key)]
+        assert 'image="ubuntu",outcome="ok",phase="render",plan="paid"|sum' in fields
+        assert 'image="ubuntu",outcome="ok",phase="submit",plan="paid"|sum' in fields
+        assert timer.timings == {}
+
+    def test_records_failures_by_outcome(self, app, redis, histogram):
+        """ A failed operation is recorded under its outcome"""
+        timer = PhaseTimer(histogram, image="ubuntu")
+        with timer.phase("running"):
+            pass
+
+        timer.record(redis, outcome="deadline_exceeded")
+
+        fields = [field.decode() for field in redis.hkeys(histogram.key)]
+        assert 'image="ubuntu",outcome="deadline_exceeded",phase="running"|sum' in (
+            fields
+        )
+
+    def test_phase_timed_when_it_raises(self):
+        """ A phase that fails is still timed"""
+        timer = PhaseTimer()
+        with pytest.raises(ValueError):
+            with timer.phase("submit"):
+                raise ValueError
+
+        assert "submit" in timer.timings
@@ -0,0 +1,50 @@
+import fakeredis
+import pytest
+from unittest import mock
+
+from app.utils.node_index import NodeIndex
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def nomad_client():
+    client = mock.Mock()
+    client.timeout = 5
+    response = mock.Mock()
+    response.json.return_value = [
+        {"ID": "node-1", "Address": "10.0.0.1"},
+        {"ID": "node-2", "Address": "10.0.0.2"},
+    ]
+    response.headers = {"X-Nomad-Index": "42"}
+    client.nodes.request.return_value = response
+    client.node.get_node.return_value = {"ID": "node-3", "Address": "10.0.0.3"}
+    return client
+
+
+class TestNodeIndex(object):
+    """Node addresses are looked up from a shared index"""
+
+    def test_sync_fills_the_index(self, redis, nomad_client):
+        """ Syncing stores every node and returns the next blocking index"""
+        index = NodeIndex(redis, nomad_client)
+
+        assert index.sync(7, wait=4) == 42
+        assert index.address("node-2") == "10.0.0.2"
+        assert nomad_client.nodes.request.call_args[1]["params"] == {
+            "index": 7,
+            "wait": "4s",
+        }
+        assert not nomad_client.node.get_node.called
+
+    def test_unknown_node_is_fetched_once(self, redis, nomad_client):
+        """ A missing node is fetched on its own and remembered"""
+        index = NodeIndex(redis, nomad_client)
+
+        assert index.address("node-3") == "10.0.0.3"
+        assert index.address("node-3") == "10.0.0.3"
+        assert nomad_client.node.get_node.call_count == 1
+        assert not nomad_client.nodes.request.called
@@ -0,0 +1,112 @@
+import nomad
+import pytest
+import requests
+import time
+from unittest import mock
+
+from app.utils.dns import EndpointHealth, Entry, ServiceExplicit
+from app.utils.errors import NomadUnavailable
+from app.utils.nomad_pool import NomadClientRegistry
+
+
+@pytest.fixture
+def discover():
+    with mock.patch(
+        "app.utils.nomad_pool.discover_service",
+        side_effect=lambda _: ServiceExplicit("10.0.0.1"),
+    ) as discover:
+        yield discover
+
+
+@pytest.fixture(autouse=True)
+def health():
+    health = EndpointHealth(failures=2)
+    with mock.patch("app.utils.nomad_pool.endpoint_health", health):
+        yield health
+
+
+class TestNomadClientRegistry(object):
+    """Nomad clients are pooled per process"""
+
+    def test_client_is_reused(self, app, discover):
+        """ Repeated lookups reuse the client and skip discovery"""
+        registry = NomadClientRegistry()
+        with app.app_context():
+            first = registry.client()
+            second = registry.client()
+
+        assert first is second
+        assert discover.call_count == 1
+
+    def test_endpoints_share_a_session(self, app, discover):
+        """ Every endpoint talks through the same keep-alive session"""
+        registry = NomadClientRegistry()
+        with app.app_context():
+            client = registry.client()
+
+        assert client.job.session is client.jobs.session
+        assert client.allocation.session is client.nodes.session
+
+    def test_resolves_again_after_failure(self, app, discover):
+        """ A failed connection triggers a fresh discovery"""
+        registry = NomadClientRegistry()
+        with app.app_context():
+            first = registry.client()
+            registry.mark_failed()
+            second = registry.client()
+
+        assert discover.call_count == 2
+        assert first is second
+
+    def test_new_client_when_address_changes(self, app, discover):
+        """ A new address from discovery builds a new client"""
+        registry = NomadClientRegistry()
+        with app.app_context():
+            first = registry.client()
+            registry.mark_failed()
+            discover.side_effect = lambda _: ServiceExplicit("10.0.0.2")
+            second = registry.client()
+
+        assert first is not second
+        assert second.host == "10.0.0.2"
+
+    @mock.patch("requests.adapters.HTTPAdapter.send")
+    def test_fails_fast_while_nomad_is_down(self, mock_send, app, discover):
+        """ Calls stop reaching Nomad once the breaker opens"""
+        mock_send.side_effect = requests.ConnectionError
+        registry = NomadClientRegistry()
+        with mock.patch.dict(app.config, {"NOMAD_BREAKER_THRESHOLD": 2}):
+            with app.app_context():
+                client = registry.client()
+                for _ in range(2):
+                    with pytest.raises(nomad.api.exceptions.BaseNomadException):
+                        client.job.get_job("box-client-box-1")
+
+                with pytest.raises(NomadUnavailable) as e:
+                    client.job.get_job("box-client-box-1")
+
+        assert mock_send.call_count == 2
+        assert e.value.retry_after == app.config["NOMAD_BREAKER_RESET"]
+
+    @mock.patch("requests.adapters.HTTPAdapter.send")
+    def test_reports_endpoint_health(self, mock_send, app, discover, health):
+        """ Server errors count against the endpoint and eject it"""
+
+        def server_error(request, **kwargs):
+            response = requests.Response()
+            response.status_code = 500
+            response.request = request
+            response._content = b"no leader"
+            return response
+
+        mock_send.side_effect = server_error
+        registry = NomadClientRegistry()
+        with app.app_context():
+            client = registry.client()
+            for _ in range(2):
+                with pytest.raises(nomad.api.exceptions.BaseNomadException):
+                    client.job.get_job("box-client-box-1")
+            registry.client()
+
+        assert not health.available(Entry("10.0.0.1", "0"), time.monotonic())
+        assert discover.call_count == 2
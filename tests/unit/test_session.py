@@ -0,0 +1,26 @@
+from app.utils.session import after_commit
+
+
+class TestAfterCommit(object):
+    """Callbacks run once their transaction commits"""
+
+    def test_runs_once_on_commit(self, session):
+        """ The callback runs on the next commit and only that one"""
+        calls = []
+        after_commit(lambda: calls.append("committed"))
+
+        session.commit()
+        session.commit()
+
+        assert calls == ["committed"]
+
+    def test_dropped_on_rollback(self, session):
+        """ A rolled back transaction never runs its callbacks"""
+        calls = []
+        after_commit(lambda: calls.append("rolled back"))
+        session.rollback()
+
+        after_commit(lambda: calls.append("committed"))
+        session.commit()
+
+        assert calls == ["committed"]